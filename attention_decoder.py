@@ -57,6 +57,9 @@ def attention_decoder(
     """
     with variable_scope.variable_scope("attention_decoder"):
         batch_size = encoder_states.get_shape()[0].value
+        if batch_size is None:
+            # batch size is only known at run time (decode mode)
+            batch_size = array_ops.shape(encoder_states)[0]
         attn_size = encoder_states.get_shape()[2].value
 
         # Reshape encoder_states (need to insert a dim) to shape
@@ -4,12 +4,14 @@ This file contains code to define model inputs and process data into batches.
 
 import Queue
 import numpy as np
+import random
 import tensorflow as tf
 import time
 from google.protobuf import text_format
 from random import shuffle
 from threading import Thread
 
+import compiled_data
 import data
 
 
@@ -35,20 +37,20 @@ class Example(object):
         start_decoding = vocab.word2id(data.START_DECODING, None)
         stop_decoding = vocab.word2id(data.STOP_DECODING, None)
 
-        # Process the article
-        article_words = [data.parse_word(word) for word in article.split()]
-        if len(article_words) > hps.max_enc_steps:
-            article_words = article_words[:hps.max_enc_steps]
+        # Process the article, truncated to max_enc_steps
+        article_tokens = [vocab.parse_token(token) for token in article.split()[:hps.max_enc_steps]]
+        article_words = [(w, word_type) for w, word_type, _ in article_tokens]
 
         # Store the length after truncation but before padding
         self.enc_len = len(article_words)
         # List of word ids; OOVs and entities are represented by ids less than data.N_FREE_TOKENS
-        self.enc_input = [vocab.word2id(w, word_type) for w, word_type in article_words]
+        self.enc_input = [word_id for _, _, word_id in article_tokens]
 
         # Process the abstract
-        abstract_words = [data.parse_word(word) for word in abstract.split()]
+        abstract_tokens = [vocab.parse_token(token) for token in abstract.split()]
+        abstract_words = [(w, word_type) for w, word_type, _ in abstract_tokens]
         # List of word ids; OOVs and entities are represented by ids less than data.N_FREE_TOKENS
-        abs_ids = [vocab.word2id(w, word_type) for w, word_type in abstract_words]
+        abs_ids = [word_id for _, _, word_id in abstract_tokens]
 
         # Get the decoder input sequence and target sequence with non-article specific ids.
         self.dec_input, target_orig = self.get_dec_inp_targ_seqs(
@@ -94,6 +96,59 @@ class Example(object):
         self.original_abstract = abstract
 
 
+    @classmethod
+    def from_packed_article(cls, packed_article, vocab, hps):
+        """
+        Returns an Example for decoding a packed_article.PackedArticle, without parsing the
+        article again. The encoder inputs are views of the packed article's buffer. There is no
+        abstract, and the original article string isn't stored.
+        """
+        example = cls.__new__(cls)
+        example.hps = hps
+
+        start_decoding = vocab.word2id(data.START_DECODING, None)
+        stop_decoding = vocab.word2id(data.STOP_DECODING, None)
+
+        example.enc_len = packed_article.enc_len
+        example.enc_input = packed_article.enc_input
+        example.enc_input_extend_vocab = packed_article.enc_input_extend_vocab
+        example.article_oovs = packed_article.article_oovs
+        example.article_id_to_word_id = packed_article.article_id_to_word_id
+
+        example.dec_input, target_orig = example.get_dec_inp_targ_seqs(
+            [], hps.max_dec_steps, start_decoding, stop_decoding
+        )
+        example.dec_len = len(example.dec_input)
+        _, example.target = example.get_dec_inp_targ_seqs(
+            [], hps.max_dec_steps, start_decoding, stop_decoding
+        )
+
+        people_tokens = {vocab.word2id('', token) for token in data.PERSON_TOKENS}
+        example.target_people = [float(token in people_tokens) for token in target_orig]
+        example.people_ids = [
+            article_id for article_id, word_id in example.article_id_to_word_id.iteritems()
+            if word_id in people_tokens
+        ]
+
+        example.original_article = ''
+        example.original_abstract = ''
+        return example
+
+
+    @classmethod
+    def from_compiled(cls, compiled_example, hps):
+        """
+        Returns the Example of a compiled_data.CompiledExample, compiled with the same vocab and
+        hyperparameters.
+        """
+        example = cls.__new__(cls)
+        example.hps = hps
+        for field, value in compiled_example._asdict().iteritems():
+            setattr(example, field, value)
+        example.dec_len = len(example.dec_input)
+        return example
+
+
     def get_dec_inp_targ_seqs(self, sequence, max_len, start_id, stop_id):
         """
         Given the reference summary as a sequence of tokens, return the input sequence for the
@@ -144,6 +199,11 @@ class Example(object):
         """
         Pad the encoder input sequences with pad_id up to max_len.
         """
+        if isinstance(self.enc_input, np.ndarray) and self.enc_len < max_len:
+            # views of a packed article, see from_packed_article
+            self.enc_input = list(self.enc_input)
+            self.enc_input_extend_vocab = list(self.enc_input_extend_vocab)
+
         while len(self.enc_input) < max_len:
             self.enc_input.append(pad_id)
 
@@ -331,10 +391,29 @@ class Batcher(object):
             # how many batches-worth of examples to load into cache before bucketing
             self._bucketing_cache_size = 100
 
+        # If the data files are compiled for this vocab and hps (see compiled_data.py), read the
+        # Examples from the compiled files.
+        self._compiled_path = compiled_data.compiled_data_path(
+            data_path, compiled_data.vocab_fingerprint(vocab, hps)
+        )
+        self._compiled = data.has_record_indices(self._compiled_path)
+        if self._compiled:
+            tf.logging.info('Reading compiled data from %s', self._compiled_path)
+        # If the data files are indexed, each example queue thread reads its own shard of the
+        # examples, in a random order over all files shared by the threads, through one reader
+        # shared by the threads (so the number of open files doesn't grow with the threads).
+        self._indexed = self._compiled or data.has_record_indices(data_path)
+        self._indexed_records = None
+        if self._indexed:
+            self._indexed_records = data.IndexedRecords(
+                self._compiled_path if self._compiled else data_path
+            )
+        self._shuffle_seed = random.randint(0, 2 ** 31)
+
         # Start the threads that load the queues
         self._example_q_threads = []
-        for _ in xrange(self._num_example_q_threads):
-            self._example_q_threads.append(Thread(target=self.fill_example_queue))
+        for shard in xrange(self._num_example_q_threads):
+            self._example_q_threads.append(Thread(target=self.fill_example_queue, args=(shard,)))
             self._example_q_threads[-1].daemon = True
             self._example_q_threads[-1].start()
         self._batch_q_threads = []
@@ -378,17 +457,37 @@ class Batcher(object):
         return batch
 
 
-    def fill_example_queue(self):
+    def fill_example_queue(self, shard=0):
         """
-        Reads data from file and processes into Examples which are then placed into the example
-        queue.
+        Reads data from file and processes into Examples (or reads compiled Examples) which are
+        then placed into the example queue. If the data files are indexed, only reads the shard of
+        this thread.
         """
-        input_gen = self.text_generator(data.example_generator(self._data_path, self._single_pass))
+        if self._compiled:
+            examples = (
+                Example.from_compiled(compiled_data.unpack_example(record), self._hps)
+                for record in data.indexed_record_generator(
+                    self._indexed_records, self._single_pass, shard, self._num_example_q_threads,
+                    self._shuffle_seed,
+                )
+            )
+        else:
+            if self._indexed:
+                example_gen = data.indexed_example_generator(
+                    self._indexed_records, self._single_pass, shard, self._num_example_q_threads,
+                    self._shuffle_seed,
+                )
+            else:
+                example_gen = data.example_generator(self._data_path, self._single_pass)
+            examples = (
+                Example(article, abstract, self._vocab, self._hps)
+                for article, abstract in self.text_generator(example_gen)
+            )
 
         while True:
             try:
-                # read the next example from file. article and abstract are both strings.
-                (article, abstract) = input_gen.next()
+                # read the next example from file
+                example = examples.next()
             except StopIteration:
                 # if there are no more examples:
                 tf.logging.info(
@@ -407,7 +506,6 @@ class Batcher(object):
                         "single_pass mode is off but the example generator is out of data; error."
                     )
 
-            example = Example(article, abstract, self._vocab, self._hps)
             if self._hps.attn_only_entities:
                 n_people_enc_tokens = sum(
                     1 for token in example.enc_input[:self._hps.max_enc_steps]
@@ -463,7 +561,7 @@ class Batcher(object):
             for idx,t in enumerate(self._example_q_threads):
                 if not t.is_alive():
                     tf.logging.error('Found example queue thread dead. Restarting.')
-                    new_t = Thread(target=self.fill_example_queue)
+                    new_t = Thread(target=self.fill_example_queue, args=(idx,))
                     self._example_q_threads[idx] = new_t
                     new_t.daemon = True
                     new_t.start()
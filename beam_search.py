@@ -7,6 +7,7 @@ import os
 
 import data
 import language_check
+from constraints import ConstraintMasker
 
 
 class Hypothesis(object):
@@ -140,8 +141,51 @@ class Hypothesis(object):
         return sum(self.log_probs[1:]) / (len(self.log_probs) - 1)
 
 
+class AdaptiveBeam(object):
+    """
+    Policy for varying the number of hypotheses kept at each step of beam search. When the best
+    candidate is far ahead of the others the step is nearly deterministic, so fewer hypotheses are
+    kept (and the decoder runs on fewer rows). When the candidates are close, the beam is widened
+    again.
+    """
+
+    def __init__(self, min_beam_size=1, max_beam_size=4, log_prob_margin=2.):
+        """
+        AdaptiveBeam constructor.
+
+        Args:
+            min_beam_size: Integer, the least number of hypotheses to keep.
+            max_beam_size: Integer, the most number of hypotheses to keep.
+            log_prob_margin: Float. Candidates whose total log probability is within this margin
+                of the best candidate's are kept.
+        """
+        assert 1 <= min_beam_size <= max_beam_size
+        self.min_beam_size = min_beam_size
+        self.max_beam_size = max_beam_size
+        self.log_prob_margin = log_prob_margin
+
+
+    def beam_size(self, candidate_log_probs):
+        """
+        Returns the number of hypotheses to keep for the next step.
+
+        Args:
+            candidate_log_probs: List of floats, the total log probabilities of the candidates
+                that can be extended.
+        """
+        if not candidate_log_probs:
+            return self.min_beam_size
+        best = max(candidate_log_probs)
+        n_close = sum(
+            1 for log_prob in candidate_log_probs if best - log_prob < self.log_prob_margin
+        )
+        return max(self.min_beam_size, min(self.max_beam_size, n_close))
+
+
 def run_beam_search(
-    sess, model, vocab, batch, beam_size, max_dec_steps, min_dec_steps, trace_path=''
+    sess, model, vocab, batch, beam_size, max_dec_steps, min_dec_steps, trace_path='',
+    expansion_size=None, recombination_n_gram=None, mask_constraints=False, adaptive_beam=None,
+    stats=None,
 ):
     """
     Performs beam search decoding on the given example.
@@ -151,87 +195,212 @@ def run_beam_search(
         model: a seq2seq model
         vocab: Vocabulary object
         batch: Batch object that is the same example repeated across the batch
-        beam_size: Integer, size of the search at each step
+        beam_size: Integer, size of the search at each step. At most the model's batch size.
         max_dec_steps: Integer, stop search after this many steps
         min_dec_steps: Integer, accept results of at least this length only
         trace_path: string, if provided save trace results to this path
+        expansion_size, recombination_n_gram, mask_constraints, adaptive_beam, stats: see
+            BeamSearch.
   
     Returns:
         best_hyp: Hypothesis object; the best hypothesis found by beam search.
         score: the score of the best hypothesis.
     """
-    # Run the encoder to get the encoder hidden states and decoder initial state.
-    # enc_states has shape [batch_size, <=max_enc_steps, 2*enc_hidden_dim].
-    # dec_in_state is a LSTMStateTuple, or if two layer lstm then a tuple of LSTMStateTuples.
-    enc_states, dec_in_state = model.run_encoder(sess, batch)
-
-    # Initialize beam_size-many hypotheses
-    hyps = [
-        Hypothesis(
-            tokens=[vocab.word2id(data.START_DECODING, None)],
-            token_strings=[data.START_DECODING],
-            log_probs=[0.],
-            state=dec_in_state,
-            attn_dists=[],
-            p_gens=[],
-            # zero vector of length attention_length
-            coverage=np.zeros([batch.enc_batch.shape[1]]),
-        )
-        for _ in xrange(beam_size)
-    ]
-    # This will contain finished hypotheses (those that have emitted the [STOP] token).
-    results = []
-    # Ids for tokens that will be needed for scoring hypotheses.
-    org_id = vocab.word2id('[ORG]', None)
-    key_token_ids = {
-        'stop': vocab.word2id(data.STOP_DECODING, None),
-        'comma': vocab.word2id(',', None),
-        'period': vocab.word2id('.', None),
-        'pronouns': {vocab.word2id(word, None) for word in ('he', 'she', 'him', 'her')},
-        'people': set(
-            article_id for article_id, word_id in batch.article_id_to_word_ids[0].iteritems()
-            if 3 <= word_id < len(data.PERSON_TOKENS) + 3
-        ),
-        'orgs': set(
-            article_id for article_id, word_id in batch.article_id_to_word_ids[0].iteritems()
-            if word_id == org_id
-        ),
-    }
-
-    steps = 0
-    while steps < max_dec_steps and len(results) < 4 * beam_size:
-        latest_tokens = [h.latest_token for h in hyps]
-        # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
+    search = BeamSearch(
+        sess, model, vocab, batch, beam_size, [(min_dec_steps, max_dec_steps)],
+        expansion_size=expansion_size,
+        recombination_n_gram=recombination_n_gram,
+        mask_constraints=mask_constraints,
+        adaptive_beam=adaptive_beam,
+        stats=stats,
+    )
+    search.run()
+    write_traces(model, trace_path)
+    return search.best(0)
+
+
+def write_traces(model, trace_path):
+    """
+    If needed, record trace of the search performance.
+    """
+    if trace_path:
+        for i, trace in enumerate(model._traces):
+            with open(os.path.join(trace_path, 'timeline_%d.json' % i), 'w') as f:
+                f.write(trace)
+
+
+class BeamSearch(object):
+    """
+    Beam search over a single example, run one decoder step at a time. Results are collected for
+    a list of length ranges at once, so summaries of several lengths come from a single encoder
+    pass and a single search: finished hypotheses are assigned to every range they fall in, and the
+    search goes on while some range still needs results.
+    """
+
+    def __init__(
+        self, sess, model, vocab, batch, beam_size, length_ranges, expansion_size=None,
+        recombination_n_gram=None, mask_constraints=False, adaptive_beam=None, stats=None,
+    ):
+        """
+        BeamSearch constructor. Runs the encoder.
+
+        Args:
+            sess: a tf.Session
+            model: a seq2seq model
+            vocab: Vocabulary object
+            batch: Batch object that is the same example repeated across the batch
+            beam_size: Integer, size of the search at each step. At most the model's batch size.
+            length_ranges: list of (min_dec_steps, max_dec_steps) tuples. For each, results of at
+                least min_dec_steps and less than max_dec_steps steps are collected.
+            expansion_size: Integer, the number of candidates each hypothesis is extended with at
+                each step. Defaults to 2 * beam_size, and can be at most twice the model's batch
+                size.
+            recombination_n_gram: Integer or None. If set, hypotheses whose last n token strings
+                are identical are merged, keeping only the highest scoring one, so that duplicates
+                don't take up beam slots. If 0, only merge hypotheses with identical full
+                histories.
+            mask_constraints: Boolean. If True, tokens that would make a hypothesis malformed are
+                masked out before taking the top candidates of each step (see constraints.py),
+                rather than only being penalized afterwards.
+            adaptive_beam: AdaptiveBeam or None. If provided, the number of hypotheses kept at
+                each step is chosen by this policy (but is never more than beam_size).
+            stats: optional dictionary. If provided, it is filled with counts describing the
+                search ('steps'; 'rows', the total number of decoder rows run over all steps;
+                'recombined', the number of beam slots reclaimed by recombination; and 'wasted',
+                the number of candidates discarded for being malformed or unknown).
+        """
+        assert length_ranges
+        self._sess = sess
+        self._model = model
+        self._vocab = vocab
+        self._batch = batch
+        self._beam_size = beam_size
+        self._length_ranges = length_ranges
+        self._min_dec_steps = min(min_steps for min_steps, _ in length_ranges)
+        self._expansion_size = expansion_size or 2 * beam_size
+        self._recombination_n_gram = recombination_n_gram
+        self._adaptive_beam = adaptive_beam
+        self._stats = stats
+
+        # Run the encoder to get the encoder hidden states and decoder initial state.
+        # enc_states has shape [batch_size, <=max_enc_steps, 2*enc_hidden_dim].
+        # dec_in_state is a LSTMStateTuple, or if two layer lstm then a tuple of LSTMStateTuples.
+        self._enc_states, dec_in_state = model.run_encoder(sess, batch)
+
+        # Initialize with the single initial hypothesis.
+        self.hyps = [
+            Hypothesis(
+                tokens=[vocab.word2id(data.START_DECODING, None)],
+                token_strings=[data.START_DECODING],
+                log_probs=[0.],
+                state=dec_in_state,
+                attn_dists=[],
+                p_gens=[],
+                # zero vector of length attention_length
+                coverage=np.zeros([batch.enc_batch.shape[1]]),
+            )
+        ]
+        # For each length range, the finished hypotheses (those that have emitted the [STOP]
+        # token), and the live hypotheses when the range's maximum length was reached.
+        self._results = [[] for _ in length_ranges]
+        self._fallbacks = [[] for _ in length_ranges]
+        # Keys of all finished hypotheses, used for recombination
+        self._result_keys = set()
+        # Ids for tokens that will be needed for scoring hypotheses.
+        org_id = vocab.word2id('[ORG]', None)
+        self.key_token_ids = {
+            'stop': vocab.word2id(data.STOP_DECODING, None),
+            'comma': vocab.word2id(',', None),
+            'period': vocab.word2id('.', None),
+            'pronouns': {vocab.word2id(word, None) for word in ('he', 'she', 'him', 'her')},
+            'people': set(
+                article_id for article_id, word_id in batch.article_id_to_word_ids[0].iteritems()
+                if 3 <= word_id < len(data.PERSON_TOKENS) + 3
+            ),
+            'orgs': set(
+                article_id for article_id, word_id in batch.article_id_to_word_ids[0].iteritems()
+                if word_id == org_id
+            ),
+        }
+
+        # Masks out invalid next tokens before the top candidates are taken, if enabled.
+        self._masker = None
+        if mask_constraints:
+            self._masker = ConstraintMasker(vocab, batch.art_oovs[0], self._min_dec_steps)
+
+        self.steps = 0
+        self._n_rows = 0
+        self._n_recombined = 0
+        self._n_wasted = 0
+        self._update_stats()
+
+
+    @property
+    def done(self):
+        """
+        Whether every length range has 4 * beam_size results or has reached its maximum length,
+        or there are no hypotheses left to extend.
+        """
+        return not self.hyps or not any(self._is_open(i) for i in xrange(len(self._length_ranges)))
+
+
+    def run(self):
+        """
+        Runs steps until the search is done.
+        """
+        while not self.done:
+            self.step()
+
+
+    def step(self):
+        """
+        Runs one step of the decoder on the live hypotheses, and collects the finished ones.
+        """
+        assert not self.done
+        vocab = self._vocab
+        batch = self._batch
+        hyps = self.hyps
+        steps = self.steps
+
+        # The decoder runs on one row per hypothesis. Unless the beam is adaptive, the first step
+        # runs the single initial hypothesis on beam_size identical rows, as every later step
+        # does, since matrix products over a different number of rows round differently. Only
+        # the first row is extended.
+        rows = hyps
+        if steps == 0 and self._adaptive_beam is None:
+            rows = hyps * self._beam_size
+        self._n_rows += len(rows)
+        latest_tokens = [h.latest_token for h in rows]
+        # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word
+        # embeddings
         latest_tokens = [batch.article_id_to_word_ids[0].get(t, t) for t in latest_tokens]
         # list of current decoder states of the hypotheses
-        states = [h.state for h in hyps]
+        states = [h.state for h in rows]
         # list of coverage vectors (or None)
-        prev_coverage = [h.coverage for h in hyps]
+        prev_coverage = [h.coverage for h in rows]
 
         # Run one step of the decoder to get the new info
         topk_ids, topk_log_probs, new_states, attn_dists, p_gens, new_coverage = (
-            model.decode_onestep(
-                sess=sess,
+            self._model.decode_onestep(
+                sess=self._sess,
                 batch=batch,
                 latest_tokens=latest_tokens,
-                enc_states=enc_states,
+                enc_states=self._enc_states,
                 dec_init_states=states,
                 prev_coverage=prev_coverage,
+                logit_mask=self._masker.mask(rows, steps) if self._masker else None,
             )
         )
 
         # Extend each hypothesis and collect them all in all_hyps
         all_hyps = []
-        # On the first step, we only had one original hypothesis (the initial hypothesis). On
-        # subsequent steps, all original hypotheses are distinct.
-        num_orig_hyps = 1 if steps == 0 else len(hyps)
-        for i in xrange(num_orig_hyps):
+        for i in xrange(len(hyps)):
             h, new_state, attn_dist, p_gen, new_coverage_i = (
                 hyps[i], new_states[i], attn_dists[i], p_gens[i], new_coverage[i]
             )
-            for j in xrange(2 * beam_size):
+            for j in xrange(self._expansion_size):
                 token_string = data.outputid_to_word(topk_ids[i, j], vocab, batch.art_oovs[0])
-                # For each of the top 2 * beam_size hyps:
+                # For each of the top expansion_size hyps:
                 # Extend the ith hypothesis with the jth option
                 new_hyp = h.extend(
                     token=topk_ids[i, j],
@@ -244,48 +413,125 @@ def run_beam_search(
                 )
                 all_hyps.append(new_hyp)
 
+        if self._stats is not None:
+            self._n_wasted += sum(
+                1 for h in all_hyps
+                if _is_wasted(h, steps, self._min_dec_steps, vocab.size, self.key_token_ids)
+            )
+
+        # Number of hypotheses to keep for the next step
+        step_beam_size = self._beam_size
+        if self._adaptive_beam is not None:
+            step_beam_size = min(self._beam_size, self._adaptive_beam.beam_size([
+                sum(h.log_probs) for h in all_hyps if h.latest_token >= data.N_FREE_TOKENS
+            ]))
+
         # Filter and collect any hypotheses that have produced the end token.
         # will contain hypotheses for the next step
         hyps = []
-        for h in sort_hyps(all_hyps, vocab.size, key_token_ids, complete_hyps=False):
+        # keys of the hypotheses kept so far, used for recombination
+        hyp_keys = set()
+        for h in sort_hyps(all_hyps, vocab.size, self.key_token_ids, complete_hyps=False):
             # in order of most likely h
-            if h.latest_token == vocab.word2id(data.STOP_DECODING, None):
-                # Stop token is reached. If this hypothesis is sufficiently long, put in results.
-                # Otherwise discard.
-                if steps >= min_dec_steps:
-                    results.append(h)
+            if h.latest_token == self.key_token_ids['stop']:
+                # Stop token is reached. Put it in the results of each open length range it is
+                # long enough for. Otherwise discard.
+                range_indices = [
+                    i for i, (min_steps, _) in enumerate(self._length_ranges)
+                    if steps >= min_steps and self._is_open(i)
+                ]
+                if not range_indices:
+                    continue
+                key = tuple(h.token_strings)
+                if self._recombination_n_gram is not None and key in self._result_keys:
+                    # same summary as a better result already found
+                    self._n_recombined += 1
+                    continue
+                self._result_keys.add(key)
+                for i in range_indices:
+                    self._results[i].append(h)
             elif h.latest_token >= data.N_FREE_TOKENS:
-                # Hasn't reached stop token and generated non-unk token, so continue to extend this
-                # hypothesis.
+                # Hasn't reached stop token and generated non-unk token, so continue to extend
+                # this hypothesis.
+                if self._recombination_n_gram is not None:
+                    key = _recombination_key(h.token_strings, self._recombination_n_gram)
+                    if key in hyp_keys:
+                        # a better hypothesis with the same recent history is already kept
+                        self._n_recombined += 1
+                        continue
+                    hyp_keys.add(key)
                 hyps.append(h)
-            if len(hyps) == beam_size or len(results) == 4 * beam_size:
-                # Once we've collected beam_size-many hypotheses for the next step, or
-                # 4 * beam_size-many complete hypotheses, stop.
+            if len(hyps) == step_beam_size or not any(
+                len(self._results[i]) < 4 * self._beam_size and self._is_open(i)
+                for i in xrange(len(self._length_ranges))
+            ):
+                # Once we've collected step_beam_size-many hypotheses for the next step, or
+                # 4 * beam_size-many complete hypotheses for each length range, stop.
                 break
 
-        steps += 1
+        self.hyps = hyps
+        self.steps += 1
+        for i, (_, max_steps) in enumerate(self._length_ranges):
+            if self.steps == max_steps:
+                # Keep the incomplete summaries, in case this range has no results.
+                self._fallbacks[i] = hyps
+        self._update_stats()
 
-    if trace_path:
-        # If needed, record trace of the search performance.
-        for i, trace in enumerate(model._traces):
-            with open(os.path.join(trace_path, 'timeline_%d.json' % i), 'w') as f:
-                f.write(trace)
 
-    # At this point, either we've got 4 * beam_size results, or we've reached maximum decoder steps.
+    def sorted_results(self, index):
+        """
+        Returns the hypotheses for the length range with the given index, sorted from best to
+        worst. If there aren't any complete results, the current (or last, if the maximum length
+        was reached) hypotheses are used, i.e. incomplete summaries. Note: we still use
+        complete_hyps=True since we want to check for valid grammar properties.
+        """
+        results = self._results[index] or self._fallbacks[index] or self.hyps
+        return sort_hyps(results, self._vocab.size, self.key_token_ids, complete_hyps=True)
+
+
+    def best(self, index):
+        """
+        Returns the best hypothesis for the length range with the given index, and its score.
+        """
+        best_hyp = self.sorted_results(index)[0]
+        score = best_hyp.score(self._vocab.size, self.key_token_ids, is_complete=True)
+        return best_hyp, score
+
+
+    def n_best(self, index, n=None):
+        """
+        Returns up to n (or all, if n is None) hypotheses with distinct token strings for the
+        length range with the given index, best first, each with its score.
+        """
+        n_best = []
+        keys = set()
+        for hyp in self.sorted_results(index):
+            key = tuple(hyp.token_strings)
+            if key in keys:
+                continue
+            keys.add(key)
+            n_best.append((hyp, hyp.score(self._vocab.size, self.key_token_ids, is_complete=True)))
+            if len(n_best) == n:
+                break
+        return n_best
+
 
-    if len(results) == 0:
-        # If we don't have any complete results, add all current hypotheses (incomplete summaries)
-        # to results. Note: we still use complete_hyps=True in the next step since we want to
-        # check for valid grammar properties.
-        results = hyps
+    def _is_open(self, index):
+        """
+        Whether the length range with the given index still needs results.
+        """
+        return (
+            self.steps < self._length_ranges[index][1]
+            and len(self._results[index]) < 4 * self._beam_size
+        )
 
-    # Sort hypotheses by average log probability
-    hyps_sorted = sort_hyps(results, vocab.size, key_token_ids, complete_hyps=True)
 
-    # Return the hypothesis with highest average log prob
-    best_hyp = hyps_sorted[0]
-    score = best_hyp.score(vocab.size, key_token_ids, is_complete=True)
-    return best_hyp, score
+    def _update_stats(self):
+        if self._stats is not None:
+            self._stats['steps'] = self.steps
+            self._stats['rows'] = self._n_rows
+            self._stats['recombined'] = self._n_recombined
+            self._stats['wasted'] = self._n_wasted
 
 
 def sort_hyps(hyps, vocab_size, key_token_ids, complete_hyps):
@@ -299,6 +545,30 @@ def sort_hyps(hyps, vocab_size, key_token_ids, complete_hyps):
     )
 
 
+def _is_wasted(hyp, steps, min_dec_steps, vocab_size, key_token_ids):
+    """
+    Returns whether the candidate hypothesis can't be used: it is malformed, produced an unknown
+    token, or stopped before min_dec_steps.
+    """
+    if hyp.latest_token == key_token_ids['stop']:
+        if steps < min_dec_steps:
+            return True
+    elif hyp.latest_token < data.N_FREE_TOKENS:
+        return True
+    return hyp._is_early_malformed(vocab_size, key_token_ids['stop'], key_token_ids['comma'])
+
+
+def _recombination_key(token_strings, n_gram):
+    """
+    Returns the key used to merge hypotheses: the last n_gram token strings, or all token strings
+    if n_gram is 0. Token strings are used rather than ids so that copies of the same word through
+    different ids (e.g. a vocab id and an article OOV id) are merged.
+    """
+    if n_gram:
+        return tuple(token_strings[-n_gram:])
+    return tuple(token_strings)
+
+
 def _has_unknown_token(tokens, stop_token_id):
     """
     Returns whether any of the tokens generated are unknown (except possible a final STOP token).
@@ -0,0 +1,176 @@
+"""
+Pre-encoded training data. Making a batcher.Example from a tf.Example (parsing the words, mapping
+them to ids and computing the article OOVs and targets) is deterministic given the vocab and a few
+hyperparameters, so it can be done once for all epochs. compile_data writes the Examples of each
+data file as records (see data.example_generator) packed as:
+
+    header: 7 int32s, the encoder length, the number of article OOVs, the number of article id to
+        word id pairs, the decoder length, the number of people ids and the lengths of the original
+        article and abstract in bytes
+    int32 arrays: the encoder input ids, the encoder input ids with the article OOV ids, the
+        (article id, word id) pairs, the decoder input ids, the target ids, the target people mask,
+        the people ids and the lengths of the article OOVs in bytes
+    strings: the article OOVs, the original article and the original abstract
+
+Each compiled file has a sidecar index (see data.write_record_index), and is written in a
+directory keyed by the fingerprint of the vocab and hyperparameters, so the Batcher only reads
+compiled data matching its own.
+"""
+import hashlib
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+import data
+
+_HEADER = struct.Struct('<7i')
+_INT32 = np.dtype('<i4')
+
+# The hyperparameters used by batcher.Example.
+COMPILE_HPS_FIELDS = ('max_enc_steps', 'max_dec_steps', 'copy_only_entities', 'output_vocab_size')
+# Enough hyperparameters for compiling, when not training.
+CompileHps = namedtuple('CompileHps', COMPILE_HPS_FIELDS)
+
+# The attributes of a batcher.Example, see Example.from_compiled.
+CompiledExample = namedtuple('CompiledExample', (
+    'enc_len',
+    'enc_input',
+    'enc_input_extend_vocab',
+    'article_oovs',
+    'article_id_to_word_id',
+    'dec_input',
+    'target',
+    'target_people',
+    'people_ids',
+    'original_article',
+    'original_abstract',
+))
+
+
+def vocab_fingerprint(vocab, hps):
+    """
+    Returns a hex digest of the vocab words and the hyperparameters in COMPILE_HPS_FIELDS.
+    """
+    h = hashlib.md5()
+    for word_id in xrange(vocab.size):
+        h.update(vocab.id2word(word_id) + '\n')
+    h.update(repr([getattr(hps, field) for field in COMPILE_HPS_FIELDS]))
+    return h.hexdigest()
+
+
+def compiled_data_path(data_path, fingerprint):
+    """
+    Returns the path of the compiled data files of the data files matching data_path: the same
+    file names in the compiled_<fingerprint> subdirectory.
+    """
+    data_dir, pattern = os.path.split(data_path)
+    return os.path.join(data_dir, 'compiled_%s' % fingerprint, pattern)
+
+
+def pack_example(example):
+    """
+    Returns the batcher.Example, before padding, packed as a string.
+    """
+    article_id_to_word_id = sorted(example.article_id_to_word_id.items())
+    ints = np.concatenate([
+        np.array(example.enc_input, dtype=_INT32),
+        np.array(example.enc_input_extend_vocab, dtype=_INT32),
+        np.array(article_id_to_word_id, dtype=_INT32).reshape(-1),
+        np.array(example.dec_input, dtype=_INT32),
+        np.array(example.target, dtype=_INT32),
+        np.array(example.target_people, dtype=_INT32),
+        np.array(example.people_ids, dtype=_INT32),
+        np.array([len(oov) for oov in example.article_oovs], dtype=_INT32),
+    ]).astype(_INT32)
+    header = _HEADER.pack(
+        example.enc_len, len(example.article_oovs), len(article_id_to_word_id),
+        len(example.dec_input), len(example.people_ids), len(example.original_article),
+        len(example.original_abstract),
+    )
+    return (
+        header + ints.tobytes() + ''.join(example.article_oovs) + example.original_article +
+        example.original_abstract
+    )
+
+
+def unpack_example(packed):
+    """
+    Returns the CompiledExample packed in the string.
+    """
+    (
+        enc_len, n_oovs, n_pairs, dec_len, n_people, article_length, abstract_length,
+    ) = _HEADER.unpack_from(packed)
+    ints = np.frombuffer(
+        packed, _INT32, 2 * enc_len + 2 * n_pairs + 3 * dec_len + n_people + n_oovs, _HEADER.size
+    )
+    sections = np.cumsum([0, enc_len, enc_len, 2 * n_pairs, dec_len, dec_len, dec_len, n_people])
+    (
+        enc_input, enc_input_extend_vocab, pairs, dec_input, target, target_people, people_ids,
+        oov_lengths,
+    ) = np.split(ints, sections[1:])
+
+    offset = _HEADER.size + ints.nbytes
+    article_oovs = []
+    for oov_length in oov_lengths.tolist():
+        article_oovs.append(packed[offset: offset + oov_length])
+        offset += oov_length
+    original_article = packed[offset: offset + article_length]
+    offset += article_length
+    original_abstract = packed[offset: offset + abstract_length]
+
+    return CompiledExample(
+        enc_len=enc_len,
+        enc_input=enc_input.tolist(),
+        enc_input_extend_vocab=enc_input_extend_vocab.tolist(),
+        article_oovs=article_oovs,
+        article_id_to_word_id=dict(pairs.reshape(-1, 2).tolist()),
+        dec_input=dec_input.tolist(),
+        target=target.tolist(),
+        target_people=target_people.astype(np.float64).tolist(),
+        people_ids=people_ids.tolist(),
+        original_article=original_article,
+        original_abstract=original_abstract,
+    )
+
+
+def compile_data(data_path, vocab, hps):
+    """
+    Compiles the data files matching data_path for the vocab and hyperparameters, skipping files
+    already compiled. Returns the path of the compiled data files, see compiled_data_path.
+    """
+    # These imports are slow - lazy import.
+    from batcher import Example
+    from tensorflow.core.example import example_pb2
+
+    fingerprint = vocab_fingerprint(vocab, hps)
+    for data_file in sorted(data.data_files(data_path)):
+        compiled_file = compiled_data_path(data_file, fingerprint)
+        # the index is written last
+        if os.path.exists(compiled_file + data.INDEX_SUFFIX):
+            continue
+        if not os.path.exists(os.path.dirname(compiled_file)):
+            os.makedirs(os.path.dirname(compiled_file))
+
+        print 'Compiling %s' % data_file
+        offsets = []
+        with open(compiled_file, 'wb') as writer:
+            for example_str in data.read_records(data_file):
+                # same as Batcher.text_generator
+                features = example_pb2.Example.FromString(example_str).features.feature
+                try:
+                    article = features['article'].bytes_list.value[0]
+                    abstract = features['abstract'].bytes_list.value[0]
+                except ValueError:
+                    continue
+                if len(article) == 0:
+                    continue
+
+                packed = pack_example(Example(article, abstract, vocab, hps))
+                offsets.append(writer.tell())
+                writer.write(struct.pack('q', len(packed)))
+                writer.write(packed)
+        data.write_record_index(compiled_file, offsets)
+
+    return compiled_data_path(data_path, fingerprint)
@@ -0,0 +1,107 @@
+"""
+Hard constraints for beam search, applied as masks over the next token ids. These are the rules
+in beam_search.Hypothesis._is_early_malformed, but they rule out bad continuations before the top
+k candidates are taken, instead of penalizing the candidates afterwards. This way the beam is
+always filled with valid continuations.
+"""
+
+import numpy as np
+
+import data
+import language_check
+
+
+# Value added to the log probability of a masked token.
+MASKED_LOG_PROB = -10. ** 9
+
+
+class ConstraintMasker(object):
+    """
+    Builds masks over the extended vocabulary (vocab + article OOVs) for the hypotheses of a
+    single article.
+    """
+
+    def __init__(self, vocab, article_oovs, min_dec_steps):
+        """
+        ConstraintMasker constructor.
+
+        Args:
+            vocab: Vocabulary object
+            article_oovs: list of in-article OOV words (strings), in the order corresponding to
+                their temporary article OOV ids
+            min_dec_steps: Integer, the stop token is masked before this many steps
+        """
+        self._vocab = vocab
+        self._vocab_size = vocab.size
+        self._extended_vsize = vocab.size + len(article_oovs)
+        self._min_dec_steps = min_dec_steps
+        self._stop_id = vocab.word2id(data.STOP_DECODING, None)
+        self._comma_id = vocab.word2id(',', None)
+        self._period_id = vocab.word2id('.', None)
+        self._article_oov_ids = {w: vocab.size + i for i, w in enumerate(article_oovs)}
+
+        # Unknown tokens can never be generated. The stop token is handled per step.
+        self._base_mask = np.zeros([self._extended_vsize], dtype=np.float32)
+        self._base_mask[:data.N_FREE_TOKENS] = MASKED_LOG_PROB
+        self._base_mask[self._stop_id] = 0.
+
+
+    def mask(self, hyps, steps):
+        """
+        Returns a numpy array of shape [len(hyps), extended_vsize] with MASKED_LOG_PROB for each
+        token that would make the extended hypothesis malformed, and 0 elsewhere.
+
+        Args:
+            hyps: list of Hypothesis objects to be extended
+            steps: Integer, the number of decoder steps taken so far
+        """
+        masks = np.tile(self._base_mask, (len(hyps), 1))
+        if steps < self._min_dec_steps:
+            # stopping now would be discarded anyway
+            masks[:, self._stop_id] = MASKED_LOG_PROB
+
+        for i, hyp in enumerate(hyps):
+            masks[i, self.banned_ids(hyp.tokens, hyp.token_strings)] = MASKED_LOG_PROB
+
+        return masks
+
+
+    def banned_ids(self, tokens, token_strings):
+        """
+        Returns the list of token ids that would make the hypothesis with the given tokens and
+        token strings malformed if appended.
+        """
+        banned = []
+
+        # Repeated trigrams (see language_check.has_repeated_n_gram).
+        if len(tokens) >= 2:
+            last_bigram = tokens[-2], tokens[-1]
+            for i in xrange(len(tokens) - 2):
+                if (tokens[i], tokens[i + 1]) == last_bigram:
+                    banned.append(tokens[i + 2])
+
+        # Repeated entities, back to back or separated by a comma (see
+        # beam_search._has_repeated_entity).
+        if tokens[-1] >= self._vocab_size:
+            banned.extend(self._ids_for_string(token_strings[-1]))
+        if len(tokens) >= 2 and tokens[-2] >= self._vocab_size and tokens[-1] == self._comma_id:
+            banned.extend(self._ids_for_string(token_strings[-2]))
+
+        # Sentences ending on an article or preposition (see language_check.sent_end_on_bad_word).
+        if language_check.is_bad_sent_end_word(token_strings[-1]):
+            banned.append(self._period_id)
+
+        return banned
+
+
+    def _ids_for_string(self, token_string):
+        """
+        Returns the ids in the extended vocabulary that are output as the given string.
+        """
+        ids = []
+        vocab_id = self._vocab.word2id(token_string, None)
+        if vocab_id >= data.N_FREE_TOKENS:
+            ids.append(vocab_id)
+        if token_string in self._article_oov_ids:
+            ids.append(self._article_oov_ids[token_string])
+        return ids
@@ -3,17 +3,25 @@ This file contains code to read the train/eval/test data from file and process i
 vocab data from file and process it.
 """
 
+import bisect
 import csv
 import glob
+import mmap
+import os
 import random
-import re
 import string
 import struct
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 from tensorflow.core.example import example_pb2
 
 PEOPLE_ID_SIZE = 16
 
+# The length prefix of each record in the data files.
+_RECORD_LENGTH = struct.Struct('q')
+# Suffix of the sidecar index of a data file: the number of records, then the offset of each.
+INDEX_SUFFIX = '.index'
+
 # This is used to pad the encoder input, decoder input, and target sequence.
 PAD_TOKEN = '[PAD]'
 # This is used at the start of every decoder input sequence.
@@ -67,6 +75,11 @@ UNKNOWN_TOKEN = '[UNK]'
 
 UNKNOWN_TOKENS = ENTITY_TOKENS + POS_TOKENS + (UNKNOWN_TOKEN,)
 
+# Sets of the tokens above, for membership tests.
+_ENTITY_TOKENS_SET = frozenset(ENTITY_TOKENS)
+_POS_TOKENS_SET = frozenset(POS_TOKENS)
+_WORD_TYPES_SET = _ENTITY_TOKENS_SET | _POS_TOKENS_SET
+
 N_IMPORTANT_TOKENS = len(ENTITY_TOKENS) + 3
 N_FREE_TOKENS = len(UNKNOWN_TOKENS) + 3
 
@@ -76,6 +89,9 @@ class Vocab(object):
     Vocabulary class for mapping between words and ids (integers)
     """
 
+    # the most number of tokens in each generation of the parse_token memo
+    MAX_PARSED_TOKENS = 2 ** 16
+
     def __init__(self, vocab_file, max_size):
         """
         Creates a vocab of up to max_size words, reading from the vocab_file. If max_size is 0,
@@ -92,6 +108,9 @@ class Vocab(object):
         self._id_to_word = {}
         # keeps track of total number of words in the Vocab
         self._count = 0
+        # memo of parse_token, see there
+        self._parsed_tokens = {}
+        self._old_parsed_tokens = {}
 
         # [PAD], [START], [STOP], and the UNKNOWN_TOKENS get the ids 0, 1, 2, 3...
         for w in (PAD_TOKEN, START_DECODING, STOP_DECODING) + UNKNOWN_TOKENS:
@@ -149,15 +168,39 @@ class Vocab(object):
         ENTITY_TOKENS: overrides the word in all cases
         POS_TOKENS: used if word is out-of-vocab
         """
-        if word_type in ENTITY_TOKENS:
+        if word_type in _ENTITY_TOKENS_SET:
             return self._word_to_id[word_type]
-        if word in self._word_to_id:
-            return self._word_to_id[word]
-        if word_type in POS_TOKENS:
+        word_id = self._word_to_id.get(word)
+        if word_id is not None:
+            return word_id
+        if word_type in _POS_TOKENS_SET:
             return self._word_to_id[word_type]
         return self._word_to_id[UNKNOWN_TOKEN]
 
 
+    def parse_token(self, token):
+        """
+        Returns the (word, word_type, id) tuple of a token of the data files, the same as
+        parse_word and word2id.
+
+        Tokens are memoized, so repeated tokens are only parsed once. The memo keeps the tokens
+        of the current and the last generation of up to MAX_PARSED_TOKENS tokens, so the least
+        recently used tokens are dropped.
+        """
+        parsed = self._parsed_tokens.get(token)
+        if parsed is None:
+            parsed = self._old_parsed_tokens.get(token)
+            if parsed is None:
+                word, word_type = parse_word(token)
+                parsed = word, word_type, self.word2id(word, word_type)
+            if len(self._parsed_tokens) >= self.MAX_PARSED_TOKENS:
+                # new generation
+                self._old_parsed_tokens = self._parsed_tokens
+                self._parsed_tokens = {}
+            self._parsed_tokens[token] = parsed
+        return parsed
+
+
     def id2word(self, word_id):
         """
         Returns the word (string) corresponding to an id (integer).
@@ -213,27 +256,195 @@ def example_generator(data_path, single_pass):
     """
     while True:
         # get the list of datafiles
-        filelist = glob.glob(data_path)
+        filelist = data_files(data_path)
         assert filelist, ('Error: Empty filelist at %s' % data_path)
         if single_pass:
             filelist = sorted(filelist)
         else:
             random.shuffle(filelist)
         for f in filelist:
-            reader = open(f, 'rb')
-            while True:
-                len_bytes = reader.read(8)
-                if not len_bytes:
-                    # finished reading this file
-                    break
-                str_len = struct.unpack('q', len_bytes)[0]
-                example_str = struct.unpack('%ds' % str_len, reader.read(str_len))[0]
+            for example_str in read_records(f):
                 yield example_pb2.Example.FromString(example_str)
         if single_pass:
             print "example_generator completed reading all datafiles. No more data."
             break
 
 
+def read_records(data_file):
+    """
+    Generates the serialized records of a data file (see example_generator). The file is memory
+    mapped and the records are sliced from it, so there is a single copy of each record and no
+    read call per record. The file is closed when the generator finishes or is closed.
+    """
+    with open(data_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        offset = 0
+        while offset < size:
+            str_len = _RECORD_LENGTH.unpack_from(mapped, offset)[0]
+            offset += _RECORD_LENGTH.size
+            assert offset + str_len <= size, 'Error: truncated record in %s' % data_file
+            yield mapped[offset: offset + str_len]
+            offset += str_len
+    finally:
+        mapped.close()
+
+
+def data_files(data_path):
+    """
+    Returns the data files matching data_path, without their sidecar indices.
+    """
+    return [f for f in glob.glob(data_path) if not f.endswith(INDEX_SUFFIX)]
+
+
+def write_record_index(data_file, offsets=None):
+    """
+    Writes the sidecar index of the data file. The offsets of the records are found by reading
+    the file if not given.
+    """
+    if offsets is None:
+        offsets = _find_record_offsets(data_file)
+    with open(data_file + INDEX_SUFFIX, 'wb') as writer:
+        writer.write(struct.pack('q%dq' % len(offsets), len(offsets), *offsets))
+
+
+def read_record_index(data_file):
+    """
+    Returns the offsets of the records of the data file from its sidecar index, or by reading the
+    file if it has no index.
+    """
+    if not os.path.exists(data_file + INDEX_SUFFIX):
+        return _find_record_offsets(data_file)
+    with open(data_file + INDEX_SUFFIX, 'rb') as reader:
+        index = reader.read()
+    n_records = _RECORD_LENGTH.unpack_from(index)[0]
+    return struct.unpack_from('%dq' % n_records, index, _RECORD_LENGTH.size)
+
+
+def has_record_indices(data_path):
+    """
+    Returns whether all the data files matching data_path have a sidecar index.
+    """
+    filelist = data_files(data_path)
+    return bool(filelist) and all(os.path.exists(f + INDEX_SUFFIX) for f in filelist)
+
+
+def _find_record_offsets(data_file):
+    offsets = []
+    with open(data_file, 'rb') as reader:
+        while True:
+            len_bytes = reader.read(_RECORD_LENGTH.size)
+            if not len_bytes:
+                break
+            offsets.append(reader.tell() - _RECORD_LENGTH.size)
+            reader.seek(_RECORD_LENGTH.unpack(len_bytes)[0], os.SEEK_CUR)
+    return offsets
+
+
+class IndexedRecords(object):
+    """
+    Random access to the serialized records of the data files matching data_path, in sorted file
+    order, through their sidecar indices (see write_record_index). Records are read with seek()
+    and read(), keeping at most max_open_files files open (the least recently used is closed), so
+    a reader over thousands of chunks doesn't run out of file descriptors. Reading is thread-safe,
+    so one reader can be shared by the threads reading different shards.
+    """
+
+    def __init__(self, data_path, max_open_files=16):
+        self.filelist = sorted(data_files(data_path))
+        assert self.filelist, ('Error: Empty filelist at %s' % data_path)
+        self._offsets = [read_record_index(f) for f in self.filelist]
+        # index of the first record of each file
+        self._starts = [0]
+        for offsets in self._offsets:
+            self._starts.append(self._starts[-1] + len(offsets))
+        self._max_open_files = max_open_files
+        # open files by file index, least recently used first
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return self._starts[-1]
+
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        file_index = bisect.bisect_right(self._starts, i) - 1
+        offset = self._offsets[file_index][i - self._starts[file_index]]
+        with self._lock:
+            f = self._files.pop(file_index, None)
+            if f is None:
+                if len(self._files) >= self._max_open_files:
+                    self._files.popitem(last=False)[1].close()
+                f = open(self.filelist[file_index], 'rb')
+            self._files[file_index] = f
+
+            f.seek(offset)
+            str_len = _RECORD_LENGTH.unpack(f.read(_RECORD_LENGTH.size))[0]
+            return f.read(str_len)
+
+
+    def shard_indices(self, shard=0, n_shards=1, seed=None):
+        """
+        Returns the indices of the records of the shard. The shards of the same seed partition the
+        records. If seed is given, the records are in a random order over all files, the same for
+        every shard, otherwise in file order.
+        """
+        assert 0 <= shard < n_shards
+        indices = range(len(self))
+        if seed is not None:
+            random.Random(seed).shuffle(indices)
+        return indices[shard::n_shards]
+
+
+    def close(self):
+        with self._lock:
+            for f in self._files.itervalues():
+                f.close()
+            self._files = OrderedDict()
+
+
+def indexed_record_generator(records, single_pass, shard=0, n_shards=1, seed=0):
+    """
+    Generates the serialized records of the shard of indexed data files. Unlike
+    example_generator, records are shuffled over all files rather than by file, and readers with
+    the same seed and different shards read disjoint records.
+
+    Args:
+        records: IndexedRecords of the data files, which can be shared by the readers of all the
+            shards. It isn't closed by the generator.
+        single_pass: Boolean. If True, go through the shard exactly once in file order, then
+            return. Otherwise, go through the shard in a new random order each epoch,
+            indefinitely.
+        shard: Integer, the shard of this reader.
+        n_shards: Integer, the number of readers.
+        seed: Integer, the seed of the random order of the first epoch, shared by all readers.
+    """
+    epoch = 0
+    while True:
+        indices = records.shard_indices(shard, n_shards, seed=None if single_pass else seed + epoch)
+        for i in indices:
+            yield records[i]
+        if single_pass:
+            print "indexed_record_generator completed reading all datafiles. No more data."
+            break
+        epoch += 1
+
+
+def indexed_example_generator(records, single_pass, shard=0, n_shards=1, seed=0):
+    """
+    Generates tf.Examples from the shard of the indexed data files, see indexed_record_generator.
+    """
+    for example_str in indexed_record_generator(records, single_pass, shard, n_shards, seed):
+        yield example_pb2.Example.FromString(example_str)
+
+
 def article2ids(article_words, vocab, copy_only_entities):
     """
     Map the article words to their ids. Also return a list of OOVs in the article.
@@ -261,34 +472,36 @@ def article2ids(article_words, vocab, copy_only_entities):
     """
     ids = []
     oovs = []
-    unk_article_id_to_word_id_list = defaultdict(list) # for OOV ids
+    # oov_num of each OOV
+    oov_nums = {}
+    # for each OOV id, the count of each vocab word id it's labeled as
+    unk_article_id_to_word_id_counts = defaultdict(dict)
     unk_ids = set(vocab.word2id('', token) for token in UNKNOWN_TOKENS)
 
-    for index, (w, word_type) in enumerate(article_words):
+    for w, word_type in article_words:
         i = vocab.word2id(w, word_type)
         if i in unk_ids and (not copy_only_entities or 3 <= i < N_IMPORTANT_TOKENS):
-            if w not in oovs:
+            # oov_num is 0 for the first article OOV, 1 for the second article OOV...
+            oov_num = oov_nums.get(w)
+            if oov_num is None:
                 # Add to list of OOVs
+                oov_num = oov_nums[w] = len(oovs)
                 oovs.append(w)
-            # oov_num is 0 for the first article OOV, 1 for the second article OOV...
-            oov_num = oovs.index(w)
             # id is e.g. 50000 for the first article OOV, 50001 for the second...
             ids.append(vocab.size + oov_num)
-            unk_article_id_to_word_id_list[ids[-1]].append(i)
+            word_id_counts = unk_article_id_to_word_id_counts[ids[-1]]
+            word_id_counts[i] = word_id_counts.get(i, 0) + 1
         else:
             ids.append(i)
 
     unk_article_id_to_word_id = {}
-    # For every labeled OOV word, find the most common vocab word id.
-    for article_id, word_ids in unk_article_id_to_word_id_list.iteritems():
-        word_id_counts = defaultdict(int)
-        # compute word_id count for each occurrence of article_id.
-        for word_id in word_ids:
-            word_id_counts[word_id] += 1
-        # take most commonly labeled vocab word.
-        sorted_words = sorted(word_id_counts.items(), key=lambda pair: pair[1], reverse=True)
-        top_word_id = sorted_words[0][0]
-        unk_article_id_to_word_id[article_id] = top_word_id
+    # For every labeled OOV word, take the most commonly labeled vocab word id. Ties go to the
+    # first in the counts dict's iteration order, which for int keys depends on the ids and the
+    # order they were inserted in, not on the order of occurrence alone.
+    for article_id, word_id_counts in unk_article_id_to_word_id_counts.iteritems():
+        unk_article_id_to_word_id[article_id] = max(
+            word_id_counts.iteritems(), key=lambda pair: pair[1]
+        )[0]
 
     return ids, oovs, unk_article_id_to_word_id
 
@@ -317,16 +530,18 @@ def abstract2ids(abstract_words, vocab, article_oovs, copyable_words, output_voc
     """
     ids = []
     unk_ids = set(vocab.word2id('', token) for token in UNKNOWN_TOKENS)
+    # index of each in-article OOV
+    article_oov_ids = {}
+    for oov_num, w in enumerate(article_oovs):
+        article_oov_ids.setdefault(w, vocab.size + oov_num)
 
     for w, word_type in abstract_words:
         # index ignoring entity / POS tags
         i_orig = vocab.word2id(w, None)
         # index including entity / POS tags
-        i_real = vocab.word2id(w, word_type)
+        i_real = i_orig if word_type is None else vocab.word2id(w, word_type)
         # index if word is in article oov or entity
-        i_article_oov = vocab.size + article_oovs.index(w) if w in article_oovs else 0
-        # index for part of speech
-        i_pos = vocab.word2id('', word_type)
+        i_article_oov = article_oov_ids.get(w, 0)
         is_copyable = w in copyable_words
 
         if i_orig < output_vocab_size:
@@ -345,7 +560,7 @@ def abstract2ids(abstract_words, vocab, article_oovs, copyable_words, output_voc
                 ids.append(i_orig)
             else:
                 # can't be generated or copied, use POS
-                ids.append(i_pos)
+                ids.append(vocab.word2id('', word_type))
         else:
             # out-of-vocab
             if is_copyable:
@@ -353,7 +568,7 @@ def abstract2ids(abstract_words, vocab, article_oovs, copyable_words, output_voc
                 ids.append(i_article_oov)
             else:
                 # can't be generated or copied, use POS
-                ids.append(i_pos)
+                ids.append(vocab.word2id('', word_type))
 
     return ids
 
@@ -388,11 +603,8 @@ def show_art_oovs(article, vocab):
     Returns the article string, highlighting the OOVs by placing __underscores__ around them.
     """
     unk_ids = set(vocab.word2id('', token) for token in UNKNOWN_TOKENS)
-    words = [parse_word(word) for word in article.split(' ')]
-    words = [
-        ("__%s__" % w) if vocab.word2id(w, word_type) in unk_ids else w
-        for w, word_type in words
-    ]
+    words = [vocab.parse_token(word) for word in article.split(' ')]
+    words = [("__%s__" % w) if word_id in unk_ids else w for w, _, word_id in words]
 
     out_str = ' '.join(words)
     return out_str
@@ -409,11 +621,11 @@ def show_abs_oovs(abstract, vocab, article_oovs):
         article_oovs: list of words (strings)
     """
     unk_ids = set(vocab.word2id('', token) for token in UNKNOWN_TOKENS)
-    words = [parse_word(word) for word in abstract.split(' ')]
+    words = [vocab.parse_token(word) for word in abstract.split(' ')]
     new_words = []
 
-    for w, word_type in words:
-        if vocab.word2id(w, word_type) in unk_ids:
+    for w, _, word_id in words:
+        if word_id in unk_ids:
             # w is oov
             if w in article_oovs:
                 # word appeared in article
@@ -442,27 +654,28 @@ def parse_word(word):
     - "word[entity_or_POS]" -> word, entity_or_POS
     - "word" -> word, None
     """
-    def find_match(pattern):
-        match = re.search(pattern, word)
-        if match:
-            return word[:match.start()], word[match.start(): match.end()]
-        return word, ''
-
-    real_word, person_id = find_match(r'(\{.*\})')
-    if person_id:
-        # has person id tag
-        person_id = int(person_id[1: -1])
-        if person_id < PEOPLE_ID_SIZE:
-            return real_word, PERSON_TOKENS[person_id]
-        else:
-            # person id is too large, return generic person token
-            return real_word, PERSON_TOKENS[-1]
-
-    real_word, word_type = find_match(r'(\[.*\])')
-    if word_type:
-        if word_type in ENTITY_TOKENS + POS_TOKENS:
-            return real_word, word_type
-        else:
-            return real_word, None
+    # same as matching the regexes r'(\{.*\})' and r'(\[.*\])', from the first opening bracket
+    # to the last closing bracket
+    start = word.find('{')
+    if start != -1:
+        end = word.rfind('}')
+        if end > start:
+            # has person id tag
+            person_id = int(word[start + 1: end])
+            if person_id < PEOPLE_ID_SIZE:
+                return word[:start], PERSON_TOKENS[person_id]
+            else:
+                # person id is too large, return generic person token
+                return word[:start], PERSON_TOKENS[-1]
+
+    start = word.find('[')
+    if start != -1:
+        end = word.rfind(']')
+        if end > start:
+            word_type = word[start: end + 1]
+            if word_type in _WORD_TYPES_SET:
+                return word[:start], word_type
+            else:
+                return word[:start], None
 
     return word, None
@@ -73,8 +73,19 @@ class BeamSearchDecoder(object):
         """
         counter = 0
         scores = []
+        t_ckpt = time.time()
 
         while True:
+            if not FLAGS.single_pass and time.time() - t_ckpt > SECS_UNTIL_NEW_CKPT:
+                # Load the latest checkpoint between examples, so that each example is decoded
+                # with a single checkpoint.
+                tf.logging.info(
+                    "Decoded with the same checkpoint for %i seconds, loading latest checkpoint",
+                    time.time() - t_ckpt,
+                )
+                util.load_ckpt(self._saver, self._sess)
+                t_ckpt = time.time()
+
             batch = self._batcher.next_batch()  # 1 example repeated across batch
             if batch is None: # finished decoding dataset in single_pass mode
                 assert FLAGS.single_pass, "Dataset exhausted, but we are not in single_pass mode"
@@ -3,7 +3,12 @@ Seq-to-seq based summarization method. Model is based off of
 https://github.com/abisee/pointer-generator and is trained on 300K news articles from
 CNN / Dailymail and 100K new cables.
 """
+import json
 import os
+import socket
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 from spacy.tokens.doc import Doc
 
 
@@ -11,32 +16,114 @@ _model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_par
 _vocab_path = os.path.join(_model_dir, 'vocab')
 _vocab_size = 20000
 _beam_size = 4
+# Directory of per-host serving settings, written by tune_threads.py
+_host_config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'host_configs')
 
-_settings = None
-_hps = None
-_vocab = None
-_sess = None
-_model = None
+DecodeMode = namedtuple('DecodeMode', (
+    # number of hypotheses kept at each step
+    'beam_size',
+    # number of candidates each hypothesis is extended with at each step
+    'expansion_size',
+    # whether constraints are applied as masks by default
+    'mask_constraints',
+))
 
+# 'beam' is the full search. 'narrow' and 'greedy' are much cheaper and meant for bulk jobs that
+# can accept lower quality; their scores are on the same scale, so low scoring summaries can be
+# regenerated with 'beam'. The narrow modes mask out invalid tokens by default since they have
+# few hypotheses to fall back on.
+DECODE_MODES = {
+    'beam': DecodeMode(
+        beam_size=_beam_size, expansion_size=2 * _beam_size, mask_constraints=False
+    ),
+    'narrow': DecodeMode(beam_size=2, expansion_size=4, mask_constraints=True),
+    'greedy': DecodeMode(beam_size=1, expansion_size=2, mask_constraints=True),
+}
 
-def _load_model():
+# Everything needed to run the model, swapped as a whole when a new checkpoint is loaded (see
+# CheckpointWatcher). Requests keep using the LoadedModel they started with, whose session is
+# closed once the last of them finishes (see _using_model).
+LoadedModel = namedtuple('LoadedModel', (
+    'settings', 'hps', 'vocab', 'sess', 'model',
+    # path of the checkpoint restored, or None if loaded from a weight bundle
+    'checkpoint_path',
+    # directory of the weight bundle loaded, or None if restored from a checkpoint
+    'weight_bundle_dir',
+))
+
+_loaded_model = None
+# (intra_op_parallelism_threads, inter_op_parallelism_threads) of the sessions, 0 meaning the
+# tensorflow default
+_session_threads = (0, 0)
+# Guards swapping _loaded_model and counting the requests using each LoadedModel.
+_model_lock = threading.Lock()
+# Held while loading a model to swap in, so concurrent loads don't load the same checkpoint twice.
+_load_lock = threading.Lock()
+# number of running requests using each LoadedModel, by session
+_model_users = {}
+
+
+def host_config_path():
+    return os.path.join(_host_config_dir, '%s.json' % socket.gethostname())
+
+
+def load_host_config():
+    """
+    Returns the serving settings tuned for this host by tune_threads.py: a dictionary with
+    'intra_op_threads', 'inter_op_threads' and 'n_workers', or an empty dictionary if the host
+    wasn't tuned.
+    """
+    path = host_config_path()
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _load_model(weight_bundle_dir=None, session_threads=None):
+    """
+    Builds the model and restores its parameters, from the latest checkpoint in model_parameters/
+    or from the given weight bundle (see weight_bundle.py).
+
+    Args:
+        weight_bundle_dir: optional string, directory of the weight bundle.
+        session_threads: optional (intra_op_parallelism_threads, inter_op_parallelism_threads)
+            tuple for the session. Defaults to the host config, if any.
+    """
+    global _session_threads
+    if session_threads is None:
+        host_config = load_host_config()
+        session_threads = (
+            host_config.get('intra_op_threads', 0), host_config.get('inter_op_threads', 0)
+        )
+    _session_threads = session_threads
+
+    if weight_bundle_dir:
+        _swap_model(_build_model(weight_bundle_dir=weight_bundle_dir))
+    else:
+        _swap_model(_build_model(checkpoint_path=_latest_checkpoint_path()))
+
+
+def _latest_checkpoint_path():
     # These imports are slow - lazy import.
     import tensorflow as tf
-    from data import Vocab
-    from model import Hps, Settings, SummarizationModel
 
-    global _settings, _hps, _vocab, _sess, _model
+    ckpt_state = tf.train.get_checkpoint_state(_model_dir)
+    return ckpt_state.model_checkpoint_path
 
-    # Define settings and hyperparameters
-    _settings = Settings(
-        embeddings_path='',
-        log_root='',
-        trace_path='',# traces/traces_blog',
-    )
-    _hps = Hps(
+
+def _decode_hps():
+    """
+    Returns the hyperparameters of the model for decoding.
+    """
+    # This import is slow - lazy import.
+    from model import Hps
+
+    return Hps(
         # parameters important for decoding
         attn_only_entities=False,
         batch_size=_beam_size,
+        beam_size=_beam_size,
         copy_only_entities=False,
         emb_dim=128,
         enc_hidden_dim=200,
@@ -64,63 +151,446 @@ def _load_model():
         trunc_norm_init_std=1e-4,
     )
 
+
+def _build_model(checkpoint_path=None, weight_bundle_dir=None):
+    """
+    Returns a LoadedModel with its own graph and session, restored from the checkpoint or the
+    weight bundle.
+    """
+    # These imports are slow - lazy import.
+    import tensorflow as tf
+    from data import Vocab
+    from model import Settings, SummarizationModel
+
+    # Define settings and hyperparameters
+    settings = Settings(
+        embeddings_path='',
+        log_root='',
+        trace_path='',# traces/traces_blog',
+    )
+    hps = _decode_hps()
+
     # Define model
-    _vocab = Vocab(_vocab_path, _vocab_size)
-    _model = SummarizationModel(_settings, _hps, _vocab)
-    _model.build_graph()
+    vocab = Vocab(_vocab_path, _vocab_size)
+    graph = tf.Graph()
+    with graph.as_default():
+        model = SummarizationModel(settings, hps, vocab)
+        model.build_graph()
 
     # Load model from disk
-    saver = tf.train.Saver()
     config = tf.ConfigProto(
         allow_soft_placement=True,
-        #intra_op_parallelism_threads=1,
-        #inter_op_parallelism_threads=1,
+        intra_op_parallelism_threads=_session_threads[0],
+        inter_op_parallelism_threads=_session_threads[1],
     )
-    _sess = tf.Session(config=config)
-    ckpt_state = tf.train.get_checkpoint_state(_model_dir)
-    saver.restore(_sess, ckpt_state.model_checkpoint_path)
+    if weight_bundle_dir:
+        # The bundle's frozen graph, mapping the weights from the bundle, replaces the model's.
+        from weight_bundle import configure_session, import_weight_bundle
+        graph = import_weight_bundle(model, weight_bundle_dir)
+        configure_session(config)
+    sess = tf.Session(graph=graph, config=config)
+    if not weight_bundle_dir:
+        with graph.as_default():
+            saver = tf.train.Saver()
+        saver.restore(sess, checkpoint_path)
+
+    return LoadedModel(settings, hps, vocab, sess, model, checkpoint_path, weight_bundle_dir)
+
+
+def _swap_model(loaded_model):
+    """
+    Makes loaded_model the model used by the following requests. The session of the replaced
+    model is closed right away if no request is using it, otherwise by the last one to finish.
+    """
+    global _loaded_model
+    with _model_lock:
+        old_model, _loaded_model = _loaded_model, loaded_model
+        if (
+            old_model is not None and old_model.sess is not loaded_model.sess
+            and old_model.sess not in _model_users
+        ):
+            old_model.sess.close()
+
+
+@contextmanager
+def _using_model():
+    """
+    Context manager giving the current LoadedModel, loading it first if needed. The model's
+    session isn't closed before the context exits, even if a new model is swapped in meanwhile.
+    """
+    if _loaded_model is None:
+        with _load_lock:
+            if _loaded_model is None:
+                _load_model()
+    with _model_lock:
+        loaded_model = _loaded_model
+        _model_users[loaded_model.sess] = _model_users.get(loaded_model.sess, 0) + 1
+
+    try:
+        yield loaded_model
+    finally:
+        with _model_lock:
+            _model_users[loaded_model.sess] -= 1
+            if not _model_users[loaded_model.sess]:
+                del _model_users[loaded_model.sess]
+                # the last request using a model that was swapped out
+                if loaded_model.sess is not _loaded_model.sess:
+                    loaded_model.sess.close()
+
+
+class CheckpointWatcher(object):
+    """
+    Watches model_parameters/ for a new checkpoint (i.e. the 'checkpoint' file pointing to a new
+    path), and restores it into a new model in the background. Once ready, the new model is
+    swapped in for the following requests, while requests already running finish with the old one,
+    whose session is closed once they're done. A model loaded from a weight bundle is never
+    replaced, since the bundle isn't a checkpoint.
+    """
+
+    def __init__(self, interval_secs=60):
+        """
+        CheckpointWatcher constructor. Starts the watcher thread.
+
+        Args:
+            interval_secs: Number of seconds between checks for a new checkpoint.
+        """
+        self.interval_secs = interval_secs
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
 
 
-def generate_summary(spacy_article, ideal_summary_length_tokens=60):
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+    def check(self):
+        """
+        Loads the latest checkpoint if it is new. Returns whether a new model was swapped in.
+        """
+        # under the lock, so that concurrent checks don't both load the same checkpoint
+        with _load_lock:
+            if _loaded_model is None:
+                # load it the same way as for a request, with the host's session settings
+                _load_model()
+                return True
+            if _loaded_model.weight_bundle_dir:
+                return False
+            checkpoint_path = _latest_checkpoint_path()
+            if checkpoint_path == _loaded_model.checkpoint_path:
+                return False
+            _swap_model(_build_model(checkpoint_path=checkpoint_path))
+            return True
+
+
+    def _run(self):
+        # This import is slow - lazy import.
+        import tensorflow as tf
+
+        while not self._stopped.wait(self.interval_secs):
+            try:
+                self.check()
+            except Exception as e:
+                # e.g. the checkpoint is still being written; try again next time
+                tf.logging.warning('Failed to load new checkpoint: %s', e)
+
+
+def generate_summary(
+    spacy_article, ideal_summary_length_tokens=60, decode_mode='beam', recombination_n_gram=None,
+    mask_constraints=None, adaptive_beam=None, search_stats=None,
+):
     """
     Generates summary of the given article. Note that this is slow (~20 seconds on a single CPU).
     
     Args:
         spacy_article: Spacy-processed text. The model was trained on the output of
         doc.spacy_text(), so for best results the input here should also come from doc.spacy_text().
+            Can also be an io_processing.AnnotatedArticle, e.g. from io_processing.annotate_article,
+            to skip the people resolver.
+        ideal_summary_length_tokens: Integer, target length of the summary.
+        decode_mode: One of DECODE_MODES; 'beam' (default), 'narrow' or 'greedy'.
+        recombination_n_gram: Integer or None. If set, merge beam search hypotheses that end in
+            the same n tokens (see beam_search.BeamSearch).
+        mask_constraints: Boolean. If True, mask out tokens that would break the beam search
+            constraints before choosing candidates (see constraints.py). Defaults to the setting
+            of the decode mode.
+        adaptive_beam: beam_search.AdaptiveBeam or None. If provided, varies the number of
+            hypotheses kept at each step, up to the beam size of the decode mode.
+        search_stats: optional dictionary, filled with statistics of the beam search.
     
     Returns:
         Tuple of unicode summary of the text and scalar score of its quality. Score is approximately
         an average log-likelihood of the summary (so it is < 0.) and typically is in the range
         [-.2, -.5]. Summaries with scores below -.4 are usually not very good.
     """
-    assert isinstance(spacy_article, Doc)
+    return generate_summaries(
+        spacy_article, [ideal_summary_length_tokens], decode_mode=decode_mode,
+        recombination_n_gram=recombination_n_gram, mask_constraints=mask_constraints,
+        adaptive_beam=adaptive_beam, search_stats=search_stats,
+    )[0]
+
 
+def generate_summaries(
+    spacy_article, ideal_summary_lengths_tokens=(30, 60, 90), decode_mode='beam',
+    recombination_n_gram=None, mask_constraints=None, adaptive_beam=None, search_stats=None,
+):
+    """
+    Generates summaries of several lengths of the given article. The article is encoded once and a
+    single beam search collects results for all lengths, so this is much cheaper than calling
+    generate_summary for each length.
+
+    Args:
+        spacy_article: Spacy-processed text, see generate_summary.
+        ideal_summary_lengths_tokens: list of integers, target lengths of the summaries.
+        decode_mode, recombination_n_gram, mask_constraints, adaptive_beam, search_stats: see
+            generate_summary.
+
+    Returns:
+        List of (summary, score) tuples as returned by generate_summary, one per target length.
+    """
+    return [
+        n_best[0] for n_best in _generate(
+            spacy_article, ideal_summary_lengths_tokens, 1, decode_mode, recombination_n_gram,
+            mask_constraints, adaptive_beam, search_stats,
+        )
+    ]
+
+
+def generate_n_best_summaries(
+    spacy_article, n_best=4, ideal_summary_length_tokens=60, decode_mode='beam',
+    recombination_n_gram=None, mask_constraints=None, adaptive_beam=None, search_stats=None,
+):
+    """
+    Generates the best n_best distinct summaries of the given article. The alternatives come from
+    the results already collected by the beam search, so they cost no extra model time.
+
+    Args:
+        spacy_article: Spacy-processed text, see generate_summary.
+        n_best: Integer, the most number of summaries to return. The beam search collects at most
+            4 * beam_size results, so fewer may be returned.
+        ideal_summary_length_tokens, decode_mode, recombination_n_gram, mask_constraints,
+            adaptive_beam, search_stats: see generate_summary.
+
+    Returns:
+        List of (summary, score) tuples as returned by generate_summary, best first.
+    """
+    return _generate(
+        spacy_article, [ideal_summary_length_tokens], n_best, decode_mode, recombination_n_gram,
+        mask_constraints, adaptive_beam, search_stats,
+    )[0]
+
+
+def stream_summary(
+    spacy_article, ideal_summary_length_tokens=60, decode_mode='beam', recombination_n_gram=None,
+    mask_constraints=None, adaptive_beam=None, search_stats=None, partial_summaries=True,
+):
+    """
+    Generates summary of the given article, yielding the current best partial summary after each
+    decoder step so that text can be shown before the search finishes. The partial summaries end
+    with an ellipsis. Closing the generator early stops the search.
+
+    Args:
+        partial_summaries: Boolean. If False, None is yielded after each decoder step instead of
+            the partial summary, skipping its output processing. Useful for running the search
+            one step at a time when only the final result is needed.
+        Others: see generate_summary.
+
+    Yields:
+        (summary, score) tuples. Scores of partial summaries are those of incomplete hypotheses.
+        The last tuple yielded is the final result, the same as returned by generate_summary.
+    """
     # These imports are slow - lazy import.
-    from batcher import Batch, Example
-    from beam_search import run_beam_search
-    from io_processing import process_article, process_output
+    from beam_search import write_traces
+    from io_processing import process_outputs
 
-    if _model is None:
-        _load_model()
+    with _using_model() as loaded_model:
+        search, _, word_capitalizations = _start_search(
+            loaded_model, spacy_article, [ideal_summary_length_tokens], decode_mode,
+            recombination_n_gram, mask_constraints, adaptive_beam, search_stats,
+        )
+        if search is None:
+            yield spacy_article.text, 0.
+            return
 
-    # Handle short inputs
-    article_tokens, _, orig_article_tokens = process_article(spacy_article)
-    if len(article_tokens) <= ideal_summary_length_tokens:
-        return spacy_article.text, 0.
+        while not search.done:
+            search.step()
+            if not partial_summaries:
+                yield None
+            elif search.hyps:
+                # live hypotheses are kept in order of their scores
+                hyp = search.hyps[0]
+                summary = process_outputs([hyp.token_strings[1:]], word_capitalizations)[0]
+                yield summary, hyp.score(
+                    loaded_model.vocab.size, search.key_token_ids, is_complete=False
+                )
 
-    min_summary_length = min(10 + len(article_tokens) / 10, 2 * ideal_summary_length_tokens / 3)
-    max_summary_length = min(10 + len(article_tokens) / 5, 3 * ideal_summary_length_tokens / 2)
+        write_traces(loaded_model.model, loaded_model.settings.trace_path)
+        hyp, score = search.best(0)
+    summary = process_outputs([hyp.token_strings[1:]], word_capitalizations)[0]
+    yield summary, score
 
-    # Make input data
-    example = Example(' '.join(article_tokens), abstract='', vocab=_vocab, hps=_hps)
-    batch = Batch([example] * _beam_size, _hps, _vocab)
 
-    # Generate output
-    hyp, score = run_beam_search(
-        _sess, _model, _vocab, batch, _beam_size, max_summary_length, min_summary_length,
-        _settings.trace_path,
+def decode_article_tokens(
+    article_tokens, ideal_summary_length_tokens=60, decode_mode='beam', recombination_n_gram=None,
+    mask_constraints=None, adaptive_beam=None, search_stats=None,
+):
+    """
+    Runs the beam search on an already processed article, without the input and output
+    processing, so that these can be done elsewhere (see pipeline.py).
+
+    Args:
+        article_tokens: list of the processed article tokens, the first output of
+            io_processing.process_article, or a packed_article.PackedArticle of them.
+        ideal_summary_length_tokens, decode_mode, recombination_n_gram, mask_constraints,
+            adaptive_beam, search_stats: see generate_summary.
+
+    Returns:
+        Tuple of the summary token strings, to be passed to io_processing.process_output, and the
+        score. None if the article is short, in which case the summary is the article itself.
+    """
+    # These imports are slow - lazy import.
+    from beam_search import write_traces
+
+    with _using_model() as loaded_model:
+        search, _ = _start_search_from_tokens(
+            loaded_model, article_tokens, [ideal_summary_length_tokens], decode_mode,
+            recombination_n_gram, mask_constraints, adaptive_beam, search_stats,
+        )
+        if search is None:
+            return None
+
+        search.run()
+        write_traces(loaded_model.model, loaded_model.settings.trace_path)
+        hyp, score = search.best(0)
+    return hyp.token_strings[1:], score
+
+
+def _generate(
+    spacy_article, ideal_summary_lengths_tokens, n_best, decode_mode, recombination_n_gram,
+    mask_constraints, adaptive_beam, search_stats,
+):
+    """
+    Runs a single beam search for the target lengths and returns, for each length, a list of up to
+    n_best distinct (summary, score) tuples.
+    """
+    assert n_best >= 1
+
+    # These imports are slow - lazy import.
+    from beam_search import write_traces
+    from io_processing import process_outputs
+
+    with _using_model() as loaded_model:
+        search, search_lengths, word_capitalizations = _start_search(
+            loaded_model, spacy_article, ideal_summary_lengths_tokens, decode_mode,
+            recombination_n_gram, mask_constraints, adaptive_beam, search_stats,
+        )
+
+        # Handle short inputs
+        outputs = [[(spacy_article.text, 0.)] for _ in ideal_summary_lengths_tokens]
+        if search is None:
+            return outputs
+
+        # Generate output
+        search.run()
+        write_traces(loaded_model.model, loaded_model.settings.trace_path)
+
+    for range_index, i in enumerate(search_lengths):
+        if n_best == 1:
+            hyp, score = search.best(range_index)
+            hyps, scores = [hyp], [score]
+        else:
+            hyps_and_scores = search.n_best(range_index)
+            hyps = [hyp for hyp, _ in hyps_and_scores]
+            scores = [score for _, score in hyps_and_scores]
+        # Extract the output ids from the hypotheses and convert back to words
+        summaries = process_outputs([hyp.token_strings[1:] for hyp in hyps], word_capitalizations)
+        # Different hypotheses can still give the same summary, e.g. after fixing capitalization
+        outputs[i] = []
+        for summary, score in zip(summaries, scores):
+            if len(outputs[i]) == n_best:
+                break
+            if summary not in (output[0] for output in outputs[i]):
+                outputs[i].append((summary, score))
+
+    return outputs
+
+
+def _start_search(
+    loaded_model, spacy_article, ideal_summary_lengths_tokens, decode_mode, recombination_n_gram,
+    mask_constraints, adaptive_beam, search_stats,
+):
+    """
+    Processes the article and sets up a beam search with the LoadedModel for the target lengths,
+    which runs the encoder. Target lengths that are at least the length of the article are not
+    searched for.
+
+    Returns:
+        search: beam_search.BeamSearch, or None if no target length needs a search.
+        search_lengths: list of indices of the target lengths searched for, in the order of the
+            length ranges of the search.
+        word_capitalizations: capitalizations of the original article strings, see
+            io_processing.process_article.
+    """
+    # These imports are slow - lazy import.
+    from io_processing import AnnotatedArticle, process_article
+
+    assert isinstance(spacy_article, (Doc, AnnotatedArticle))
+
+    article_tokens, _, _, word_capitalizations = process_article(spacy_article)
+    search, search_lengths = _start_search_from_tokens(
+        loaded_model, article_tokens, ideal_summary_lengths_tokens, decode_mode,
+        recombination_n_gram, mask_constraints, adaptive_beam, search_stats,
     )
+    return search, search_lengths, word_capitalizations
+
+
+def _start_search_from_tokens(
+    loaded_model, article_tokens, ideal_summary_lengths_tokens, decode_mode, recombination_n_gram,
+    mask_constraints, adaptive_beam, search_stats,
+):
+    """
+    Sets up a beam search on the processed article tokens, see _start_search.
+    """
+    assert decode_mode in DECODE_MODES
+    mode = DECODE_MODES[decode_mode]
+    if mask_constraints is None:
+        mask_constraints = mode.mask_constraints
 
-    # Extract the output ids from the hypothesis and convert back to words
-    return process_output(hyp.token_strings[1:], orig_article_tokens), score
+    # These imports are slow - lazy import.
+    from batcher import Batch, Example
+    from beam_search import BeamSearch
+    from packed_article import PackedArticle
+
+    search_lengths = [
+        i for i, length in enumerate(ideal_summary_lengths_tokens) if len(article_tokens) > length
+    ]
+    if not search_lengths:
+        return None, search_lengths
+
+    length_ranges = []
+    for i in search_lengths:
+        ideal_summary_length_tokens = ideal_summary_lengths_tokens[i]
+        min_summary_length = min(
+            10 + len(article_tokens) / 10, 2 * ideal_summary_length_tokens / 3
+        )
+        max_summary_length = min(
+            10 + len(article_tokens) / 5, 3 * ideal_summary_length_tokens / 2
+        )
+        length_ranges.append((min_summary_length, max_summary_length))
+
+    # Make input data
+    vocab, hps = loaded_model.vocab, loaded_model.hps
+    if isinstance(article_tokens, PackedArticle):
+        example = Example.from_packed_article(article_tokens, vocab, hps)
+    else:
+        example = Example(' '.join(article_tokens), abstract='', vocab=vocab, hps=hps)
+    batch = Batch([example] * _beam_size, hps, vocab)
+
+    search = BeamSearch(
+        loaded_model.sess, loaded_model.model, vocab, batch, mode.beam_size, length_ranges,
+        expansion_size=mode.expansion_size, recombination_n_gram=recombination_n_gram,
+        mask_constraints=mask_constraints, adaptive_beam=adaptive_beam, stats=search_stats,
+    )
+    return search, search_lengths
@@ -2,9 +2,10 @@
 Processes input for training samples and generating summaries, and processes output for
 generating summaries.
 """
+import bisect
 import string
 import unicodedata
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 import data
 from nltk.tokenize.moses import MosesDetokenizer
@@ -15,10 +16,32 @@ assert all(token[0] == '[' and token[-1] == ']' for token in data.ENTITY_TOKENS
 ENTITY_TAGS = tuple(token[1: -1] for token in data.ENTITY_TOKENS)
 POS_TAGS = tuple(token[1: -1] for token in data.POS_TOKENS)
 
+# An article already tokenized and tagged, with its people already resolved: span_to_person_id
+# maps the (start, end) character offsets of each person mention to the person id, 0 being the
+# most mentioned person (see _resolve_people).
+AnnotatedArticle = namedtuple('AnnotatedArticle', ('text', 'tokens', 'span_to_person_id'))
+# A token of an AnnotatedArticle, with the attributes of spacy tokens used by process_article.
+AnnotatedToken = namedtuple('AnnotatedToken', ('text', 'idx', 'ent_type_', 'pos_'))
 
-def process_article(spacy_article, print_edge_cases=False):
+
+def annotate_article(spacy_article, span_to_person_id=None):
+    """
+    Returns the AnnotatedArticle of spacy_article, resolving its people unless span_to_person_id is
+    given. The result can be cached and processed several times without the people resolver.
+    """
+    if span_to_person_id is None:
+        span_to_person_id = _resolve_people(spacy_article)
+    tokens = [
+        AnnotatedToken(token.text, token.idx, token.ent_type_, token.pos_)
+        for token in spacy_article
+    ]
+    return AnnotatedArticle(spacy_article.text, tokens, span_to_person_id)
+
+
+def process_article(article, print_edge_cases=False):
     """
-    Tags the tokens from spacy_article with the first of the following:
+    Tags the tokens from article (spacy-processed, or an AnnotatedArticle to skip the people
+    resolver) with the first of the following:
     
     {PERSON_X}:
         If the token is part of the Xth most important person, where people identities are
@@ -28,10 +51,16 @@ def process_article(spacy_article, print_edge_cases=False):
     [part_of_speech]:
         Part of speech as determined by spacy.
     
-    Return both the newly tagged tokens as well as the text of the original tokens.
+    Return the newly tagged tokens, their character offsets in the article, the text of the
+    original tokens and the capitalizations of the original tokens (see get_word_capitalizations),
+    computed once here so that every summary of the article can be processed with them.
     """
     # compute people mentions
-    span_to_person_id = _resolve_people(spacy_article)
+    if isinstance(article, AnnotatedArticle):
+        tokens, span_to_person_id = article.tokens, article.span_to_person_id
+    else:
+        tokens, span_to_person_id = article, _resolve_people(article)
+    person_spans = _PersonSpans(article.text, span_to_person_id)
     # keep original tokens to help with capitalization later
     case_sensitive_article_tokens = []
     # actual tokens to use for training / generating
@@ -39,7 +68,7 @@ def process_article(spacy_article, print_edge_cases=False):
     # used only for processing training data
     article_token_indices = []
 
-    for token in spacy_article:
+    for token in tokens:
         # simple token edits
         orig_token_text = token.text.strip()
         orig_token_text = orig_token_text.replace('[', '(').replace(']', ')')
@@ -51,9 +80,7 @@ def process_article(spacy_article, print_edge_cases=False):
         token_text = orig_token_text.lower()
 
         # get person id if it was labeled as a person by the people resolver
-        person_id = _find_person_span_and_update(
-            spacy_article.text, span_to_person_id, token.idx, token.idx + len(token.text)
-        )
+        person_id = person_spans.find_and_update(token.idx, token.idx + len(token.text))
         if person_id is not None:
             # token is a person
             token_text += '{%d}' % person_id
@@ -66,12 +93,15 @@ def process_article(spacy_article, print_edge_cases=False):
         article_tokens.append(token_text)
         article_token_indices.append(token.idx)
 
-    if print_edge_cases and span_to_person_id:
+    if print_edge_cases and person_spans.span_to_person_id():
         print '################'
         print "Person mention not fully found:"
-        print span_to_person_id
+        print person_spans.span_to_person_id()
 
-    return article_tokens, article_token_indices, case_sensitive_article_tokens
+    return (
+        article_tokens, article_token_indices, case_sensitive_article_tokens,
+        get_word_capitalizations(case_sensitive_article_tokens),
+    )
 
 
 def _resolve_people(spacy_article):
@@ -112,31 +142,59 @@ def _resolve_people(spacy_article):
     return span_to_person_id
 
 
-def _find_person_span_and_update(text, span_to_person_id, start, end):
+class _PersonSpans(object):
     """
-    Try to find a person span containing the search span. If found, reduce the person span by
-    removing the search span from it. Returns the person id of the found span.
+    The person spans sorted by start, for finding the span containing a token with a binary search
+    instead of scanning all spans.
     """
-    span = _find_span(span_to_person_id, start, end)
-    if span is None:
+
+    def __init__(self, text, span_to_person_id):
+        self._text = text
+        items = sorted(span_to_person_id.iteritems())
+        self._starts = [start for (start, _), _ in items]
+        self._ends = [end for (_, end), _ in items]
+        self._person_ids = [person_id for _, person_id in items]
+        # spans only shrink, so a span containing a token starts at most this far before its end
+        self._max_length = max([end - start for (start, end), _ in items] or [0])
+
+
+    def find_and_update(self, start, end):
+        """
+        Try to find a person span containing the search span. If found, reduce the person span by
+        removing the search span from it. Returns the person id of the found span.
+        """
+        i = bisect.bisect_right(self._starts, start)
+        while i > 0 and self._starts[i - 1] >= end - self._max_length:
+            i -= 1
+            if end <= self._ends[i]:
+                return self._update(i, end)
         return None
 
-    person_id = span_to_person_id.pop(span)
-    remaining_mention = text[end: span[1]].lstrip()
-    if remaining_mention:
-        span_to_person_id[(span[1] - len(remaining_mention), span[1])] = person_id
 
-    return person_id
+    def _update(self, i, end):
+        del self._starts[i]
+        span_end = self._ends.pop(i)
+        person_id = self._person_ids.pop(i)
 
+        remaining_mention = self._text[end: span_end].lstrip()
+        if remaining_mention:
+            span_start = span_end - len(remaining_mention)
+            j = bisect.bisect_left(self._starts, span_start)
+            self._starts.insert(j, span_start)
+            self._ends.insert(j, span_end)
+            self._person_ids.insert(j, person_id)
 
-def _find_span(span_to_person_id, start, end):
-    """
-    Find an containing span of the search span.
-    """
-    for (span_start, span_end), person_id in span_to_person_id.iteritems():
-        if start >= span_start and end <= span_end:
-            return span_start, span_end
-    return None
+        return person_id
+
+
+    def span_to_person_id(self):
+        """
+        Returns the map from span to person id of the remaining person spans.
+        """
+        return {
+            (start, end): person_id
+            for start, end, person_id in zip(self._starts, self._ends, self._person_ids)
+        }
 
 
 def _strip_span(span, text):
@@ -152,6 +210,22 @@ _moses_detokenizer = MosesDetokenizer()
 _end_sentence_punc = {'.', '!', '?'}
 _punctuation = set(string.punctuation)
 
+# XML escapes replaced by MosesDetokenizer, in order
+_xml_unescapes = (
+    (u'&bar;', u'|'), (u'&#124;', u'|'), (u'&lt;', u'<'), (u'&gt;', u'>'), (u'&bra;', u'['),
+    (u'&ket;', u']'), (u'&quot;', u'"'), (u'&apos;', u"'"), (u'&#91;', u'['), (u'&#93;', u']'),
+    (u'&amp;', u'&'),
+)
+# characters of the tokens attached to the previous token by MosesDetokenizer
+_left_shift_chars = frozenset(u',.?!:;\\%}])')
+_quote_chars = frozenset(u'\'"\u201e\u201c`')
+_double_quote_chars = frozenset(u'\u201e\u201c\u201d')
+# code point ranges of CJK characters, see nltk.tokenize.util.is_cjk
+_cjk_ranges = (
+    (4352, 4607), (11904, 42191), (43072, 43135), (44032, 55215), (63744, 64255),
+    (65072, 65103), (65381, 65500), (131072, 196607),
+)
+
 
 def _is_punctuation(token):
     return (
@@ -160,49 +234,124 @@ def _is_punctuation(token):
     )
 
 
-def process_output(summary_token_strings, article_token_strings):
+def process_output(summary_token_strings, word_capitalizations):
     """
     Convert output of beach search decoder into a final string for the summary.
     
     Args:
         summary_token_strings: list of output strings
-        article_token_strings: list of the original article strings
+        word_capitalizations: capitalizations of the original article strings, the last output of
+            process_article
     """
-    summary_token_strings = _fix_word_capitalizations(summary_token_strings, article_token_strings)
-    summary_token_strings = _fix_contractions(summary_token_strings)
-    _fix_ending(summary_token_strings)
-    _capitalize_sentence_starts(summary_token_strings)
-    merged_summary = _moses_detokenizer.detokenize(summary_token_strings, return_str=True)
-    return merged_summary
+    return process_outputs([summary_token_strings], word_capitalizations)[0]
 
 
-def _fix_word_capitalizations(token_strings, article_token_strings):
+def process_outputs(summaries_token_strings, word_capitalizations):
     """
-    For each output word, look up the most common capitalization of the word from the original
-    article (excluding right after punctuation), and use that capitalization.
+    Convert several outputs of beam search decoder for the same article into final strings.
+
+    Args:
+        summaries_token_strings: list of lists of output strings
+        word_capitalizations: capitalizations of the original article strings, the last output
+            of process_article
+    """
+    merged_summaries = []
+    for summary_token_strings in summaries_token_strings:
+        summary_token_strings = [
+            word_capitalizations.get(token_string, token_string)
+            for token_string in summary_token_strings
+        ]
+        summary_token_strings = _fix_contractions(summary_token_strings)
+        _fix_ending(summary_token_strings)
+        _capitalize_sentence_starts(summary_token_strings)
+        merged_summaries.append(_detokenize(summary_token_strings))
+    return merged_summaries
+
+
+def get_word_capitalizations(article_token_strings):
+    """
+    Returns a map of lower case word to the most common capitalization of the word in the
+    original article (excluding right after punctuation).
     """
-    # map (lower case word -> map (original word -> count))
-    word_capitalizations = defaultdict(lambda: defaultdict(int))
+    # map (original word -> count)
+    word_counts = defaultdict(int)
+    for previous_word, word in zip(article_token_strings, article_token_strings[1:]):
+        if not _is_punctuation(previous_word):
+            word_counts[word] += 1
+
+    # map of lower case word to most common capitalization of the word, breaking ties by choosing
+    # words with more capital letters
+    best_word_capitalizations = {}
+    best_scores = {}
+    for word, count in word_counts.iteritems():
+        word_lower = word.lower()
+        score = 100 * count + _count_capital_letters(word)
+        if score > best_scores.get(word_lower, -1):
+            best_word_capitalizations[word_lower] = word
+            best_scores[word_lower] = score
 
-    for i, word in enumerate(article_token_strings):
-        if i > 0 and not _is_punctuation(article_token_strings[i - 1]):
-            word_capitalizations[word.lower()][word] += 1
+    return best_word_capitalizations
 
-    # map of lower case word to most common capitalization of the word
-    best_word_capitalizations = {}
-    for word_lower, cap_counts in word_capitalizations.iteritems():
-        # sort by frequency, break ties by choosing words with more capital letters
-        sorted_capitalizations = sorted(
-            cap_counts.items(),
-            key=lambda item: 100 * item[1] + _count_capital_letters(item[0]),
-            reverse=True,
-        )
-        best_word_capitalizations[word_lower] = sorted_capitalizations[0][0]
-
-    return [
-        best_word_capitalizations.get(token_string, token_string)
-        for token_string in token_strings
-    ]
+
+def _is_cjk(character):
+    return any(start <= ord(character) <= end for start, end in _cjk_ranges)
+
+
+def _detokenize(token_strings):
+    """
+    Joins the tokens into a string the same way as the English MosesDetokenizer, which is much
+    slower as it runs regular expressions over every token. Falls back to MosesDetokenizer for
+    CJK text.
+    """
+    text = u' %s ' % u' '.join(token_strings)
+    text = text.replace(u' @-@ ', u'-')
+    if u'&' in text:
+        for escape, character in _xml_unescapes:
+            text = text.replace(escape, character)
+    tokens = text.split()
+    if any(token[0] >= u'\u1100' and _is_cjk(token[0]) for token in tokens):
+        return _moses_detokenizer.detokenize(token_strings, return_str=True)
+
+    quote_counts = defaultdict(int)
+    prepend_space = u' '
+    detokenized = []
+    for i, token in enumerate(tokens):
+        if len(token) == 1 and unicodedata.category(token) == 'Sc':
+            # currency symbol, attach the next token
+            detokenized.append(prepend_space + token)
+            prepend_space = u''
+        elif all(c in _left_shift_chars for c in token):
+            # punctuation, attach to the previous token
+            detokenized.append(token)
+            prepend_space = u' '
+        elif i > 0 and token[0] == u"'" and len(token) > 1 and token[1].isalpha():
+            # contraction, attach to the previous token
+            detokenized.append(token)
+            prepend_space = u' '
+        elif all(c in _quote_chars for c in token):
+            normalized_quote = token
+            if all(c in _double_quote_chars for c in token):
+                normalized_quote = u'"'
+            if quote_counts[normalized_quote] % 2 == 0:
+                if token == u"'" and i > 0 and tokens[i - 1].endswith(u's'):
+                    # possessive of a word ending in s, attach to the previous token
+                    detokenized.append(token)
+                    prepend_space = u' '
+                else:
+                    # opening quote, attach the next token
+                    detokenized.append(prepend_space + token)
+                    prepend_space = u''
+                    quote_counts[normalized_quote] += 1
+            else:
+                # closing quote, attach to the previous token
+                detokenized.append(token)
+                prepend_space = u' '
+                quote_counts[normalized_quote] += 1
+        else:
+            detokenized.append(prepend_space + token)
+            prepend_space = u' '
+
+    return u''.join(detokenized).strip()
 
 
 def _count_capital_letters(word):
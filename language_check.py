@@ -102,11 +102,18 @@ def sent_end_on_bad_word(token_strings):
     Returns whether there is an article or preposition that precedes a period.
     """
     for i in range(len(token_strings) - 1):
-        if token_strings[i] in _articles_and_prepositions and token_strings[i + 1] == '.':
+        if is_bad_sent_end_word(token_strings[i]) and token_strings[i + 1] == '.':
             return True
     return False
 
 
+def is_bad_sent_end_word(token_string):
+    """
+    Returns whether a sentence should not end on the word, i.e. it is an article or preposition.
+    """
+    return token_string in _articles_and_prepositions
+
+
 def has_poor_grammar(token_strings):
     """
     Returns whether the output has an odd number of double quotes or if it does not have balanced
@@ -9,7 +9,8 @@ import time
 from collections import Counter
 from tensorflow.core.example import example_pb2
 
-from data import ENTITY_TOKENS, POS_TOKENS
+from compiled_data import CompileHps, compile_data
+from data import ENTITY_TOKENS, POS_TOKENS, Vocab, write_record_index
 from io_processing import process_article
 from primer_core.nlp.get_spacy import get_spacy
 from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
@@ -27,6 +28,8 @@ num_expected_dm_stories = 219506
 num_expected_new_cables = 101476
 
 CHUNK_SIZE = 1000 # num examples per chunk, for the chunked data
+SPACY_BATCH_SIZE = 64 # num stories per worker task, processed with a single spacy.pipe call
+SPACY_N_THREADS = 1 # num threads of each worker's spacy.pipe call
 VOCAB_SIZE = 50000
 
 assert all(token[0] == '[' and token[-1] == ']' for token in ENTITY_TOKENS + POS_TOKENS)
@@ -35,6 +38,10 @@ POS_TAGS = tuple(token[1: -1] for token in POS_TOKENS)
 
 
 def chunk_file(finished_files_dir, chunks_dir, set_name):
+    """
+    Splits the set's data file into chunks of CHUNK_SIZE examples, each with its sidecar index
+    (see data.write_record_index).
+    """
     in_file = os.path.join(finished_files_dir, '%s.bin' % set_name)
     reader = open(in_file, "rb")
     chunk = 0
@@ -42,6 +49,7 @@ def chunk_file(finished_files_dir, chunks_dir, set_name):
     while not finished:
         # new chunk
         chunk_fname = os.path.join(chunks_dir, '%s_%03d.bin' % (set_name, chunk))
+        offsets = []
         with open(chunk_fname, 'wb') as writer:
             for _ in range(CHUNK_SIZE):
                 len_bytes = reader.read(8)
@@ -50,9 +58,11 @@ def chunk_file(finished_files_dir, chunks_dir, set_name):
                     break
                 str_len = struct.unpack('q', len_bytes)[0]
                 example_str = struct.unpack('%ds' % str_len, reader.read(str_len))[0]
+                offsets.append(writer.tell())
                 writer.write(struct.pack('q', str_len))
                 writer.write(struct.pack('%ds' % str_len, example_str))
-            chunk += 1
+        write_record_index(chunk_fname, offsets)
+        chunk += 1
 
 
 def chunk_all(finished_files_dir):
@@ -78,8 +88,10 @@ def tokenize_stories(stories_dir, tokenized_stories_dir, is_cable, n_workers):
         worker = ArticlePreprocesser(tasks, stories_dir, tokenized_stories_dir, is_cable)
         worker.start()
 
-    for story in os.listdir(stories_dir):
-        tasks.put(story)
+    # each task is a batch of stories, tokenized together
+    stories = os.listdir(stories_dir)
+    for i in range(0, len(stories), SPACY_BATCH_SIZE):
+        tasks.put(stories[i: i + SPACY_BATCH_SIZE])
     for i in range(n_workers):
         tasks.put(None)
 
@@ -110,44 +122,59 @@ class ArticlePreprocesser(multiprocessing.Process):
 
     def run(self):
         while True:
-            filename = self.task_queue.get()
-            if filename is None:
+            filenames = self.task_queue.get()
+            if filenames is None:
                 self.task_queue.task_done()
                 break
 
-            input_filename = os.path.join(self.input_dir, filename)
-            output_filename = os.path.join(self.output_dir, filename)
-            if os.path.isfile(output_filename):
-                self.task_queue.task_done()
-                continue
+            input_filenames = []
+            output_filenames = []
+            for filename in filenames:
+                output_filename = os.path.join(self.output_dir, filename)
+                if not os.path.isfile(output_filename):
+                    input_filenames.append(os.path.join(self.input_dir, filename))
+                    output_filenames.append(output_filename)
 
-            process_task(input_filename, output_filename, self.is_cable)
+            if input_filenames:
+                process_tasks(input_filenames, output_filenames, self.is_cable)
             self.task_queue.task_done()
 
 
-def process_task(input_filename, output_filename, is_cable):
-    article, abstract = get_art_abs(input_filename, add_periods=True, is_cable=is_cable)
-    article = unicode(article, 'utf-8').replace(u'\xa0', ' ')
-    abstract = unicode(abstract, 'utf-8').replace(u'\xa0', ' ')
+def process_tasks(input_filenames, output_filenames, is_cable):
+    def read_stories():
+        for input_filename in input_filenames:
+            article, abstract = get_art_abs(input_filename, add_periods=True, is_cable=is_cable)
+            article = unicode(article, 'utf-8').replace(u'\xa0', ' ')
+            abstract = unicode(abstract, 'utf-8').replace(u'\xa0', ' ')
+
+            doc = SingleDocument(0, raw={'body': article})
+            clean_article = doc.text()
+            clean_articles.append(clean_article)
+            yield u'%s %s' % (clean_article, abstract)
 
-    doc = SingleDocument(0, raw={'body': article})
-    clean_article = doc.text()
-    full_text = u'%s %s' % (clean_article, abstract)
-    spacy_text = get_spacy()(full_text)
+    # filled as the stories are read by spacy
+    clean_articles = []
+    spacy_texts = list(get_spacy().pipe(
+        read_stories(), batch_size=SPACY_BATCH_SIZE, n_threads=SPACY_N_THREADS
+    ))
 
-    text_tokens, text_token_indices, _ = process_article(spacy_text, print_edge_cases=True)
-    article_tokens = [
-        text for text, idx in zip(text_tokens, text_token_indices) if idx < len(clean_article)
-    ]
-    abstract_tokens = [
-        text for text, idx in zip(text_tokens, text_token_indices) if idx >= len(clean_article)
-    ]
+    # the people of each story are resolved on their own, as for decoder.generate_summary
+    for output_filename, clean_article, spacy_text in zip(
+        output_filenames, clean_articles, spacy_texts
+    ):
+        text_tokens, text_token_indices, _, _ = process_article(spacy_text, print_edge_cases=True)
+        article_tokens = [
+            text for text, idx in zip(text_tokens, text_token_indices) if idx < len(clean_article)
+        ]
+        abstract_tokens = [
+            text for text, idx in zip(text_tokens, text_token_indices) if idx >= len(clean_article)
+        ]
 
-    with open(output_filename, 'w') as f:
-        f.write(' '.join(article_tokens).encode('utf-8'))
-        f.write('\n\n')
-        f.write('@highlight\n')
-        f.write(' '.join(abstract_tokens).encode('utf-8'))
+        with open(output_filename, 'w') as f:
+            f.write(' '.join(article_tokens).encode('utf-8'))
+            f.write('\n\n')
+            f.write('@highlight\n')
+            f.write(' '.join(abstract_tokens).encode('utf-8'))
 
 
 def read_text_file(text_file):
@@ -372,6 +399,16 @@ def main():
     # each containing e.g. 1000 examples, and saves them in finished_files/chunks.
     chunk_all(finished_files_dir)
 
+    # Compile the chunks for the default vocab size and hyperparameters of run_summarization.py,
+    # see compiled_data.py. Use run_summarization.py --compile_data for other settings.
+    vocab = Vocab(os.path.join(finished_files_dir, 'vocab'), 20000)
+    hps = CompileHps(
+        max_enc_steps=400, max_dec_steps=100, copy_only_entities=False, output_vocab_size=20000
+    )
+    for set_name in ['train', 'val', 'test']:
+        print "Compiling %s data..." % set_name
+        compile_data(os.path.join(finished_files_dir, 'chunked', '%s_*' % set_name), vocab, hps)
+
 
 if __name__ == '__main__':
     main()
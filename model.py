@@ -27,6 +27,7 @@ Hps = namedtuple('Hyperparameters', (
     'adam_optimizer',
     'attn_only_entities',
     'batch_size',
+    'beam_size',
     'copy_common_loss_wt',
     'copy_only_entities',
     'cov_loss_wt',
@@ -90,18 +91,21 @@ class SummarizationModel(object):
         Add placeholders to the graph. These are entry points for any input data.
         """
         hps = self._hps
+        # In decode mode, the number of rows can vary from step to step (e.g. narrower beams), so
+        # it is only known at run time. At most hps.batch_size rows are used.
+        batch_size = None if hps.mode == 'decode' else hps.batch_size
 
         # encoder part
-        self._enc_batch = tf.placeholder(tf.int32, [hps.batch_size, None], name='enc_batch')
-        self._enc_lens = tf.placeholder(tf.int32, [hps.batch_size], name='enc_lens')
+        self._enc_batch = tf.placeholder(tf.int32, [batch_size, None], name='enc_batch')
+        self._enc_lens = tf.placeholder(tf.int32, [batch_size], name='enc_lens')
         self._enc_batch_extend_vocab = tf.placeholder(
-            tf.int32, [hps.batch_size, None], name='enc_batch_extend_vocab'
+            tf.int32, [batch_size, None], name='enc_batch_extend_vocab'
         )
         self._max_art_oovs = tf.placeholder(tf.int32, [], name='max_art_oovs')
 
         # decoder part
         self._dec_batch = tf.placeholder(
-            tf.int32, [hps.batch_size, hps.max_dec_steps], name='dec_batch'
+            tf.int32, [batch_size, hps.max_dec_steps], name='dec_batch'
         )
         self._target_batch = tf.placeholder(
             tf.int32, [hps.batch_size, hps.max_dec_steps], name='target_batch'
@@ -117,7 +121,7 @@ class SummarizationModel(object):
 
         if hps.mode == "decode" and hps.cov_loss_wt:
             self.prev_coverage = tf.placeholder(
-                tf.float32, [hps.batch_size, None], name='prev_coverage'
+                tf.float32, [batch_size, None], name='prev_coverage'
             )
 
 
@@ -230,8 +234,16 @@ class SummarizationModel(object):
             # log_dists is a singleton list containing shape (batch_size, extended_vsize).
             assert len(log_dists) == 1
             log_dists = log_dists[0]
-            # note batch_size = beam_size in decode mode
-            self._topk_log_probs, self._topk_ids = tf.nn.top_k(log_dists, hps.batch_size*2)
+            # Additive mask over the extended vocabulary, used to rule out tokens that break the
+            # beam search constraints before taking the top k. Defaults to no masking.
+            self._logit_mask = tf.placeholder_with_default(
+                tf.zeros_like(log_dists), shape=[None, None], name='logit_mask'
+            )
+            # the number of rows varies, so take the width from beam_size, the largest number of
+            # candidates that can be expanded per hypothesis
+            self._topk_log_probs, self._topk_ids = tf.nn.top_k(
+                log_dists + self._logit_mask, hps.beam_size*2
+            )
         else:
             # Used to get output words to be fed back for training
             # shape [max_dec_steps, batch_size, 4].
@@ -569,7 +581,12 @@ class SummarizationModel(object):
 
         # the maximum (over the batch) size of the extended vocabulary
         extended_vsize = self._vocab.size + self._max_art_oovs
-        extra_zeros = tf.zeros((self._hps.batch_size, self._max_art_oovs))
+        # the batch size is only known at run time in decode mode
+        if self._hps.mode == 'decode':
+            batch_size = tf.shape(self._enc_batch_extend_vocab)[0]
+        else:
+            batch_size = self._hps.batch_size
+        extra_zeros = tf.zeros((batch_size, self._max_art_oovs))
         # list length max_dec_steps of shape (batch_size, extended_vsize)
         vocab_dists_extended = [
             tf.concat(axis=1, values=[dist, extra_zeros]) for dist in vocab_dists
@@ -581,12 +598,12 @@ class SummarizationModel(object):
         # final distribution. This is done for each decoder timestep.
 
         # This is fiddly; we use tf.scatter_nd to do the projection.
-        batch_nums = tf.range(0, limit=self._hps.batch_size) # shape (batch_size)
+        batch_nums = tf.range(0, limit=batch_size) # shape (batch_size)
         batch_nums = tf.expand_dims(batch_nums, 1) # shape (batch_size, 1)
         attn_len = tf.shape(self._enc_batch_extend_vocab)[1] # number of states we attend over
         batch_nums = tf.tile(batch_nums, [1, attn_len]) # shape (batch_size, attn_len)
         indices = tf.stack((batch_nums, self._enc_batch_extend_vocab), axis=2) # shape (batch_size, enc_t, 2)
-        shape = [self._hps.batch_size, extended_vsize]
+        shape = [batch_size, extended_vsize]
         # list length max_dec_steps (batch_size, extended_vsize)
         self.attn_dists_projected = [
             tf.scatter_nd(indices, copy_dist, shape) for copy_dist in attn_dists
@@ -863,7 +880,9 @@ class SummarizationModel(object):
                 then a tuple of such LSTMStateTuples.
                 
         """
-        # Feed the batch into the placeholders
+        # Feed the batch into the placeholders. The whole batch is encoded, rather than only its
+        # first row, since matrix products over a different number of rows round differently and
+        # beam search results must not depend on it.
         feed_dict = self._make_feed_dict(batch, just_enc=True)
         # Run the encoder
         enc_states, dec_in_state, global_step = sess.run(
@@ -886,7 +905,8 @@ class SummarizationModel(object):
 
 
     def decode_onestep(
-        self, sess, batch, latest_tokens, enc_states, dec_init_states, prev_coverage
+        self, sess, batch, latest_tokens, enc_states, dec_init_states, prev_coverage,
+        logit_mask=None
     ):
         """
         For beam search decoding. Run the decoder for one step.
@@ -901,17 +921,21 @@ class SummarizationModel(object):
             enc_states:
                 The encoder states.
             dec_init_states:
-                List of beam_size LSTMStateTuples; the decoder states from the previous timestep.
-                If two layers, each state is instead a tuple of LSTMStateTuples.
+                List of LSTMStateTuples, one per hypothesis (at most hps.batch_size); the decoder
+                states from the previous timestep. If two layers, each state is instead a tuple of
+                LSTMStateTuples.
             prev_coverage:
                 List of np arrays. The coverage vectors from the previous timestep. List of None
                 if not using coverage.
+            logit_mask:
+                Optional np array of shape [beam_size, extended_vsize], added to the log
+                probabilities before taking the top k. Used to rule out invalid tokens.
     
         Returns:
             ids:
-                top 2k ids. shape [beam_size, 2*beam_size]
+                top 2k ids, where k is hps.beam_size. shape [beam_size, 2*hps.beam_size]
             probs:
-                top 2k log probabilities. shape [beam_size, 2*beam_size]
+                top 2k log probabilities. shape [beam_size, 2*hps.beam_size]
             new_states:
                 new states of the decoder. a list length beam_size containing LSTMStateTuples
                 each of shape ([dec_hidden_dim,],[dec_hidden_dim,]). If two layers, each state
@@ -944,12 +968,14 @@ class SummarizationModel(object):
 
         new_dec_in_state = tuple(new_dec_in_states) if self._hps.two_layer_lstm else new_dec_in_states[0]
 
+        # Only feed as many rows of the batch as there are hypotheses.
+        assert beam_size <= self._hps.batch_size
         feed = {
-            self._enc_batch: batch.enc_batch,
-            self._enc_states: enc_states,
+            self._enc_batch: batch.enc_batch[:beam_size],
+            self._enc_states: enc_states[:beam_size],
             self._dec_in_state: new_dec_in_state,
             self._dec_batch: np.transpose(np.array([latest_tokens])),
-            self._enc_batch_extend_vocab: batch.enc_batch_extend_vocab,
+            self._enc_batch_extend_vocab: batch.enc_batch_extend_vocab[:beam_size],
             self._max_art_oovs: batch.max_art_oovs,
         }
 
@@ -965,6 +991,9 @@ class SummarizationModel(object):
             feed[self.prev_coverage] = np.stack(prev_coverage, axis=0)
             to_return['coverage'] = self.coverage
 
+        if logit_mask is not None:
+            feed[self._logit_mask] = logit_mask
+
         # Run the decoder step
         if self._settings.trace_path:
             options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
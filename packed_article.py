@@ -0,0 +1,155 @@
+"""
+Compact representation of a processed article, for passing articles between processes. The
+encoder input ids (as computed by batcher.Example), the article OOVs, the article text and the
+capitalizations of the original article strings are packed into a single buffer:
+
+    header: 6 int32s, the buffer length in bytes, the number of processed article tokens, the
+        number of encoder input tokens, the number of article OOVs, the number of article id to
+        word id pairs and the number of strings
+    int32 arrays: the encoder input ids, the encoder input ids with the article OOV ids, the
+        (article id, word id) pairs and the offsets of the strings
+    utf-8 strings: the article OOVs, the article text and the (lower case word, capitalization)
+        pairs
+
+The arrays are read as numpy views of the buffer without copying, so a buffer in shared memory
+(see SharedSlots) can be decoded directly.
+"""
+import mmap
+import struct
+
+import numpy as np
+
+_HEADER = struct.Struct('<6i')
+_INT32 = np.dtype('<i4')
+
+
+def pack_article(article_tokens, word_capitalizations, text, vocab, hps):
+    """
+    Returns the packed article as a string.
+
+    Args:
+        article_tokens: list of the processed article tokens, the first output of
+            io_processing.process_article
+        word_capitalizations: capitalizations of the original article tokens, the last output of
+            io_processing.process_article
+        text: unicode article text, the summary of short articles
+        vocab: Vocabulary object
+        hps: hyperparameters of the model the article will be decoded with
+    """
+    # This import is slow - lazy import.
+    import data
+
+    # same as batcher.Example
+    parsed_tokens = [vocab.parse_token(token) for token in article_tokens[:hps.max_enc_steps]]
+    article_words = [(w, word_type) for w, word_type, _ in parsed_tokens]
+    enc_input = [word_id for _, _, word_id in parsed_tokens]
+    enc_input_extend_vocab, article_oovs, article_id_to_word_id = data.article2ids(
+        article_words, vocab, hps.copy_only_entities
+    )
+
+    capitalization_strings = [s for pair in sorted(word_capitalizations.iteritems()) for s in pair]
+    strings = [s.encode('utf-8') for s in article_oovs + [text] + capitalization_strings]
+    string_offsets = np.cumsum([0] + [len(s) for s in strings])
+    ints = np.concatenate([
+        np.array(enc_input, dtype=_INT32),
+        np.array(enc_input_extend_vocab, dtype=_INT32),
+        np.array(sorted(article_id_to_word_id.items()), dtype=_INT32).reshape(-1),
+        string_offsets.astype(_INT32),
+    ]).astype(_INT32)
+
+    length = _HEADER.size + ints.nbytes + int(string_offsets[-1])
+    header = _HEADER.pack(
+        length, len(article_tokens), len(enc_input), len(article_oovs),
+        len(article_id_to_word_id), len(strings),
+    )
+    return header + ints.tobytes() + ''.join(strings)
+
+
+class PackedArticle(object):
+    """
+    Read-only view of a packed article in a buffer (a string, mmap or other object supporting the
+    buffer protocol). len() is the number of processed article tokens.
+    """
+
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+        (
+            self.length, self._n_article_tokens, self.enc_len, self._n_oovs, self._n_pairs,
+            self._n_strings,
+        ) = _HEADER.unpack_from(buffer, offset)
+        offset += _HEADER.size
+
+        # numpy views of the buffer
+        self.enc_input = np.frombuffer(buffer, _INT32, self.enc_len, offset)
+        offset += self.enc_input.nbytes
+        self.enc_input_extend_vocab = np.frombuffer(buffer, _INT32, self.enc_len, offset)
+        offset += self.enc_input_extend_vocab.nbytes
+        self._pairs = np.frombuffer(buffer, _INT32, 2 * self._n_pairs, offset).reshape(-1, 2)
+        offset += self._pairs.nbytes
+        self._string_offsets = np.frombuffer(buffer, _INT32, self._n_strings + 1, offset)
+        self._strings_offset = offset + self._string_offsets.nbytes
+
+
+    def __len__(self):
+        return self._n_article_tokens
+
+
+    def _string(self, i):
+        start = self._strings_offset + int(self._string_offsets[i])
+        end = self._strings_offset + int(self._string_offsets[i + 1])
+        return self.buffer[start: end].decode('utf-8')
+
+
+    @property
+    def article_oovs(self):
+        return [self._string(i) for i in xrange(self._n_oovs)]
+
+
+    @property
+    def article_id_to_word_id(self):
+        return {int(article_id): int(word_id) for article_id, word_id in self._pairs}
+
+
+    @property
+    def text(self):
+        return self._string(self._n_oovs)
+
+
+    @property
+    def word_capitalizations(self):
+        strings = [self._string(i) for i in xrange(self._n_oovs + 1, self._n_strings)]
+        return dict(zip(strings[::2], strings[1::2]))
+
+
+class SharedSlots(object):
+    """
+    Fixed size slots for packed articles in an anonymous shared memory map. The map is inherited
+    by processes forked after it's created, so these can write packed articles that the parent
+    reads without copying them through a pipe.
+    """
+
+    def __init__(self, n_slots, slot_size=2 ** 20):
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.buffer = mmap.mmap(-1, n_slots * slot_size)
+
+
+    def write(self, slot, packed):
+        """
+        Writes the packed article string to the slot. Returns False if it's too large.
+        """
+        assert 0 <= slot < self.n_slots
+        if len(packed) > self.slot_size:
+            return False
+        start = slot * self.slot_size
+        self.buffer[start: start + len(packed)] = packed
+        return True
+
+
+    def read(self, slot):
+        """
+        Returns a PackedArticle view of the slot, valid until the slot is written again.
+        """
+        assert 0 <= slot < self.n_slots
+        return PackedArticle(self.buffer, slot * self.slot_size)
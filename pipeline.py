@@ -0,0 +1,200 @@
+"""
+Staged pipeline for summarizing many articles in one process with the model. Input processing
+(spacy, people resolution and tagging) and output processing (capitalization and detokenization)
+are pure python and hold the GIL, so they run on a pool of processes, while the model decodes in
+the main process. Processed articles are fed to the decoder through a bounded queue, so the input
+processing of the next articles overlaps with the decoding of the current one.
+
+Processed articles are packed (see packed_article.py) into slots of a shared memory map, so the
+decoder reads the encoder inputs without unpickling lists of tokens, and the output processing
+reads the capitalizations of the original article tokens from the same slot.
+"""
+import multiprocessing
+import threading
+import time
+from Queue import Queue
+
+import decoder
+from io_processing import process_article, process_output
+from packed_article import PackedArticle, SharedSlots, pack_article
+from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
+
+# set in the processing processes by _init_process
+_vocab = None
+_hps = None
+_slots = None
+
+
+def _init_process(vocab, hps, slots):
+    global _vocab, _hps, _slots
+    _vocab, _hps, _slots = vocab, hps, slots
+
+
+def _read_packed(slots, slot, packed):
+    """
+    Returns the PackedArticle in the slot of the SharedSlots, or in the packed string if it didn't
+    fit.
+    """
+    return slots.read(slot) if packed is None else PackedArticle(packed)
+
+
+def _preprocess(article_text, slot):
+    """
+    Processes the article and packs it into the slot. Returns the packed article string if it's
+    too large for the slot (None otherwise), and the number of seconds taken.
+    """
+    t0 = time.time()
+    spacy_article = SingleDocument(0, raw={'body': article_text}).spacy_text()
+    article_tokens, _, _, word_capitalizations = process_article(spacy_article)
+    packed = pack_article(article_tokens, word_capitalizations, spacy_article.text, _vocab, _hps)
+    if _slots.write(slot, packed):
+        packed = None
+    return packed, time.time() - t0
+
+
+def _postprocess(summary_token_strings, slot, packed):
+    """
+    Returns the summary and the number of seconds taken. Errors are returned in place of the
+    summary rather than raised, since the pool only calls the callback that frees the slot for
+    tasks that return.
+    """
+    t0 = time.time()
+    try:
+        word_capitalizations = _read_packed(_slots, slot, packed).word_capitalizations
+        summary = process_output(summary_token_strings, word_capitalizations)
+    except Exception as e:
+        summary = e
+    return summary, time.time() - t0
+
+
+class SummarizationPipeline(object):
+    """
+    Summarizes lists of articles, with the input and output processing on a pool of processes.
+    """
+
+    def __init__(self, n_processes=None, queue_size=8):
+        """
+        SummarizationPipeline constructor. Starts the processing pool, so should be created before
+        the model is loaded in this process.
+
+        Args:
+            n_processes: Integer, the number of input / output processing processes. Defaults to
+                the number of CPUs.
+            queue_size: Integer, the most number of processed articles waiting to be decoded.
+        """
+        # These imports are slow - load them before forking, so the processes share them.
+        from data import Vocab
+
+        self._n_processes = n_processes or multiprocessing.cpu_count()
+        self._queue_size = queue_size
+        # slots for the articles queued, and being processed before and after decoding
+        self._slots = SharedSlots(queue_size + 2 * self._n_processes + 1)
+        vocab = Vocab(decoder._vocab_path, decoder._vocab_size)
+        self._pool = multiprocessing.Pool(
+            self._n_processes, _init_process, (vocab, decoder._decode_hps(), self._slots)
+        )
+        # statistics of the last run
+        self.stats = {}
+
+
+    def run(self, article_texts, ideal_summary_length_tokens=60, decode_mode='beam'):
+        """
+        Returns the (summary, score) tuples as returned by decoder.generate_summary for each of
+        the article texts, in order. Afterwards, self.stats has the end-to-end throughput
+        (articles / second) and the utilization of each stage: the fraction of the time the
+        decoder was busy, and of the time of the processing pool spent on each processing stage.
+
+        If processing or decoding an article raises, no more articles are started, and the error
+        is raised once the articles already started are done with their slots.
+        """
+        # processed articles (as slots and async results of the pool) in order, waiting to be
+        # decoded
+        decode_queue = Queue(maxsize=self._queue_size)
+        # slots not used by an article being processed or decoded
+        free_slots = Queue()
+        for slot in range(self._slots.n_slots):
+            free_slots.put(slot)
+
+        # set when an article fails, to stop feeding articles
+        failed = threading.Event()
+
+        def feed():
+            for article_text in article_texts:
+                slot = free_slots.get()
+                if failed.is_set():
+                    break
+                decode_queue.put((slot, self._pool.apply_async(_preprocess, (article_text, slot))))
+            # no more articles
+            decode_queue.put(None)
+
+        t_start = time.time()
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        decode_seconds = 0.
+        # for each article, either the final output or the async result of its output processing
+        pending_outputs = []
+        # the first error processing or decoding an article
+        error = None
+        for slot, preprocessed in iter(decode_queue.get, None):
+            if error is not None:
+                # wait for the input processing to be done with the slot
+                preprocessed.wait()
+                free_slots.put(slot)
+                continue
+            try:
+                packed, preprocess_seconds = preprocessed.get()
+                packed_article = _read_packed(self._slots, slot, packed)
+                t0 = time.time()
+                decoded = decoder.decode_article_tokens(
+                    packed_article, ideal_summary_length_tokens, decode_mode
+                )
+                decode_seconds += time.time() - t0
+            except Exception as e:
+                error = e
+                failed.set()
+                free_slots.put(slot)
+                continue
+
+            if decoded is None:
+                # short inputs
+                pending_outputs.append(((packed_article.text, 0.), preprocess_seconds, None, None))
+                free_slots.put(slot)
+                continue
+            summary_token_strings, score = decoded
+            postprocessed = self._pool.apply_async(
+                _postprocess, (summary_token_strings, slot, packed),
+                callback=lambda _, slot=slot: free_slots.put(slot),
+            )
+            pending_outputs.append((None, preprocess_seconds, postprocessed, score))
+        feeder.join()
+
+        outputs = []
+        preprocess_seconds = 0.
+        postprocess_seconds = 0.
+        for output, article_preprocess_seconds, postprocessed, score in pending_outputs:
+            preprocess_seconds += article_preprocess_seconds
+            if postprocessed is not None:
+                summary, article_postprocess_seconds = postprocessed.get()
+                postprocess_seconds += article_postprocess_seconds
+                if isinstance(summary, Exception) and error is None:
+                    error = summary
+                output = summary, score
+            outputs.append(output)
+        if error is not None:
+            raise error
+
+        total_seconds = time.time() - t_start
+        self.stats = {
+            'throughput': len(article_texts) / total_seconds,
+            'decode_utilization': decode_seconds / total_seconds,
+            'preprocess_utilization': preprocess_seconds / (self._n_processes * total_seconds),
+            'postprocess_utilization': postprocess_seconds / (self._n_processes * total_seconds),
+        }
+        return outputs
+
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -8,6 +8,7 @@ import tensorflow as tf
 import numpy as np
 from data import Vocab
 from batcher import Batcher
+from compiled_data import compile_data
 from model import Hps, Settings, SummarizationModel
 from decode_eval import BeamSearchDecoder
 import util
@@ -17,6 +18,7 @@ FLAGS = tf.app.flags.FLAGS
 # Where to find data
 tf.app.flags.DEFINE_string('data_path', '', 'Path expression to tf.Example datafiles. Can include wildcards to access multiple datafiles.')
 tf.app.flags.DEFINE_string('vocab_path', '', 'Path expression to text vocabulary file.')
+tf.app.flags.DEFINE_boolean('compile_data', False, 'If True, first compile the datafiles for the vocab and hyperparameters (see compiled_data.py), so the batcher reads pre-encoded examples.')
 tf.app.flags.DEFINE_string('embeddings_path', '', 'For the start of training, if provided use the pretrained word embeddings in the file.')
 
 # Important settings
@@ -356,6 +358,9 @@ def main(unused_argv):
     settings = Settings(**settings_dict)
     hps = Hps(**hps_dict)
 
+    if FLAGS.compile_data:
+        compile_data(FLAGS.data_path, vocab, hps)
+
     # Create a batcher object that will create minibatches of data
     batcher = Batcher(FLAGS.data_path, vocab, hps, single_pass=FLAGS.single_pass)
 
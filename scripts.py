@@ -2,6 +2,7 @@ import reproducible
 reproducible.add_non_git_file('results/articles/article_0.txt')
 reproducible.write_fingerprint()
 
+import glob
 import json
 import numpy as np
 import os
@@ -11,13 +12,19 @@ import struct
 import sys
 from sklearn.decomposition.truncated_svd import TruncatedSVD
 from tensorflow.core.example import example_pb2
+import threading
 import time
 
+from beam_search import AdaptiveBeam
 from data import N_FREE_TOKENS, Vocab
 from make_datafiles import get_art_abs
 from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
+from primer_core.nlp.get_spacy import get_spacy
 from primer_core.nlp.summary.lexrank.summary import compute_summaries
-from decoder import generate_summary
+from decoder import DECODE_MODES, generate_summaries, generate_summary
+from pipeline import SummarizationPipeline
+from summarization_client import SummarizationClient
+from worker_pool import SummarizerPool, memory_usage
 
 
 ######################################################
@@ -258,31 +265,48 @@ def get_lexrank_summary(doc):
     )
     return summaries[0]['summary']
 
-def write_results(out_file):
+def summarize_with_fallback(spacy_article, decode_mode='beam', rerun_below_score=None):
+    """
+    Generates a summary with the given decode mode. If rerun_below_score is set and the summary
+    scores below it, the summary is generated again with the full beam search.
+    """
+    summary, score = generate_summary(spacy_article, decode_mode=decode_mode)
+    if rerun_below_score is not None and decode_mode != 'beam' and score < rerun_below_score:
+        summary, score = generate_summary(spacy_article, decode_mode='beam')
+    return summary, score
+
+def write_results(
+    out_file, decode_mode='beam', rerun_below_score=None, spacy_batch_size=16, spacy_n_threads=1,
+):
     out = open(out_file, 'w')
     out.write('\t'.join(['Reference', 'Lexrank', 'Seq-to-seq', 'Score']) + '\n')
 
-    for filename in sorted(os.listdir(RESULTS_ARTICLE_DIR)):
-        article_id = int(filename.split('.')[0].split('_')[1])
+    filenames = sorted(os.listdir(RESULTS_ARTICLE_DIR))
+    docs = [
+        SingleDocument(0, raw={'body': read_results_article(filename)}) for filename in filenames
+    ]
+    # same as doc.spacy_text(), but batched
+    spacy_articles = get_spacy().pipe(
+        (doc.text() for doc in docs), batch_size=spacy_batch_size, n_threads=spacy_n_threads
+    )
 
-        # Read article
-        with open(os.path.join(RESULTS_ARTICLE_DIR, filename)) as f:
-            article_text = unicode(f.read(), 'utf-8')
-            article_text = article_text.replace(u'\xa0', ' ').replace('\t', ' ').replace('\n', ' ')
+    for filename, doc in zip(filenames, docs):
+        article_id = int(filename.split('.')[0].split('_')[1])
 
         # Read reference summary
         with open(os.path.join(RESULTS_ABSTRACT_DIR, 'abstract_%d.txt' % article_id)) as f:
             reference_summary = f.read()
 
-        doc = SingleDocument(0, raw={'body': article_text})
-
         # Generate lexrank summary
         lexrank_summary = get_lexrank_summary(doc).encode('utf-8')
 
-        # Generate seq-to-seq summary
+        # Generate seq-to-seq summary. The time includes parsing, as with doc.spacy_text(): the
+        # pipe parses the next batch of articles when the first of them is pulled.
         t0 = time.time()
-        spacy_article = doc.spacy_text()
-        seq_to_seq_summary, score = generate_summary(spacy_article)
+        spacy_article = next(spacy_articles)
+        seq_to_seq_summary, score = summarize_with_fallback(
+            spacy_article, decode_mode, rerun_below_score
+        )
         seq_to_seq_summary = seq_to_seq_summary.encode('utf-8')
 
         print '####################'
@@ -301,7 +325,7 @@ def write_results(out_file):
 # Generate sample summaries
 ######################################################
 
-def get_cable_results(data_file, out_file):
+def get_cable_results(data_file, out_file, decode_mode='beam', rerun_below_score=None):
     out = open(out_file, 'w')
     out.write('\t'.join(['Cable', 'Lexrank', 'Seq-to-seq']) + '\n')
 
@@ -314,7 +338,7 @@ def get_cable_results(data_file, out_file):
             continue
 
         lexrank = get_lexrank_summary(doc)
-        seq2seq = generate_summary(doc.spacy_text())[0]
+        seq2seq = summarize_with_fallback(doc.spacy_text(), decode_mode, rerun_below_score)[0]
 
         out.write(
             '\t'.join([
@@ -328,6 +352,464 @@ def get_cable_results(data_file, out_file):
 
 
 
+######################################################
+# Benchmarks
+######################################################
+
+def read_results_article(filename):
+    with open(os.path.join(RESULTS_ARTICLE_DIR, filename)) as f:
+        article_text = unicode(f.read(), 'utf-8')
+    return article_text.replace(u'\xa0', ' ').replace('\t', ' ').replace('\n', ' ')
+
+def get_benchmark_articles():
+    """
+    Returns the spacy-processed articles from the results directory, used as a benchmark corpus.
+    """
+    return [
+        SingleDocument(0, raw={'body': read_results_article(filename)}).spacy_text()
+        for filename in sorted(os.listdir(RESULTS_ARTICLE_DIR))
+    ]
+
+def benchmark_recombination(n_gram=0):
+    """
+    Reports the number of beam slots reclaimed per article by hypothesis recombination, and the
+    change in time and score compared to the search without recombination.
+    """
+    spacy_articles = get_benchmark_articles()
+    # make sure the model is loaded before timing
+    generate_summary(spacy_articles[0])
+
+    reclaimed = []
+    times = {None: [], n_gram: []}
+    scores = {None: [], n_gram: []}
+
+    for spacy_article in spacy_articles:
+        for recombination_n_gram in (None, n_gram):
+            stats = {}
+            t0 = time.time()
+            _, score = generate_summary(
+                spacy_article, recombination_n_gram=recombination_n_gram, search_stats=stats
+            )
+            times[recombination_n_gram].append(time.time() - t0)
+            scores[recombination_n_gram].append(score)
+            if recombination_n_gram is not None:
+                reclaimed.append(stats.get('recombined', 0))
+
+    print 'Articles:', len(spacy_articles)
+    print 'Reclaimed beam slots per article: mean %.2f | max %d' % (
+        np.mean(reclaimed), max(reclaimed)
+    )
+    for recombination_n_gram in (None, n_gram):
+        print 'recombination_n_gram=%s | mean time %.3f | mean score %.4f' % (
+            recombination_n_gram,
+            np.mean(times[recombination_n_gram]),
+            np.mean(scores[recombination_n_gram]),
+        )
+
+def benchmark_constraint_masks():
+    """
+    Compares the number of decoder steps, wasted candidates, time and score of beam search with
+    constraints applied as logit masks versus as penalties after expansion.
+    """
+    spacy_articles = get_benchmark_articles()
+    # make sure the model is loaded before timing
+    generate_summary(spacy_articles[0])
+
+    for mask_constraints in (False, True):
+        steps = []
+        wasted = []
+        times = []
+        scores = []
+
+        for spacy_article in spacy_articles:
+            stats = {}
+            t0 = time.time()
+            _, score = generate_summary(
+                spacy_article, mask_constraints=mask_constraints, search_stats=stats
+            )
+            times.append(time.time() - t0)
+            scores.append(score)
+            steps.append(stats.get('steps', 0))
+            wasted.append(stats.get('wasted', 0))
+
+        print '####################'
+        print 'mask_constraints:', mask_constraints
+        print 'Mean steps: %.1f | Mean wasted candidates: %.1f' % (np.mean(steps), np.mean(wasted))
+        print 'Mean time: %.3f | Mean score: %.4f' % (np.mean(times), np.mean(scores))
+
+def benchmark_decode_modes(low_score=-.4):
+    """
+    Compares the cost against the score distribution of each decode mode, including the fraction
+    of summaries that score below low_score (and so would be rerun with the full beam search).
+    """
+    spacy_articles = get_benchmark_articles()
+    # make sure the model is loaded before timing
+    generate_summary(spacy_articles[0])
+
+    for decode_mode in sorted(DECODE_MODES):
+        times = []
+        scores = []
+
+        for spacy_article in spacy_articles:
+            t0 = time.time()
+            _, score = generate_summary(spacy_article, decode_mode=decode_mode)
+            times.append(time.time() - t0)
+            scores.append(score)
+
+        print '####################'
+        print 'decode_mode:', decode_mode
+        print 'Mean time: %.3f | Total time: %.1f' % (np.mean(times), sum(times))
+        print 'Score percentiles (10, 25, 50, 75, 90):', np.percentile(scores, [10, 25, 50, 75, 90])
+        print 'Fraction below %.2f: %.3f' % (low_score, np.mean(np.array(scores) < low_score))
+
+def benchmark_adaptive_beam(min_beam_size=1, max_beam_size=4, log_prob_margin=2.):
+    """
+    Compares the average number of active decoder rows per step, latency and score of the
+    adaptive beam against the fixed beam of 4.
+    """
+    spacy_articles = get_benchmark_articles()
+    # make sure the model is loaded before timing
+    generate_summary(spacy_articles[0])
+
+    adaptive_beam = AdaptiveBeam(min_beam_size, max_beam_size, log_prob_margin)
+    for policy in (None, adaptive_beam):
+        rows_per_step = []
+        times = []
+        scores = []
+
+        for spacy_article in spacy_articles:
+            stats = {}
+            t0 = time.time()
+            _, score = generate_summary(spacy_article, adaptive_beam=policy, search_stats=stats)
+            times.append(time.time() - t0)
+            scores.append(score)
+            if stats.get('steps'):
+                rows_per_step.append(float(stats['rows']) / stats['steps'])
+
+        print '####################'
+        print 'adaptive beam:', policy is not None
+        print 'Mean active rows per step: %.2f' % np.mean(rows_per_step)
+        print 'Mean time: %.3f | 90th percentile time: %.3f' % (
+            np.mean(times), np.percentile(times, 90)
+        )
+        print 'Mean score: %.4f' % np.mean(scores)
+
+def benchmark_multiple_lengths(lengths=(30, 60, 90)):
+    """
+    Compares generating summaries of several lengths with one search against one search per
+    length.
+    """
+    spacy_articles = get_benchmark_articles()
+    # make sure the model is loaded before timing
+    generate_summary(spacy_articles[0])
+
+    separate_times = []
+    single_times = []
+    n_same = 0
+    for spacy_article in spacy_articles:
+        t0 = time.time()
+        separate = [generate_summary(spacy_article, length) for length in lengths]
+        separate_times.append(time.time() - t0)
+
+        t0 = time.time()
+        single = generate_summaries(spacy_article, lengths)
+        single_times.append(time.time() - t0)
+        n_same += sum(a[0] == b[0] for a, b in zip(separate, single))
+
+    print 'lengths:', lengths
+    print 'Mean time, one search per length: %.3f' % np.mean(separate_times)
+    print 'Mean time, single search: %.3f' % np.mean(single_times)
+    print 'Fraction of identical summaries: %.3f' % (
+        float(n_same) / (len(lengths) * len(spacy_articles))
+    )
+
+def benchmark_scheduler(n_bulk_rounds=3):
+    """
+    Reports the latency of interactive requests, alone and while bulk requests saturate the
+    summarization client, and the queue waits of each priority class.
+    """
+    spacy_articles = get_benchmark_articles()
+    client = SummarizationClient()
+    # make sure the model is loaded before timing
+    client.summarize(spacy_articles[0])
+
+    def submit_bulk():
+        for _ in xrange(n_bulk_rounds):
+            for spacy_article in spacy_articles:
+                client.submit(spacy_article, priority='bulk', blocking=True)
+
+    for with_bulk in (False, True):
+        bulk_thread = threading.Thread(target=submit_bulk)
+        if with_bulk:
+            bulk_thread.start()
+
+        times = []
+        for spacy_article in spacy_articles:
+            t0 = time.time()
+            client.summarize(spacy_article, priority='interactive')
+            times.append(time.time() - t0)
+
+        print '####################'
+        print 'with bulk requests:', with_bulk
+        print 'Interactive latency percentiles (50, 90, 99):', np.percentile(times, [50, 90, 99])
+        if with_bulk:
+            bulk_thread.join()
+
+    for priority in ('interactive', 'bulk'):
+        print priority, 'queue wait percentiles (50, 90, 99):',
+        print client.queue_wait_percentiles(priority)
+    client.close()
+
+def benchmark_worker_pool(weight_bundle_dir, n_workers=4):
+    """
+    Compares memory per worker and total throughput of a single process, and of pools of
+    pre-forked workers restoring from the checkpoint or from a weight bundle (see
+    weight_bundle.py).
+    """
+    article_texts = [
+        read_results_article(filename) for filename in sorted(os.listdir(RESULTS_ARTICLE_DIR))
+    ]
+
+    for bundle_dir in (None, weight_bundle_dir):
+        pool = SummarizerPool(n_workers, weight_bundle_dir=bundle_dir)
+        # make sure the workers have loaded the model before timing
+        pool.map(article_texts[:n_workers])
+        t0 = time.time()
+        pool.map(article_texts)
+        throughput = len(article_texts) / (time.time() - t0)
+        usage = pool.memory_usage()
+        pool.close()
+
+        print '####################'
+        print 'pool with %d workers, weight bundle: %s' % (n_workers, bundle_dir)
+        print 'Mean RSS per worker: %.0f MB' % (np.mean([rss for rss, _ in usage]) / 2. ** 20)
+        print 'Mean PSS per worker: %.0f MB' % (
+            np.mean([pss or 0 for _, pss in usage]) / 2. ** 20
+        )
+        print 'Total PSS of the workers: %.0f MB' % (sum(pss or 0 for _, pss in usage) / 2. ** 20)
+        print 'Throughput: %.3f articles / second' % throughput
+
+    # The model is only loaded in this process after the pools are done, since tensorflow sessions
+    # can't be shared across a fork.
+    spacy_articles = get_benchmark_articles()
+    generate_summary(spacy_articles[0])
+    t0 = time.time()
+    for spacy_article in spacy_articles:
+        generate_summary(spacy_article)
+    rss, pss = memory_usage()
+    print '####################'
+    print 'single process'
+    print 'RSS: %.0f MB | PSS: %.0f MB' % (rss / 2. ** 20, (pss or 0) / 2. ** 20)
+    print 'Throughput: %.3f articles / second' % (len(spacy_articles) / (time.time() - t0))
+
+def benchmark_pipeline(n_processes=None):
+    """
+    Compares the throughput of the staged pipeline against generating summaries one after another,
+    and reports the utilization of each pipeline stage.
+    """
+    article_texts = [
+        read_results_article(filename) for filename in sorted(os.listdir(RESULTS_ARTICLE_DIR))
+    ]
+
+    # The pipeline's pool is started before the model is loaded in this process.
+    pipeline = SummarizationPipeline(n_processes)
+    # make sure the model is loaded before timing
+    pipeline.run(article_texts[:1])
+    pipeline.run(article_texts)
+    pipeline.close()
+    print '####################'
+    print 'pipeline'
+    for key, value in sorted(pipeline.stats.iteritems()):
+        print '%s: %.3f' % (key, value)
+
+    t0 = time.time()
+    for article_text in article_texts:
+        generate_summary(SingleDocument(0, raw={'body': article_text}).spacy_text())
+    print '####################'
+    print 'sequential'
+    print 'throughput: %.3f' % (len(article_texts) / (time.time() - t0))
+
+def benchmark_person_spans(n_mentions=5000):
+    """
+    Compares finding the person span of each token of a long, name heavy article with the sorted
+    span index against scanning all the spans for each token.
+    """
+    from io_processing import _PersonSpans
+
+    names = [u'John Smith', u'Mary Jones', u'Ban Ki-moon', u'Smith']
+    words = []
+    span_to_person_id = {}
+    start = 0
+    for i in range(n_mentions):
+        name = names[i % len(names)]
+        span_to_person_id[(start, start + len(name))] = i % len(names)
+        words.append(name + u' said that')
+        start += len(words[-1]) + 1
+    text = u' '.join(words)
+    token_spans = []
+    start = 0
+    for token in text.split(u' '):
+        token_spans.append((start, start + len(token)))
+        start += len(token) + 1
+
+    def find_and_update_linear(spans, start, end):
+        for (span_start, span_end), person_id in spans.iteritems():
+            if start >= span_start and end <= span_end:
+                del spans[(span_start, span_end)]
+                remaining_mention = text[end: span_end].lstrip()
+                if remaining_mention:
+                    spans[(span_end - len(remaining_mention), span_end)] = person_id
+                return person_id
+        return None
+
+    spans = dict(span_to_person_id)
+    t0 = time.time()
+    linear_ids = [find_and_update_linear(spans, start, end) for start, end in token_spans]
+    linear_seconds = time.time() - t0
+
+    person_spans = _PersonSpans(text, span_to_person_id)
+    t0 = time.time()
+    indexed_ids = [person_spans.find_and_update(start, end) for start, end in token_spans]
+    indexed_seconds = time.time() - t0
+
+    assert indexed_ids == linear_ids
+    print '####################'
+    print '%d tokens, %d person mentions' % (len(token_spans), n_mentions)
+    print 'linear scan: %.3f seconds' % linear_seconds
+    print 'sorted index: %.3f seconds' % indexed_seconds
+
+def benchmark_spacy_pipe(batch_size=16, n_threads=2):
+    """
+    Compares the throughput of spacy on the benchmark articles one call per article against
+    batched with nlp.pipe.
+    """
+    texts = [
+        SingleDocument(0, raw={'body': read_results_article(filename)}).text()
+        for filename in sorted(os.listdir(RESULTS_ARTICLE_DIR))
+    ]
+    nlp = get_spacy()
+    # warm up
+    nlp(texts[0])
+
+    t0 = time.time()
+    for text in texts:
+        nlp(text)
+    print '####################'
+    print 'one call per article: %.1f docs / second' % (len(texts) / (time.time() - t0))
+
+    t0 = time.time()
+    for _ in nlp.pipe(texts, batch_size=batch_size, n_threads=n_threads):
+        pass
+    print 'nlp.pipe (batch size %d, %d threads): %.1f docs / second' % (
+        batch_size, n_threads, len(texts) / (time.time() - t0)
+    )
+
+def benchmark_data_reader(data_path):
+    """
+    Compares the raw read throughput of the data files matching data_path (e.g. the chunked
+    train_* files) with read calls and struct.unpack, as example_generator used to, against
+    data.read_records. Run twice to compare with the files in the page cache.
+    """
+    from data import read_records
+    filelist = sorted(glob.glob(data_path))
+
+    n_bytes = 0
+    t0 = time.time()
+    for filename in filelist:
+        with open(filename, 'rb') as reader:
+            while True:
+                len_bytes = reader.read(8)
+                if not len_bytes:
+                    break
+                str_len = struct.unpack('q', len_bytes)[0]
+                example_str = struct.unpack('%ds' % str_len, reader.read(str_len))[0]
+                n_bytes += len(example_str)
+    read_seconds = time.time() - t0
+
+    t0 = time.time()
+    for filename in filelist:
+        for example_str in read_records(filename):
+            pass
+    mmap_seconds = time.time() - t0
+
+    print '####################'
+    print '%d files, %.0f MB of records' % (len(filelist), n_bytes / 2. ** 20)
+    print 'read + unpack: %.1f MB / second' % (n_bytes / 2. ** 20 / read_seconds)
+    print 'read_records: %.1f MB / second' % (n_bytes / 2. ** 20 / mmap_seconds)
+
+
+def benchmark_parse_tokens(data_path, vocab_path='model_parameters/vocab', n_examples=1000):
+    """
+    Compares the tokens / second of mapping the article tokens of the first n_examples examples of
+    the data files matching data_path to (word, word_type, id) tuples: with the regexes
+    data.parse_word used to and Vocab.word2id, with data.parse_word and Vocab.word2id, and with
+    the memoized Vocab.parse_token.
+    """
+    import re
+    from data import (
+        ENTITY_TOKENS, PEOPLE_ID_SIZE, PERSON_TOKENS, POS_TOKENS, data_files, parse_word,
+        read_records,
+    )
+
+    def parse_word_regex(word):
+        def find_match(pattern):
+            match = re.search(pattern, word)
+            if match:
+                return word[:match.start()], word[match.start(): match.end()]
+            return word, ''
+
+        real_word, person_id = find_match(r'(\{.*\})')
+        if person_id:
+            person_id = int(person_id[1: -1])
+            if person_id < PEOPLE_ID_SIZE:
+                return real_word, PERSON_TOKENS[person_id]
+            else:
+                return real_word, PERSON_TOKENS[-1]
+
+        real_word, word_type = find_match(r'(\[.*\])')
+        if word_type:
+            if word_type in ENTITY_TOKENS + POS_TOKENS:
+                return real_word, word_type
+            else:
+                return real_word, None
+
+        return word, None
+
+    tokens = []
+    n_read = 0
+    for filename in sorted(data_files(data_path)):
+        for example_str in read_records(filename):
+            features = example_pb2.Example.FromString(example_str).features.feature
+            tokens.extend(features['article'].bytes_list.value[0].split())
+            n_read += 1
+            if n_read == n_examples:
+                break
+        if n_read == n_examples:
+            break
+    vocab = Vocab(vocab_path, 20000)
+
+    def parse_regex(token):
+        word, word_type = parse_word_regex(token)
+        return word, word_type, vocab.word2id(word, word_type)
+
+    def parse(token):
+        word, word_type = parse_word(token)
+        return word, word_type, vocab.word2id(word, word_type)
+
+    print '####################'
+    print '%d examples, %d tokens' % (n_read, len(tokens))
+    outputs = []
+    for name, parse_fn in (
+        ('regex parse_word', parse_regex),
+        ('parse_word', parse),
+        ('Vocab.parse_token', vocab.parse_token),
+    ):
+        t0 = time.time()
+        outputs.append([parse_fn(token) for token in tokens])
+        print '%s: %.0f tokens / second' % (name, len(tokens) / (time.time() - t0))
+    assert all(output == outputs[0] for output in outputs)
+
+
 ######################################################
 # Generate sample summaries
 ######################################################
@@ -341,3 +823,15 @@ if __name__ == '__main__':
     #find_articles()
     #generate_input_file(sys.argv[1])
     #get_cable_results(sys.argv[1], sys.argv[2])
+    #benchmark_recombination(int(sys.argv[1]))
+    #benchmark_constraint_masks()
+    #benchmark_decode_modes()
+    #benchmark_adaptive_beam()
+    #benchmark_multiple_lengths()
+    #benchmark_scheduler()
+    #benchmark_worker_pool(sys.argv[1])
+    #benchmark_pipeline()
+    #benchmark_person_spans()
+    #benchmark_spacy_pipe()
+    #benchmark_data_reader(sys.argv[1])
+    #benchmark_parse_tokens(sys.argv[1])
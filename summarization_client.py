@@ -0,0 +1,319 @@
+"""
+Client for generating summaries in the background, so that callers (e.g. services handling other
+requests) aren't blocked for the tens of seconds a summary takes.
+
+Requests are scheduled by priority class: a worker thread runs one decoder step at a time of the
+highest priority request, so interactive requests don't wait for bulk requests to finish, only for
+their current step. Each class has a bounded queue, and requests beyond it are rejected right away
+with SummarizerBusy. Requests can be cancelled between decoder steps.
+"""
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import decoder
+
+
+# Priority classes, highest priority first.
+PRIORITIES = ('interactive', 'bulk')
+# Default number of requests of each priority class that can wait to be started.
+DEFAULT_QUEUE_LIMITS = {'interactive': 8, 'bulk': 256}
+
+
+class SummaryCancelled(Exception):
+    """
+    Raised when getting the result of a cancelled request.
+    """
+    pass
+
+
+class SummaryTimeout(Exception):
+    """
+    Raised when the result of a request isn't ready by the timeout.
+    """
+    pass
+
+
+class SummarizerBusy(Exception):
+    """
+    Raised when submitting a request whose priority class queue is full.
+    """
+    pass
+
+
+class SummarizerClosed(Exception):
+    """
+    Raised when submitting a request to a closed client.
+    """
+    pass
+
+
+class SummaryRequest(object):
+    """
+    Handle to a summary being generated by a SummarizationClient.
+    """
+
+    def __init__(self, client, spacy_article, priority, stream, kwargs):
+        self.spacy_article = spacy_article
+        self.priority = priority
+        self.stream = stream
+        self.kwargs = kwargs
+        # current best partial summary, updated after each decoder step if streaming
+        self.partial = None
+        # seconds between being submitted and being started
+        self.queue_wait = None
+        self._submit_time = time.time()
+        self._stream = None
+        # last output of the stream
+        self._output = None
+        self._result = None
+        # sys.exc_info() of the error raised while generating the summary, if any
+        self._exc_info = None
+        self._cancelled = False
+        self._done = threading.Event()
+        self._client = client
+
+
+    def cancel(self):
+        """
+        Cancels the request. If it is waiting, it is removed from its queue right away, freeing
+        its place. If it is running, the search stops after the current decoder step. Returns
+        False if the request had already finished.
+        """
+        return self._client._cancel(self)
+
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+
+    def done(self):
+        """
+        Whether the request has finished, was cancelled or failed.
+        """
+        return self._done.is_set()
+
+
+    def result(self, timeout=None):
+        """
+        Waits for the request to finish and returns the (summary, score) tuple as returned by
+        decoder.generate_summary. Raises SummaryCancelled if the request was cancelled, or the
+        error raised while generating the summary, with the worker thread's traceback.
+
+        Args:
+            timeout: optional number of seconds to wait. If the request isn't done by then,
+                SummaryTimeout is raised.
+        """
+        if not self._done.wait(timeout):
+            raise SummaryTimeout()
+        if self._cancelled:
+            raise SummaryCancelled()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class SummarizationClient(object):
+    """
+    Runs decoder.stream_summary for submitted articles on a worker thread, interleaving the
+    decoder steps of requests by priority.
+    """
+
+    def __init__(self, queue_limits=None):
+        """
+        SummarizationClient constructor. Starts the worker thread.
+
+        Args:
+            queue_limits: optional dictionary from priority class to the most number of requests
+                of that class waiting to be started. Defaults to DEFAULT_QUEUE_LIMITS.
+        """
+        self._queue_limits = dict(DEFAULT_QUEUE_LIMITS)
+        self._queue_limits.update(queue_limits or {})
+        # waiting requests of each priority class
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        # the running request of each priority class, if any
+        self._running = {priority: None for priority in PRIORITIES}
+        self._condition = threading.Condition()
+        self._closed = False
+        # counts and recent queue waits (in seconds) of each priority class
+        self.metrics = {
+            priority: {
+                'rejected': 0,
+                'completed': 0,
+                'cancelled': 0,
+                'failed': 0,
+                'queue_waits': deque(maxlen=1000),
+            }
+            for priority in PRIORITIES
+        }
+
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+
+    def submit(
+        self, spacy_article, priority='interactive', blocking=False, stream=False, **kwargs
+    ):
+        """
+        Submits an article to summarize.
+
+        Args:
+            spacy_article: Spacy-processed text, see decoder.generate_summary.
+            priority: One of PRIORITIES.
+            blocking: Boolean. If the queue of the priority class is full, wait for room if True,
+                otherwise raise SummarizerBusy. SummarizerClosed is raised if the client is
+                closed.
+            stream: Boolean. If True, the request's partial summary is updated after each decoder
+                step, see decoder.stream_summary. Otherwise partial summaries aren't processed.
+            kwargs: other arguments of decoder.generate_summary.
+
+        Returns:
+            SummaryRequest.
+        """
+        assert priority in PRIORITIES
+        with self._condition:
+            queue = self._queues[priority]
+            while True:
+                # nothing would serve the request
+                if self._closed:
+                    raise SummarizerClosed()
+                if len(queue) < self._queue_limits[priority]:
+                    break
+                if not blocking:
+                    self.metrics[priority]['rejected'] += 1
+                    raise SummarizerBusy(priority)
+                self._condition.wait()
+            request = SummaryRequest(self, spacy_article, priority, stream, kwargs)
+            queue.append(request)
+            self._condition.notify_all()
+        return request
+
+
+    def summarize(self, spacy_article, timeout=None, **kwargs):
+        """
+        Submits an article and waits for its (summary, score). If not done by the timeout, the
+        request is cancelled and SummaryCancelled is raised.
+        """
+        request = self.submit(spacy_article, **kwargs)
+        try:
+            return request.result(timeout)
+        except SummaryTimeout:
+            request.cancel()
+            raise SummaryCancelled()
+
+
+    def queue_wait_percentiles(self, priority, percentiles=(50, 90, 99)):
+        """
+        Returns the given percentiles of the recent queue waits (in seconds) of the priority
+        class, or None if no request of the class was started yet.
+        """
+        queue_waits = list(self.metrics[priority]['queue_waits'])
+        if not queue_waits:
+            return None
+        return np.percentile(queue_waits, percentiles)
+
+
+    def close(self):
+        """
+        Stops the worker thread after the requests already submitted. Later submits raise
+        SummarizerClosed.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._worker.join()
+
+
+    def _cancel(self, request):
+        """
+        Cancels the request, see SummaryRequest.cancel.
+        """
+        with self._condition:
+            if request._done.is_set():
+                return False
+            request._cancelled = True
+            queue = self._queues[request.priority]
+            if request in queue:
+                queue.remove(request)
+                self.metrics[request.priority]['cancelled'] += 1
+                request._done.set()
+                # there is room in the queue now
+                self._condition.notify_all()
+        return True
+
+
+    def _run(self):
+        while True:
+            with self._condition:
+                request = self._next_request()
+                while request is None:
+                    if self._closed:
+                        return
+                    self._condition.wait()
+                    request = self._next_request()
+            self._step(request)
+
+
+    def _next_request(self):
+        """
+        Returns the running request of the highest priority class with work, starting the next
+        waiting request of the class if none is running. Must be called with the lock held.
+        """
+        for priority in PRIORITIES:
+            if self._running[priority] is not None:
+                return self._running[priority]
+            if self._queues[priority]:
+                request = self._queues[priority].popleft()
+                # there is room in the queue now
+                self._condition.notify_all()
+                request.queue_wait = time.time() - request._submit_time
+                self.metrics[priority]['queue_waits'].append(request.queue_wait)
+                self._running[priority] = request
+                return request
+        return None
+
+
+    def _step(self, request):
+        """
+        Runs one decoder step of the request, and finishes it if it's done or cancelled.
+        """
+        try:
+            if not request.cancelled:
+                if request._stream is None:
+                    request._stream = decoder.stream_summary(
+                        request.spacy_article, partial_summaries=request.stream, **request.kwargs
+                    )
+                try:
+                    request._output = next(request._stream)
+                    if request.stream:
+                        request.partial = request._output
+                    return
+                except StopIteration:
+                    # the last output of the stream is the final result
+                    request._result = request._output
+        except Exception:
+            request._exc_info = sys.exc_info()
+        self._finish(request)
+
+
+    def _finish(self, request):
+        if request._stream is not None:
+            # Closing the stream drops the search and the encoder states right away.
+            request._stream.close()
+            request._stream = None
+
+        with self._condition:
+            self._running[request.priority] = None
+            if request.cancelled:
+                self.metrics[request.priority]['cancelled'] += 1
+            elif request._exc_info is not None:
+                self.metrics[request.priority]['failed'] += 1
+            else:
+                self.metrics[request.priority]['completed'] += 1
+            # under the lock, so that cancel either comes before or returns False
+            request._done.set()
@@ -0,0 +1,125 @@
+"""
+Summarizes a JSONL file of articles on a pool of worker processes (see worker_pool.py), writing a
+JSONL file of results. Each result is written as soon as it's done, and articles already in the
+output file are skipped, so an interrupted job resumes where it stopped when run again.
+
+Usage: python summarize_jsonl.py <input.jsonl> <output.jsonl> [--n_workers=N] ...
+    Each input line is a JSON object with the article text (in 'article' by default) and an id (in
+    'id' by default, or 'line:<line number>' if missing). Each output line is a JSON object with
+    'id', 'summary', 'score' and 'seconds' (the time taken by the worker), or 'error' if the
+    article failed (failed articles aren't retried when resuming). Results are in order of
+    completion, not of input.
+"""
+import argparse
+import json
+import os
+import time
+
+from worker_pool import SummarizerPool
+
+
+def read_articles(input_path, text_field='article', id_field='id', skip_ids=()):
+    """
+    Yields (id, article text) tuples from the JSONL file, skipping ids in skip_ids. Records without
+    an id get 'line:<line number>', namespaced so they don't collide with the explicit ids of
+    other records.
+    """
+    with open(input_path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            article_id = record.get(id_field, 'line:%d' % line_number)
+            if article_id in skip_ids:
+                continue
+            yield article_id, record[text_field]
+
+
+def read_done_ids(output_path):
+    """
+    Returns the set of ids in the output file of a previous run, after removing a partially
+    written last line (e.g. if the job was killed).
+    """
+    done_ids = set()
+    if not os.path.exists(output_path):
+        return done_ids
+
+    with open(output_path, 'r+') as f:
+        valid_length = 0
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            done_ids.add(json.loads(line)['id'])
+            valid_length += len(line)
+        f.truncate(valid_length)
+
+    return done_ids
+
+
+def summarize_jsonl(
+    input_path, output_path, n_workers=None, text_field='article', id_field='id',
+    decode_mode='beam', flush_every=10,
+):
+    """
+    Summarizes the articles of the input file not already in the output file, appending the
+    results to the output file.
+
+    Args:
+        input_path: string, JSONL file of articles
+        output_path: string, JSONL file of results
+        n_workers: Integer, the number of worker processes. Defaults to the host config (see
+            decoder.load_host_config), or the number of CPUs.
+        text_field: string, field of the input records with the article text
+        id_field: string, field of the input records with the article id
+        decode_mode: One of decoder.DECODE_MODES
+        flush_every: Integer, the output file is flushed to disk after this many results
+
+    Returns:
+        The number of articles summarized.
+    """
+    done_ids = read_done_ids(output_path)
+    if done_ids:
+        print 'Resuming, skipping %d articles already done' % len(done_ids)
+
+    pool = SummarizerPool(n_workers)
+    articles = read_articles(input_path, text_field, id_field, skip_ids=done_ids)
+    n_done = 0
+    t0 = time.time()
+    with open(output_path, 'a') as f:
+        results = pool.imap_unordered(articles, decode_mode=decode_mode)
+        for article_id, output, error, latency in results:
+            record = {'id': article_id, 'seconds': latency}
+            if error is None:
+                record['summary'], record['score'] = output
+            else:
+                record['error'] = repr(error)
+            f.write(json.dumps(record) + '\n')
+
+            n_done += 1
+            if n_done % flush_every == 0:
+                f.flush()
+                os.fsync(f.fileno())
+                print 'Summarized %d articles, %.2f articles / second' % (
+                    n_done, n_done / (time.time() - t0)
+                )
+    pool.close()
+
+    return n_done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarizes a JSONL file of articles.')
+    parser.add_argument('input_path')
+    parser.add_argument('output_path')
+    parser.add_argument('--n_workers', type=int, default=None)
+    parser.add_argument('--text_field', default='article')
+    parser.add_argument('--id_field', default='id')
+    parser.add_argument('--decode_mode', default='beam')
+    parser.add_argument('--flush_every', type=int, default=10)
+    args = parser.parse_args()
+
+    n_done = summarize_jsonl(
+        args.input_path, args.output_path, args.n_workers, args.text_field, args.id_field,
+        args.decode_mode, args.flush_every,
+    )
+    print 'Summarized %d articles' % n_done
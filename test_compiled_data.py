@@ -0,0 +1,50 @@
+import struct
+
+from tensorflow.core.example import example_pb2
+
+import decoder
+from batcher import Example
+from compiled_data import (
+    CompileHps, compile_data, pack_example, unpack_example, vocab_fingerprint,
+)
+from data import IndexedRecords, Vocab
+
+
+def test_compile_data(tmpdir):
+    vocab = Vocab(decoder._vocab_path, decoder._vocab_size)
+    hps = CompileHps(
+        max_enc_steps=20, max_dec_steps=8, copy_only_entities=False, output_vocab_size=20000
+    )
+    articles = [
+        ('john{0} smith{0} met zyxwvut[NOUN] in paris[GPE] . smith{0} said hi .',
+         'smith{0} met zyxwvut[NOUN] .'),
+        ('', 'skipped'),
+        (' '.join(['word'] * 30 + ['mary{1}']), 'mary{1} ' * 10),
+    ]
+    data_file = str(tmpdir.join('train_000.bin'))
+    with open(data_file, 'wb') as writer:
+        for article, abstract in articles:
+            tf_example = example_pb2.Example()
+            tf_example.features.feature['article'].bytes_list.value.extend([article])
+            tf_example.features.feature['abstract'].bytes_list.value.extend([abstract])
+            example_str = tf_example.SerializeToString()
+            writer.write(struct.pack('q', len(example_str)))
+            writer.write(example_str)
+
+    compiled_path = compile_data(str(tmpdir.join('train_*')), vocab, hps)
+    assert vocab_fingerprint(vocab, hps) in compiled_path
+    assert vocab_fingerprint(vocab, hps._replace(max_enc_steps=400)) not in compiled_path
+
+    records = IndexedRecords(compiled_path)
+    assert len(records) == 2
+    for i, (article, abstract) in enumerate([articles[0], articles[2]]):
+        example = Example(article, abstract, vocab, hps)
+        compiled_example = Example.from_compiled(unpack_example(records[i]), hps)
+        assert records[i] == pack_example(example)
+        for attribute in (
+            'enc_len', 'enc_input', 'enc_input_extend_vocab', 'article_oovs',
+            'article_id_to_word_id', 'dec_input', 'dec_len', 'target', 'target_people',
+            'people_ids', 'original_article', 'original_abstract',
+        ):
+            assert getattr(compiled_example, attribute) == getattr(example, attribute)
+    records.close()
@@ -0,0 +1,50 @@
+from constraints import MASKED_LOG_PROB, ConstraintMasker
+from data import START_DECODING, STOP_DECODING, Vocab
+from decoder import _vocab_path, _vocab_size
+
+
+vocab = Vocab(_vocab_path, _vocab_size)
+article_oovs = ['zuckerberg', 'tesla']
+masker = ConstraintMasker(vocab, article_oovs, min_dec_steps=5)
+
+
+def _ids(words):
+    return [
+        vocab.size + article_oovs.index(w) if w in article_oovs else vocab.word2id(w, None)
+        for w in words
+    ]
+
+
+def test_repeated_trigram():
+    words = [START_DECODING, 'the', 'man', 'said', 'the', 'man']
+    assert vocab.word2id('said', None) in masker.banned_ids(_ids(words), words)
+
+
+def test_repeated_entity():
+    words = [START_DECODING, 'tesla']
+    assert _ids(['tesla']) == masker.banned_ids(_ids(words), words)
+
+    words = [START_DECODING, 'tesla', ',']
+    assert _ids(['tesla']) == masker.banned_ids(_ids(words), words)
+
+
+def test_sentence_end_on_bad_word():
+    words = [START_DECODING, 'he', 'went', 'to']
+    assert vocab.word2id('.', None) in masker.banned_ids(_ids(words), words)
+
+
+def test_unknown_and_stop_tokens():
+    stop_id = vocab.word2id(STOP_DECODING, None)
+
+    class FakeHyp(object):
+        tokens = _ids([START_DECODING, 'he'])
+        token_strings = [START_DECODING, 'he']
+
+    masks = masker.mask([FakeHyp()], steps=0)
+    assert masks.shape == (1, vocab.size + len(article_oovs))
+    assert masks[0, vocab.word2id('[UNK]', None)] == MASKED_LOG_PROB
+    assert masks[0, stop_id] == MASKED_LOG_PROB
+    assert masks[0, vocab.word2id('said', None)] == 0.
+
+    masks = masker.mask([FakeHyp()], steps=5)
+    assert masks[0, stop_id] == 0.
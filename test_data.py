@@ -0,0 +1,207 @@
+import os
+import random
+import struct
+import threading
+from collections import defaultdict
+
+import decoder
+from data import (
+    ENTITY_TOKENS, N_IMPORTANT_TOKENS, PERSON_TOKENS, POS_TOKENS, UNKNOWN_TOKENS, IndexedRecords,
+    Vocab, abstract2ids, article2ids, indexed_record_generator, parse_word, read_record_index,
+    read_records, write_record_index,
+)
+
+
+def _write_data_file(data_file, records):
+    with open(data_file, 'wb') as writer:
+        for record in records:
+            writer.write(struct.pack('q', len(record)))
+            writer.write(record)
+
+
+def test_read_records(tmpdir):
+    records = ['first record', '', 'x' * 10000]
+    data_file = str(tmpdir.join('test_000.bin'))
+    _write_data_file(data_file, records)
+
+    assert list(read_records(data_file)) == records
+    tmpdir.join('empty.bin').write('')
+    assert list(read_records(str(tmpdir.join('empty.bin')))) == []
+
+
+def test_indexed_records(tmpdir):
+    records = ['record %d' % i * (i % 7) for i in range(100)]
+    for chunk in range(3):
+        data_file = str(tmpdir.join('test_%03d.bin' % chunk))
+        _write_data_file(data_file, records[chunk * 40: (chunk + 1) * 40])
+        # the last chunk is read without an index
+        if chunk < 2:
+            offsets = read_record_index(data_file)
+            write_record_index(data_file)
+            assert list(read_record_index(data_file)) == offsets
+
+    indexed_records = IndexedRecords(str(tmpdir.join('test_*')))
+    assert len(indexed_records.filelist) == 3
+    assert len(indexed_records) == len(records)
+    assert [indexed_records[i] for i in range(len(records))] == records
+
+    shards = [indexed_records.shard_indices(shard, 4, seed=1) for shard in range(4)]
+    assert sorted(sum(shards, [])) == range(len(records))
+    assert shards == [indexed_records.shard_indices(shard, 4, seed=1) for shard in range(4)]
+    assert indexed_records.shard_indices(0, 1) == range(len(records))
+    indexed_records.close()
+
+
+def test_indexed_records_open_files(tmpdir):
+    records = ['record %d' % i for i in range(60)]
+    for chunk in range(6):
+        data_file = str(tmpdir.join('test_%03d.bin' % chunk))
+        _write_data_file(data_file, records[chunk * 10: (chunk + 1) * 10])
+        write_record_index(data_file)
+
+    n_fds = len(os.listdir('/proc/self/fd'))
+    # more files than open files, read by threads sharing the reader
+    indexed_records = IndexedRecords(str(tmpdir.join('test_*')), max_open_files=2)
+    shards = [[] for _ in range(4)]
+
+    def read_shard(shard):
+        for record in indexed_record_generator(indexed_records, False, shard, 4, seed=1):
+            shards[shard].append(record)
+            # two epochs
+            if len(shards[shard]) == 30:
+                break
+
+    threads = [threading.Thread(target=read_shard, args=(shard,)) for shard in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # each epoch of the shards partitions the records
+    assert sorted(sum([shard[:15] for shard in shards], [])) == sorted(records)
+    assert sorted(sum([shard[15:] for shard in shards], [])) == sorted(records)
+    # the files read last are still open
+    assert len(os.listdir('/proc/self/fd')) == n_fds + 2
+    indexed_records.close()
+    assert len(os.listdir('/proc/self/fd')) == n_fds
+
+
+def test_parse_word():
+    assert parse_word('smith{0}') == ('smith', PERSON_TOKENS[0])
+    assert parse_word('smith{123}') == ('smith', PERSON_TOKENS[-1])
+    assert parse_word('paris[GPE]') == ('paris', '[GPE]')
+    assert parse_word('the[DET]') == ('the', '[DET]')
+    assert parse_word('word[OTHER]') == ('word', None)
+    assert parse_word('a[b]c[NOUN]') == ('a', None)
+    assert parse_word('a]b[') == ('a]b[', None)
+    assert parse_word('word') == ('word', None)
+
+
+def test_parse_token():
+    vocab = Vocab(decoder._vocab_path, decoder._vocab_size)
+    vocab.MAX_PARSED_TOKENS = 3
+    tokens = ['the', 'smith{0}', 'zyxwvut[NOUN]', 'zyxwvut', 'paris[GPE]', 'the', 'smith{0}'] * 3
+    for token in tokens:
+        word, word_type = parse_word(token)
+        assert vocab.parse_token(token) == (word, word_type, vocab.word2id(word, word_type))
+        assert len(vocab._parsed_tokens) <= vocab.MAX_PARSED_TOKENS
+
+
+def _article2ids_reference(article_words, vocab, copy_only_entities):
+    # article2ids before the OOV tables were dicts
+    ids = []
+    oovs = []
+    unk_article_id_to_word_id_list = defaultdict(list)
+    unk_ids = set(vocab.word2id('', token) for token in UNKNOWN_TOKENS)
+
+    for w, word_type in article_words:
+        i = vocab.word2id(w, word_type)
+        if i in unk_ids and (not copy_only_entities or 3 <= i < N_IMPORTANT_TOKENS):
+            if w not in oovs:
+                oovs.append(w)
+            ids.append(vocab.size + oovs.index(w))
+            unk_article_id_to_word_id_list[ids[-1]].append(i)
+        else:
+            ids.append(i)
+
+    unk_article_id_to_word_id = {}
+    for article_id, word_ids in unk_article_id_to_word_id_list.iteritems():
+        word_id_counts = defaultdict(int)
+        for word_id in word_ids:
+            word_id_counts[word_id] += 1
+        # The stable sort breaks ties by the dict's iteration order, which matches article2ids'
+        # max() over its counts dict, since both insert the same int keys in the same order.
+        sorted_words = sorted(word_id_counts.items(), key=lambda pair: pair[1], reverse=True)
+        unk_article_id_to_word_id[article_id] = sorted_words[0][0]
+
+    return ids, oovs, unk_article_id_to_word_id
+
+
+def _abstract2ids_reference(abstract_words, vocab, article_oovs, copyable_words, output_vocab_size):
+    # abstract2ids before the OOV tables were dicts
+    ids = []
+    unk_ids = set(vocab.word2id('', token) for token in UNKNOWN_TOKENS)
+
+    for w, word_type in abstract_words:
+        i_orig = vocab.word2id(w, None)
+        i_real = vocab.word2id(w, word_type)
+        i_article_oov = vocab.size + article_oovs.index(w) if w in article_oovs else 0
+        i_pos = vocab.word2id('', word_type)
+        is_copyable = w in copyable_words
+
+        if i_orig < output_vocab_size:
+            if i_real in unk_ids and i_article_oov:
+                ids.append(i_article_oov)
+            else:
+                ids.append(i_orig)
+        elif i_orig not in unk_ids:
+            if i_real in unk_ids and i_article_oov:
+                ids.append(i_article_oov)
+            elif is_copyable:
+                ids.append(i_orig)
+            else:
+                ids.append(i_pos)
+        else:
+            if is_copyable:
+                assert i_article_oov
+                ids.append(i_article_oov)
+            else:
+                ids.append(i_pos)
+
+    return ids
+
+
+def test_article2ids_abstract2ids():
+    vocab = Vocab(decoder._vocab_path, decoder._vocab_size)
+    rng = random.Random(0)
+    # common and rare vocab words, and OOVs
+    words = (
+        [vocab.id2word(i) for i in rng.sample(xrange(vocab.size), 50)] +
+        ['oov%d' % i for i in range(20)]
+    )
+    # a few word types for each word, so OOVs are labeled inconsistently and votes can tie
+    all_word_types = list(ENTITY_TOKENS) + list(POS_TOKENS) + ['[OTHER]']
+    word_types = {w: [None] + rng.sample(all_word_types, 2) for w in words}
+
+    def random_words(n):
+        return [(w, rng.choice(word_types[w])) for w in (rng.choice(words) for _ in xrange(n))]
+
+    for _ in xrange(500):
+        article_words = random_words(rng.randint(0, 200))
+        abstract_words = random_words(rng.randint(0, 50))
+        copy_only_entities = rng.random() < .5
+        output_vocab_size = rng.choice([1000, 10000, vocab.size])
+
+        article_ids = article2ids(article_words, vocab, copy_only_entities)
+        assert article_ids == _article2ids_reference(article_words, vocab, copy_only_entities)
+
+        article_oovs = article_ids[1]
+        if copy_only_entities:
+            copyable_words = set(article_oovs)
+        else:
+            copyable_words = set(w for w, _ in article_words)
+        assert abstract2ids(
+            abstract_words, vocab, article_oovs, copyable_words, output_vocab_size
+        ) == _abstract2ids_reference(
+            abstract_words, vocab, article_oovs, copyable_words, output_vocab_size
+        )
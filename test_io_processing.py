@@ -0,0 +1,84 @@
+import json
+
+from io_processing import (
+    _PersonSpans, _detokenize, _moses_detokenizer, get_word_capitalizations, process_article,
+)
+from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
+from primer_core.nlp.get_spacy import get_spacy
+
+
+def test_person_spans():
+    text = u'Then John Smith and Ms. Jones met Smith.'
+    person_spans = _PersonSpans(text, {(5, 15): 0, (20, 29): 1, (34, 39): 0})
+    assert person_spans.find_and_update(0, 4) is None
+    assert person_spans.find_and_update(5, 9) == 0
+    # the span is reduced to the rest of the mention
+    assert person_spans.span_to_person_id() == {(10, 15): 0, (20, 29): 1, (34, 39): 0}
+    assert person_spans.find_and_update(10, 15) == 0
+    assert person_spans.find_and_update(16, 19) is None
+    assert person_spans.find_and_update(20, 22) == 1
+    assert person_spans.find_and_update(34, 39) == 0
+    assert person_spans.span_to_person_id() == {(22, 29): 1}
+
+
+def test_spacy_pipe():
+    """
+    Test that batching articles through nlp.pipe, as make_datafiles and scripts.write_results do,
+    parses them the same as SingleDocument.spacy_text.
+    """
+    with open('test_article.json') as f:
+        data = json.load(f)
+    docs = [
+        SingleDocument(0, raw={'body': text})
+        for text in (data['article'], u'Barack Obama met Angela Merkel in Berlin. Obama spoke.')
+    ]
+
+    piped_articles = get_spacy().pipe((doc.text() for doc in docs), batch_size=2, n_threads=1)
+    for doc, piped_article in zip(docs, piped_articles):
+        spacy_article = doc.spacy_text()
+        assert piped_article.text == spacy_article.text
+        assert [
+            (token.text, token.idx, token.ent_type_, token.pos_) for token in piped_article
+        ] == [(token.text, token.idx, token.ent_type_, token.pos_) for token in spacy_article]
+        assert process_article(piped_article) == process_article(spacy_article)
+
+
+def test_detokenize():
+    """
+    Test that the fast detokenizer gives the same output as MosesDetokenizer.
+    """
+    token_strings_list = [
+        u'The president , Barack Obama , said " it is n\'t over " .'.split(),
+        u"The Jones ' house is the boss ' office , and John 's too .".split(),
+        u"He paid $ 5 ( about \u00a3 3 ) for 10 % of it ; really ? yes !".split(),
+        u"`` Quoted '' and ' single ' quotes , plus \u201c curly \u201d ones .".split(),
+        u"AT&amp;T &quot; escapes &quot; and a well @-@ known [ bracket ] { brace } .".split(),
+        u"They 're sure we 'll win in the '90s , \u65e5\u672c \u8a9e .".split(),
+    ]
+    with open('test_article.json') as f:
+        data = json.load(f)
+    orig_article_tokens = process_article(
+        SingleDocument(0, raw={'body': data['article']}).spacy_text()
+    )[2]
+    token_strings_list += [
+        orig_article_tokens[i: i + 30] for i in range(0, len(orig_article_tokens), 30)
+    ]
+
+    for token_strings in token_strings_list:
+        assert _detokenize(token_strings) == _moses_detokenizer.detokenize(
+            token_strings, return_str=True
+        )
+
+
+def test_word_capitalizations():
+    article_token_strings = u'Apple said . Apple , apple and APPLE make the IPhone , iPhone'.split()
+    assert get_word_capitalizations(article_token_strings) == {
+        u'said': u'said',
+        u'.': u'.',
+        u',': u',',
+        u'apple': u'APPLE',
+        u'and': u'and',
+        u'make': u'make',
+        u'the': u'the',
+        u'iphone': u'IPhone',
+    }
@@ -0,0 +1,42 @@
+from io_processing import process_article
+from make_datafiles import process_tasks
+from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
+from primer_core.nlp.get_spacy import get_spacy
+
+
+def test_process_tasks(tmpdir):
+    """
+    Test that stories tokenized in a batch get the same tokens as each story processed on its own,
+    as decoder.generate_summary does, even when they share a surname.
+    """
+    stories = [
+        (u'John Smith met Mary Jones in Paris. Smith said the talks went well. Jones agreed.',
+         u'Smith met Jones.'),
+        (u'Anna Smith won the race on Sunday. Smith, 24, beat Tom Brown by a second.',
+         u'Anna Smith won.'),
+    ]
+    input_filenames = []
+    output_filenames = []
+    for i, (article, abstract) in enumerate(stories):
+        input_filenames.append(str(tmpdir.join('%d.story' % i)))
+        output_filenames.append(str(tmpdir.join('%d.tokenized' % i)))
+        with open(input_filenames[-1], 'w') as f:
+            f.write('%s\n\n@highlight\n\n%s\n' % (article, abstract))
+
+    process_tasks(input_filenames, output_filenames, is_cable=False)
+
+    for (article, abstract), output_filename in zip(stories, output_filenames):
+        clean_article = SingleDocument(0, raw={'body': article}).text()
+        text_tokens, text_token_indices, _, _ = process_article(
+            get_spacy()(u'%s %s' % (clean_article, abstract))
+        )
+        expected_article_tokens = [
+            text for text, idx in zip(text_tokens, text_token_indices) if idx < len(clean_article)
+        ]
+        expected_abstract_tokens = [
+            text for text, idx in zip(text_tokens, text_token_indices) if idx >= len(clean_article)
+        ]
+        with open(output_filename) as f:
+            article_tokens, abstract_tokens = unicode(f.read(), 'utf-8').split(u'\n\n@highlight\n')
+        assert article_tokens.split() == expected_article_tokens
+        assert abstract_tokens.split() == expected_abstract_tokens
@@ -0,0 +1,39 @@
+import json
+
+import numpy as np
+
+import decoder
+from batcher import Example
+from data import Vocab
+from io_processing import process_article
+from packed_article import PackedArticle, SharedSlots, pack_article
+from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
+
+
+def test_pack_article():
+    with open('test_article.json') as f:
+        data = json.load(f)
+    spacy_article = SingleDocument(0, raw={'body': data['article']}).spacy_text()
+    article_tokens, _, _, word_capitalizations = process_article(spacy_article)
+    vocab = Vocab(decoder._vocab_path, decoder._vocab_size)
+    hps = decoder._decode_hps()
+
+    packed = pack_article(article_tokens, word_capitalizations, spacy_article.text, vocab, hps)
+    slots = SharedSlots(2)
+    assert slots.write(1, packed)
+    assert not slots.write(0, packed + ' ' * slots.slot_size)
+
+    example = Example(' '.join(article_tokens), abstract='', vocab=vocab, hps=hps)
+    for packed_article in (PackedArticle(packed), slots.read(1)):
+        assert packed_article.length == len(packed)
+        assert len(packed_article) == len(article_tokens)
+        assert packed_article.text == spacy_article.text
+        assert packed_article.word_capitalizations == word_capitalizations
+
+        packed_example = Example.from_packed_article(packed_article, vocab, hps)
+        for attribute in (
+            'enc_len', 'enc_input', 'enc_input_extend_vocab', 'article_oovs',
+            'article_id_to_word_id', 'dec_input', 'target', 'target_people',
+        ):
+            assert np.array_equal(getattr(packed_example, attribute), getattr(example, attribute))
+        assert sorted(packed_example.people_ids) == sorted(example.people_ids)
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from pipeline import SummarizationPipeline
+
+
+def test_pipeline():
+    with open('test_article.json') as f:
+        data = json.load(f)
+    pipeline = SummarizationPipeline(n_processes=2, queue_size=1)
+
+    outputs = pipeline.run([data['article'], u'Short phrase.', data['article']])
+    assert len(outputs) == 3
+    for i in (0, 2):
+        summary, score = outputs[i]
+        assert summary == data['expected_summary']
+        assert abs(score - data['expected_score']) < .001
+    assert outputs[1] == (u'Short phrase.', 0.)
+    assert 0. < pipeline.stats['decode_utilization'] <= 1.
+
+    pipeline.close()
+
+
+def test_pipeline_error(monkeypatch):
+    import pipeline as pipeline_module
+
+    def process_article(spacy_article):
+        if spacy_article.text == u'Bad article.':
+            raise ValueError(spacy_article.text)
+        return original_process_article(spacy_article)
+
+    # patched before the processing pool is forked
+    original_process_article = pipeline_module.process_article
+    monkeypatch.setattr(pipeline_module, 'process_article', process_article)
+    pipeline = SummarizationPipeline(n_processes=1, queue_size=1)
+
+    # more failures than slots, so a failure that kept its slot would block the run
+    with pytest.raises(ValueError):
+        pipeline.run([u'Short phrase.'] + [u'Bad article.'] * 8)
+    # the slots are all free for the next run
+    assert pipeline.run([u'Short phrase.'] * 8) == [(u'Short phrase.', 0.)] * 8
+
+    pipeline.close()
@@ -1,7 +1,13 @@
 import json
 from pytest import raises
 
-from decoder import generate_summary
+import decoder
+import io_processing
+from decoder import (
+    CheckpointWatcher, generate_n_best_summaries, generate_summaries, generate_summary,
+    stream_summary,
+)
+from io_processing import annotate_article
 from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
 from primer_core.nlp.get_spacy import get_spacy
 
@@ -38,3 +44,127 @@ def test_real_article():
     assert summary == data['expected_summary']
     assert abs(score - data['expected_score']) < .001
 
+
+
+def test_decode_modes():
+    """
+    Test that the cheaper decode modes produce summaries with scores on the usual scale.
+    """
+    with open('test_article.json') as f:
+        data = json.load(f)
+    doc = SingleDocument(document_id=0, raw={'body': data['article']})
+
+    for decode_mode in ('narrow', 'greedy'):
+        summary, score = generate_summary(doc.spacy_text(), decode_mode=decode_mode)
+        assert isinstance(summary, unicode)
+        assert summary
+        assert -1. < score < 0.
+
+
+def test_multiple_lengths():
+    """
+    Test that a single search for several lengths gives the expected summary for the default
+    length.
+    """
+    with open('test_article.json') as f:
+        data = json.load(f)
+    doc = SingleDocument(document_id=0, raw={'body': data['article']})
+
+    outputs = generate_summaries(doc.spacy_text(), [30, 60, 90])
+    assert len(outputs) == 3
+    assert outputs[1][0] == data['expected_summary']
+    for summary, score in outputs:
+        assert isinstance(summary, unicode)
+        assert summary
+        assert -1. < score < 0.
+
+
+def test_n_best():
+    """
+    Test that the n-best summaries are distinct, sorted by score, and start with the expected
+    summary.
+    """
+    with open('test_article.json') as f:
+        data = json.load(f)
+    doc = SingleDocument(document_id=0, raw={'body': data['article']})
+
+    outputs = generate_n_best_summaries(doc.spacy_text(), n_best=3)
+    summaries = [summary for summary, _ in outputs]
+    scores = [score for _, score in outputs]
+    assert 1 <= len(outputs) <= 3
+    assert summaries[0] == data['expected_summary']
+    assert len(set(summaries)) == len(summaries)
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_stream_summary():
+    """
+    Test that streaming yields partial summaries and ends with the expected summary.
+    """
+    with open('test_article.json') as f:
+        data = json.load(f)
+    doc = SingleDocument(document_id=0, raw={'body': data['article']})
+
+    outputs = list(stream_summary(doc.spacy_text()))
+    assert len(outputs) > 1
+    assert outputs[0][0].endswith('...')
+    assert outputs[-1][0] == data['expected_summary']
+    assert abs(outputs[-1][1] - data['expected_score']) < .001
+
+
+def test_checkpoint_watcher():
+    """
+    Test that a new model is swapped in only when the checkpoint changes (and not for a model
+    loaded from a weight bundle), that replaced sessions are closed once unused, and that
+    summaries are the same after the swap.
+    """
+    with open('test_article.json') as f:
+        data = json.load(f)
+    doc = SingleDocument(document_id=0, raw={'body': data['article']})
+    generate_summary(doc.spacy_text())
+
+    watcher = CheckpointWatcher(interval_secs=3600)
+    assert not watcher.check()
+
+    loaded_model = decoder._loaded_model
+    decoder._loaded_model = loaded_model._replace(checkpoint_path='old_checkpoint')
+    assert watcher.check()
+    assert decoder._loaded_model.checkpoint_path == loaded_model.checkpoint_path
+    assert decoder._loaded_model.sess is not loaded_model.sess
+    # no request was using the replaced model
+    assert loaded_model.sess._closed
+
+    # a running request keeps the replaced model's session open until it's done
+    with decoder._using_model() as running_model:
+        decoder._loaded_model = running_model._replace(checkpoint_path='old_checkpoint')
+        assert watcher.check()
+        assert not running_model.sess._closed
+    assert running_model.sess._closed
+
+    # a model loaded from a weight bundle isn't replaced
+    swapped_model = decoder._loaded_model
+    decoder._loaded_model = swapped_model._replace(checkpoint_path=None, weight_bundle_dir='bundle')
+    assert not watcher.check()
+    decoder._loaded_model = swapped_model
+    watcher.stop()
+
+    summary, _ = generate_summary(doc.spacy_text())
+    assert summary == data['expected_summary']
+
+
+def test_annotated_article(monkeypatch):
+    """
+    Test that an annotated article gives the same summary without running the people resolver.
+    """
+    with open('test_article.json') as f:
+        data = json.load(f)
+    doc = SingleDocument(document_id=0, raw={'body': data['article']})
+    annotated_article = annotate_article(doc.spacy_text())
+
+    def resolve_people(spacy_article):
+        raise AssertionError('people resolver called')
+    monkeypatch.setattr(io_processing, '_resolve_people', resolve_people)
+
+    summary, score = generate_summary(annotated_article)
+    assert summary == data['expected_summary']
+    assert abs(score - data['expected_score']) < .001
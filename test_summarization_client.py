@@ -0,0 +1,125 @@
+import json
+import time
+import traceback
+from pytest import raises
+
+import decoder
+from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
+from summarization_client import (
+    SummarizationClient, SummarizerBusy, SummarizerClosed, SummaryCancelled, SummaryTimeout,
+)
+
+
+def _load_article():
+    with open('test_article.json') as f:
+        data = json.load(f)
+    doc = SingleDocument(document_id=0, raw={'body': data['article']})
+    return doc.spacy_text(), data
+
+
+def test_result():
+    spacy_article, data = _load_article()
+    client = SummarizationClient()
+
+    summary, score = client.summarize(spacy_article)
+    assert summary == data['expected_summary']
+    assert abs(score - data['expected_score']) < .001
+    assert client.metrics['interactive']['completed'] == 1
+    assert client.queue_wait_percentiles('interactive') is not None
+
+    client.close()
+
+
+def test_stream():
+    """
+    Test that only requests asking to stream get partial summaries.
+    """
+    spacy_article, data = _load_article()
+    client = SummarizationClient()
+
+    streaming = client.submit(spacy_article, stream=True)
+    not_streaming = client.submit(spacy_article)
+    assert streaming.result()[0] == data['expected_summary']
+    assert streaming.partial == streaming.result()
+    assert not_streaming.result()[0] == data['expected_summary']
+    assert not_streaming.partial is None
+
+    client.close()
+
+
+def test_cancel():
+    spacy_article, _ = _load_article()
+    client = SummarizationClient(queue_limits={'interactive': 1})
+
+    first = client.submit(spacy_article)
+    # wait for the first request to start
+    while first.queue_wait is None:
+        time.sleep(.01)
+    second = client.submit(spacy_article)
+    assert second.cancel()
+    assert second.done()
+    # the cancelled request doesn't keep its place in the queue
+    third = client.submit(spacy_article)
+    third.cancel()
+    first.cancel()
+    for request in (first, second, third):
+        with raises(SummaryCancelled):
+            request.result()
+    assert not second.cancel()
+    assert client.metrics['interactive']['cancelled'] == 3
+
+    client.close()
+
+
+def test_busy():
+    spacy_article, _ = _load_article()
+    client = SummarizationClient(queue_limits={'bulk': 0})
+
+    with raises(SummarizerBusy):
+        client.submit(spacy_article, priority='bulk')
+    assert client.metrics['bulk']['rejected'] == 1
+
+    client.close()
+
+
+def test_priority():
+    """
+    Test that an interactive request doesn't wait for a bulk request submitted before it.
+    """
+    spacy_article, data = _load_article()
+    client = SummarizationClient()
+
+    bulk = client.submit(spacy_article, priority='bulk')
+    interactive = client.submit(spacy_article, priority='interactive')
+    summary, _ = interactive.result()
+    assert summary == data['expected_summary']
+    assert not bulk.done()
+    assert bulk.result()[0] == data['expected_summary']
+
+    client.close()
+
+
+def test_errors(monkeypatch):
+    spacy_article, _ = _load_article()
+    client = SummarizationClient()
+
+    request = client.submit(spacy_article)
+    with raises(SummaryTimeout):
+        request.result(timeout=0)
+    request.cancel()
+
+    def stream_summary(spacy_article, **kwargs):
+        raise ValueError('bad article')
+        yield
+
+    monkeypatch.setattr(decoder, 'stream_summary', stream_summary)
+    failed = client.submit(spacy_article)
+    with raises(ValueError) as excinfo:
+        failed.result()
+    # raised with the traceback of the worker thread
+    assert 'stream_summary' in [name for _, _, name, _ in traceback.extract_tb(excinfo.tb)]
+    assert client.metrics['interactive']['failed'] == 1
+
+    client.close()
+    with raises(SummarizerClosed):
+        client.submit(spacy_article)
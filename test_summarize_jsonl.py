@@ -0,0 +1,40 @@
+import json
+
+from summarize_jsonl import read_articles, read_done_ids
+
+
+def test_read_articles(tmpdir):
+    input_file = tmpdir.join('articles.jsonl')
+    input_file.write('\n'.join([
+        json.dumps({'id': 'a', 'article': 'First article.'}),
+        json.dumps({'article': 'Article without id.'}),
+        '',
+        json.dumps({'id': 'c', 'article': 'Third article.'}),
+        # an explicit id that is also a line number
+        json.dumps({'id': 2, 'article': 'Article with a number id.'}),
+    ]) + '\n')
+
+    articles = list(read_articles(str(input_file), skip_ids={'c'}))
+    assert articles == [
+        ('a', 'First article.'), ('line:2', 'Article without id.'),
+        (2, 'Article with a number id.'),
+    ]
+
+    # ids read back from an output file are unicode
+    articles = list(read_articles(str(input_file), skip_ids={u'line:2', 2}))
+    assert articles == [('a', 'First article.'), ('c', 'Third article.')]
+
+
+def test_read_done_ids(tmpdir):
+    output_file = tmpdir.join('results.jsonl')
+    assert read_done_ids(str(output_file)) == set()
+
+    complete_lines = '\n'.join([
+        json.dumps({'id': 'a', 'summary': 'Summary.', 'score': -.3, 'seconds': 1.}),
+        json.dumps({'id': 'line:2', 'error': 'ValueError()', 'seconds': 1.}),
+    ]) + '\n'
+    # the job was killed while writing the last line
+    output_file.write(complete_lines + '{"id": "c", "summ')
+
+    assert read_done_ids(str(output_file)) == {'a', 'line:2'}
+    assert output_file.read() == complete_lines
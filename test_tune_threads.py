@@ -0,0 +1,27 @@
+from tune_threads import candidate_layouts, pareto_front
+
+
+def test_candidate_layouts():
+    layouts = candidate_layouts(4)
+    assert (1, 4, 1) in layouts
+    assert (4, 1, 2) in layouts
+    assert (2, 4, 1) not in layouts
+    assert all(n_workers * intra_op_threads <= 4 for n_workers, intra_op_threads, _ in layouts)
+
+
+def test_pareto_front():
+    fast = {'throughput': 2., 'latency_50': 10.}
+    responsive = {'throughput': 1., 'latency_50': 5.}
+    dominated = {'throughput': 1., 'latency_50': 12.}
+    assert pareto_front([responsive, dominated, fast]) == [fast, responsive]
+
+
+def test_pareto_front_ties():
+    # layouts with the same metrics are all kept, not dropped for dominating each other
+    tied = [
+        {'n_workers': n_workers, 'throughput': 1., 'latency_50': 5.} for n_workers in (1, 2)
+    ]
+    assert pareto_front(tied) == tied
+    # a tie in one metric is dominated by being better in the other
+    fast = {'n_workers': 3, 'throughput': 2., 'latency_50': 5.}
+    assert pareto_front(tied + [fast]) == [fast]
@@ -0,0 +1,33 @@
+import json
+
+import decoder
+from decoder import generate_summary
+from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
+from weight_bundle import export_weight_bundle, load_weight_bundle
+
+
+def test_export_and_import(tmpdir):
+    """
+    Test that the model run from a weight bundle maps its weights instead of holding variables,
+    and gives the same summary as the model restored from the checkpoint.
+    """
+    if decoder._loaded_model is None:
+        decoder._load_model()
+    loaded_model = decoder._loaded_model
+    bundle_dir = str(tmpdir.join('bundle'))
+    export_weight_bundle(loaded_model.sess, loaded_model.model, bundle_dir)
+
+    ops = set(node.op for node in load_weight_bundle(bundle_dir).node)
+    assert 'ImmutableConst' in ops
+    assert not ops & {'Variable', 'VariableV2'}
+
+    with open('test_article.json') as f:
+        data = json.load(f)
+    doc = SingleDocument(document_id=0, raw={'body': data['article']})
+    decoder._loaded_model = decoder._build_model(weight_bundle_dir=bundle_dir)
+    try:
+        summary, score = generate_summary(doc.spacy_text())
+    finally:
+        decoder._loaded_model = loaded_model
+    assert summary == data['expected_summary']
+    assert abs(score - data['expected_score']) < .001
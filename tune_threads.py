@@ -0,0 +1,136 @@
+"""
+Tunes the tensorflow threading and the number of worker processes for this host. Each combination
+of worker count and intra / inter op thread counts is benchmarked on a sample corpus with
+worker_pool.SummarizerPool, the throughput / latency Pareto front is reported, and the chosen
+combination is written to the host config (see decoder.load_host_config), which the decoder and
+the worker pool load by default.
+
+Usage: python tune_threads.py <articles_dir> [max_latency_secs]
+    articles_dir contains one article text per file. The combination with the highest throughput
+    whose median latency is at most max_latency_secs (if given) is chosen.
+"""
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import decoder
+from worker_pool import SummarizerPool
+
+
+def candidate_layouts(n_cpus):
+    """
+    Returns the (n_workers, intra_op_threads, inter_op_threads) combinations to try: powers of two
+    that don't use more threads for ops than there are CPUs.
+    """
+    powers = [2 ** i for i in range(n_cpus.bit_length()) if 2 ** i <= n_cpus]
+    return [
+        (n_workers, intra_op_threads, inter_op_threads)
+        for n_workers in powers
+        for intra_op_threads in powers
+        for inter_op_threads in (1, 2)
+        if n_workers * intra_op_threads <= n_cpus
+    ]
+
+
+def benchmark_layout(article_texts, n_workers, intra_op_threads, inter_op_threads):
+    """
+    Returns the throughput (articles / second) and median and 90th percentile latencies (seconds
+    per article) of a pool with the given layout.
+    """
+    pool = SummarizerPool(n_workers, session_threads=(intra_op_threads, inter_op_threads))
+    # make sure the workers have loaded the model before timing
+    pool.map(article_texts[:n_workers])
+    t0 = time.time()
+    pool.map(article_texts)
+    throughput = len(article_texts) / (time.time() - t0)
+    latencies = pool.latencies
+    pool.close()
+    return throughput, np.percentile(latencies, 50), np.percentile(latencies, 90)
+
+
+def pareto_front(results):
+    """
+    Returns the results (dictionaries with 'throughput' and 'latency_50') not dominated by
+    another result, by decreasing throughput. A result is dominated if another is at least as
+    good in both throughput and latency and strictly better in one, so tied results are all kept
+    and the front of non-empty results is never empty.
+    """
+    def dominates(other, result):
+        return (
+            other['throughput'] >= result['throughput']
+            and other['latency_50'] <= result['latency_50']
+            and (
+                other['throughput'] > result['throughput']
+                or other['latency_50'] < result['latency_50']
+            )
+        )
+
+    front = [
+        result for result in results
+        if not any(dominates(other, result) for other in results)
+    ]
+    return sorted(front, key=lambda result: (-result['throughput'], result['latency_50']))
+
+
+def tune(article_texts, max_latency_secs=None):
+    """
+    Benchmarks all candidate layouts, writes the chosen one to the host config, and returns the
+    Pareto front.
+    """
+    results = []
+    for n_workers, intra_op_threads, inter_op_threads in candidate_layouts(
+        multiprocessing.cpu_count()
+    ):
+        throughput, latency_50, latency_90 = benchmark_layout(
+            article_texts, n_workers, intra_op_threads, inter_op_threads
+        )
+        result = {
+            'n_workers': n_workers,
+            'intra_op_threads': intra_op_threads,
+            'inter_op_threads': inter_op_threads,
+            'throughput': throughput,
+            'latency_50': latency_50,
+            'latency_90': latency_90,
+        }
+        print result
+        results.append(result)
+
+    front = pareto_front(results)
+    acceptable = [
+        result for result in front
+        if max_latency_secs is None or result['latency_50'] <= max_latency_secs
+    ]
+    # fall back to the lowest latency if none is fast enough
+    chosen = acceptable[0] if acceptable else front[-1]
+
+    path = decoder.host_config_path()
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump({
+            key: chosen[key] for key in ('n_workers', 'intra_op_threads', 'inter_op_threads')
+        }, f, indent=1, sort_keys=True)
+
+    print '####################'
+    print 'Pareto front (throughput in articles / second, latencies in seconds):'
+    for result in front:
+        print '%s workers x (%s intra, %s inter) threads: %.3f | %.2f | %.2f' % (
+            result['n_workers'], result['intra_op_threads'], result['inter_op_threads'],
+            result['throughput'], result['latency_50'], result['latency_90'],
+        )
+    print 'Wrote %s to %s' % (chosen, path)
+
+    return front
+
+
+if __name__ == '__main__':
+    articles_dir = sys.argv[1]
+    article_texts = []
+    for filename in sorted(os.listdir(articles_dir)):
+        with open(os.path.join(articles_dir, filename)) as f:
+            article_texts.append(unicode(f.read(), 'utf-8'))
+    tune(article_texts, float(sys.argv[2]) if len(sys.argv) > 2 else None)
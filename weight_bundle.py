@@ -0,0 +1,158 @@
+"""
+Exports a restored model for decoding as a weight bundle: the decode graph frozen to constants,
+with each large constant replaced by an ImmutableConst op reading its value from its own file in
+the bundle. Tensorflow maps these files read-only instead of copying them into variable buffers,
+so processes loading the same bundle share the pages of the weights through the page cache, and
+the memory of each process doesn't grow with the size of the model.
+
+Tensorflow's convert_graphdef_memmapped_format tool packs all the constants into a single file,
+but reading it needs a MemmappedEnv, which isn't exposed to Python. Without it ImmutableConst maps
+whole files, so the bundle has one file per constant.
+
+Usage: python weight_bundle.py <bundle_dir>
+    exports the model in model_parameters/ (see decoder.py) to bundle_dir.
+"""
+import os
+import sys
+
+
+GRAPH_FILENAME = 'graph.pb'
+# Constants smaller than this many bytes are kept in the graph rather than mapped.
+MIN_MAPPED_BYTES = 4096
+
+
+def export_weight_bundle(sess, model, bundle_dir):
+    """
+    Freezes the model's graph with the values of the variables in the session and writes it to
+    bundle_dir.
+
+    Args:
+        sess: a tf.Session with restored variables
+        model: the model.SummarizationModel of the session's graph, built in decode mode. The
+            frozen graph keeps everything its attributes refer to (placeholders, outputs, ...).
+        bundle_dir: string, directory to write the graph and constants to
+    """
+    # These imports are slow - lazy import.
+    import tensorflow as tf
+    from tensorflow.core.framework import attr_value_pb2, node_def_pb2
+    from tensorflow.python.framework import tensor_util
+
+    if not os.path.exists(bundle_dir):
+        os.makedirs(bundle_dir)
+
+    names = set()
+    for value in vars(model).itervalues():
+        _map_graph_elements(value, lambda element: names.add(element.name.split(':')[0]))
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), sorted(names)
+    )
+
+    for i, node in enumerate(graph_def.node):
+        if node.op != 'Const':
+            continue
+        value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+        if value.dtype.kind not in 'biuf' or value.nbytes < MIN_MAPPED_BYTES:
+            continue
+        filename = '%d.bin' % i
+        value.tofile(os.path.join(bundle_dir, filename))
+
+        mapped_node = node_def_pb2.NodeDef(name=node.name, op='ImmutableConst', device=node.device)
+        mapped_node.attr['dtype'].CopyFrom(node.attr['dtype'])
+        mapped_node.attr['shape'].CopyFrom(
+            attr_value_pb2.AttrValue(shape=tf.TensorShape(value.shape).as_proto())
+        )
+        mapped_node.attr['memory_region_name'].CopyFrom(attr_value_pb2.AttrValue(s=filename))
+        node.CopyFrom(mapped_node)
+
+    with open(os.path.join(bundle_dir, GRAPH_FILENAME), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+
+def load_weight_bundle(bundle_dir):
+    """
+    Returns the frozen tf.GraphDef of the bundle, with the files of the mapped constants as
+    absolute paths.
+    """
+    # These imports are slow - lazy import.
+    import tensorflow as tf
+
+    graph_def = tf.GraphDef()
+    with open(os.path.join(bundle_dir, GRAPH_FILENAME), 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    bundle_dir = os.path.abspath(bundle_dir)
+    for node in graph_def.node:
+        if node.op == 'ImmutableConst':
+            node.attr['memory_region_name'].s = os.path.join(
+                bundle_dir, node.attr['memory_region_name'].s
+            )
+    return graph_def
+
+
+def import_weight_bundle(model, bundle_dir):
+    """
+    Imports the frozen graph of the bundle into a new graph, and points the model's attributes to
+    it instead of the graph the model was built in. Returns the new graph.
+
+    Args:
+        model: a model.SummarizationModel built in decode mode with the same hyperparameters as
+            the exported one. Its graph is only used for the names of the tensors.
+        bundle_dir: string, directory of the bundle
+    """
+    # These imports are slow - lazy import.
+    import tensorflow as tf
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(load_weight_bundle(bundle_dir), name='')
+    for name, value in vars(model).items():
+        setattr(model, name, _map_graph_elements(
+            value, lambda element: graph.as_graph_element(element.name)
+        ))
+    return graph
+
+
+def configure_session(config):
+    """
+    Sets the options of the tf.ConfigProto for sessions running the frozen graph of a bundle.
+    Constant folding would copy the mapped constants, and whatever is computed from them, into
+    each session's own memory, so it is turned off.
+    """
+    # These imports are slow - lazy import.
+    import tensorflow as tf
+    from tensorflow.core.protobuf import rewriter_config_pb2
+
+    optimizer_options = config.graph_options.optimizer_options
+    # L1 turns constant folding on regardless of do_constant_folding
+    optimizer_options.opt_level = tf.OptimizerOptions.L0
+    optimizer_options.do_common_subexpression_elimination = True
+    optimizer_options.do_constant_folding = False
+    config.graph_options.rewrite_options.constant_folding = rewriter_config_pb2.RewriterConfig.OFF
+
+
+def _map_graph_elements(value, fn):
+    """
+    Returns value with fn applied to each of the tensors, operations and variables in it, which
+    can be nested in lists, tuples (including namedtuples) and dictionaries. A variable is mapped
+    to a tensor, as variables are constants once frozen.
+    """
+    # These imports are slow - lazy import.
+    import tensorflow as tf
+
+    if isinstance(value, (tf.Tensor, tf.Operation, tf.Variable)):
+        return fn(value)
+    if isinstance(value, list):
+        return [_map_graph_elements(item, fn) for item in value]
+    if isinstance(value, tuple):
+        items = [_map_graph_elements(item, fn) for item in value]
+        # namedtuples take their fields as arguments
+        return type(value)(*items) if hasattr(value, '_fields') else tuple(items)
+    if isinstance(value, dict):
+        return {key: _map_graph_elements(item, fn) for key, item in value.iteritems()}
+    return value
+
+
+if __name__ == '__main__':
+    import decoder
+
+    decoder._load_model()
+    export_weight_bundle(decoder._loaded_model.sess, decoder._loaded_model.model, sys.argv[1])
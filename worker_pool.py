@@ -0,0 +1,263 @@
+"""
+Pool of worker processes generating summaries, for using more cores per host.
+
+The pool is pre-forked: spacy, tensorflow and the other slow modules are loaded in the parent
+before the workers are started, so their memory is shared by the workers copy-on-write. Each
+worker then builds its own model and session (tensorflow sessions can't be shared across a fork).
+If given a weight bundle (see weight_bundle.py), the workers run its frozen graph, which maps the
+weights read-only from the bundle's files, so all workers share a single copy of the weights
+through the page cache instead of each restoring its own.
+"""
+import multiprocessing
+import os
+import Queue
+import time
+import traceback
+
+import decoder
+from primer_core.analytic_pipelines.base.document_pipeline import SingleDocument
+from primer_core.nlp.get_spacy import get_spacy
+
+
+def memory_usage(pid='self'):
+    """
+    Returns the resident set size and proportional set size (shared pages divided by the number of
+    processes sharing them) of the process in bytes, read from /proc. The proportional set size is
+    None if not available.
+    """
+    rss = None
+    with open('/proc/%s/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+
+    pss = None
+    smaps_path = '/proc/%s/smaps' % pid
+    if os.path.exists(smaps_path):
+        pss = 0
+        with open(smaps_path) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    pss += int(line.split()[1]) * 1024
+
+    return rss, pss
+
+
+class SummarizerWorkerError(Exception):
+    """
+    An error raised in a worker, rebuilt in the parent from the name of its type, its message and
+    its formatted traceback. Errors aren't sent as they are, since an error that can't be pickled
+    (e.g. one holding tensorflow or spacy objects) would never reach the parent.
+    """
+
+    def __init__(self, type_name, message, worker_traceback):
+        Exception.__init__(self, '%s: %s' % (type_name, message))
+        self.type_name = type_name
+        self.error_message = message
+        self.worker_traceback = worker_traceback
+
+
+def _error_info(e):
+    """
+    Returns the (type name, message, formatted traceback) tuple of the error being handled, which
+    can always be pickled.
+    """
+    # formatted first, since handling an error of str() below replaces the error being handled
+    formatted_traceback = traceback.format_exc()
+    try:
+        message = str(e)
+    except Exception:
+        message = repr(e)
+    return type(e).__name__, message, formatted_traceback
+
+
+class SummarizerPool(object):
+    """
+    Generates summaries of article texts on a pool of pre-forked worker processes.
+    """
+
+    def __init__(
+        self, n_workers=None, weight_bundle_dir=None, pin_cpus=False, session_threads=None,
+        result_timeout=None,
+    ):
+        """
+        SummarizerPool constructor. Starts the workers, which load the model.
+
+        Args:
+            n_workers: Integer, the number of worker processes. Defaults to the host config (see
+                decoder.load_host_config), or the number of CPUs.
+            weight_bundle_dir: optional string, directory of a weight bundle to restore the model
+                parameters from. Defaults to the checkpoint in model_parameters/.
+            pin_cpus: Boolean. If True, worker i is pinned to CPU i (modulo the number of CPUs).
+                Requires psutil.
+            session_threads: optional (intra_op_parallelism_threads,
+                inter_op_parallelism_threads) tuple for the sessions of the workers. Defaults to
+                the host config.
+            result_timeout: optional number of seconds to wait for the next result while articles
+                are in flight, after which a RuntimeError is raised (e.g. if a worker hangs).
+        """
+        if n_workers is None:
+            n_workers = decoder.load_host_config().get('n_workers', multiprocessing.cpu_count())
+
+        # Load everything that can be shared before forking.
+        import tensorflow
+        import batcher, beam_search, io_processing, model
+        get_spacy()
+
+        self._tasks = multiprocessing.JoinableQueue()
+        self._results = multiprocessing.Queue()
+        self._result_timeout = result_timeout
+        # seconds taken by the workers for each article of the last call to map
+        self.latencies = []
+        self.workers = []
+        for i in range(n_workers):
+            cpu = i % multiprocessing.cpu_count() if pin_cpus else None
+            worker = SummarizerWorker(
+                self._tasks, self._results, weight_bundle_dir, cpu, session_threads
+            )
+            worker.start()
+            self.workers.append(worker)
+
+
+    def map(self, article_texts, **kwargs):
+        """
+        Returns the (summary, score) tuples as returned by decoder.generate_summary for each of
+        the article texts, in order.
+
+        Args:
+            article_texts: list of unicode article texts
+            kwargs: other arguments of decoder.generate_summary
+        """
+        outputs = [None] * len(article_texts)
+        self.latencies = [None] * len(article_texts)
+        first_error = None
+        for i, output, error, latency in self.imap_unordered(enumerate(article_texts), **kwargs):
+            # collect all the results before raising, so none are left for the next call
+            if error is not None and first_error is None:
+                first_error = error
+            outputs[i] = output
+            self.latencies[i] = latency
+        if first_error is not None:
+            raise first_error
+        return outputs
+
+
+    def imap_unordered(self, keyed_article_texts, max_in_flight=None, **kwargs):
+        """
+        Summarizes the article texts, yielding results as they are done. Only max_in_flight
+        articles are queued at once, so keyed_article_texts can be a long iterator.
+
+        Args:
+            keyed_article_texts: iterable of (key, unicode article text) tuples
+            max_in_flight: Integer, the most number of articles queued or being summarized.
+                Defaults to twice the number of workers.
+            kwargs: other arguments of decoder.generate_summary
+
+        Yields:
+            (key, output, error, latency) tuples, where output is the (summary, score) tuple (or
+            None if an exception was raised, in which case error is a SummarizerWorkerError), and
+            latency is the number of seconds the worker took for the article.
+        """
+        if max_in_flight is None:
+            max_in_flight = 2 * len(self.workers)
+
+        n_in_flight = 0
+        for key, article_text in keyed_article_texts:
+            if n_in_flight == max_in_flight:
+                yield self._get_result()
+                n_in_flight -= 1
+            self._tasks.put((key, article_text, kwargs))
+            n_in_flight += 1
+
+        for _ in xrange(n_in_flight):
+            yield self._get_result()
+
+
+    def _get_result(self):
+        """
+        Returns the next result from the workers, with the error info rebuilt as a
+        SummarizerWorkerError. Raises a RuntimeError if a worker died (e.g. was killed), since the
+        results of its articles would never come, or if no result came within the result timeout.
+        """
+        t0 = time.time()
+        while True:
+            try:
+                key, output, error_info, latency = self._results.get(timeout=1)
+            except Queue.Empty:
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        raise RuntimeError('Summarizer worker %d exited with code %s' % (
+                            worker.pid, worker.exitcode
+                        ))
+                if self._result_timeout is not None and time.time() - t0 > self._result_timeout:
+                    raise RuntimeError(
+                        'No result from the summarizer workers in %d seconds' % self._result_timeout
+                    )
+                continue
+            error = SummarizerWorkerError(*error_info) if error_info is not None else None
+            return key, output, error, latency
+
+
+    def memory_usage(self):
+        """
+        Returns the list of (rss, pss) tuples of the workers, see memory_usage.
+        """
+        return [memory_usage(worker.pid) for worker in self.workers]
+
+
+    def close(self):
+        if any(worker.exitcode for worker in self.workers):
+            # A worker was killed, possibly while holding the lock of the task queue, so the
+            # others may never get their tasks.
+            for worker in self.workers:
+                worker.terminate()
+        else:
+            for _ in self.workers:
+                self._tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class SummarizerWorker(multiprocessing.Process):
+
+    def __init__(self, task_queue, result_queue, weight_bundle_dir, cpu, session_threads):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.weight_bundle_dir = weight_bundle_dir
+        self.cpu = cpu
+        self.session_threads = session_threads
+
+    def run(self):
+        if self.cpu is not None:
+            # Optional dependency - lazy import.
+            import psutil
+            psutil.Process().cpu_affinity([self.cpu])
+        # If the model can't be loaded, the error is the result of every article, so that the
+        # pool doesn't wait for results that will never come. Errors are sent as _error_info.
+        load_error = None
+        try:
+            decoder._load_model(self.weight_bundle_dir, self.session_threads)
+        except Exception as e:
+            load_error = _error_info(e)
+
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                self.task_queue.task_done()
+                break
+
+            key, article_text, kwargs = task
+            t0 = time.time()
+            if load_error is not None:
+                self.result_queue.put((key, None, load_error, 0.))
+                self.task_queue.task_done()
+                continue
+            try:
+                spacy_article = SingleDocument(0, raw={'body': article_text}).spacy_text()
+                output = decoder.generate_summary(spacy_article, **kwargs)
+                self.result_queue.put((key, output, None, time.time() - t0))
+            except Exception as e:
+                self.result_queue.put((key, None, _error_info(e), time.time() - t0))
+            self.task_queue.task_done()